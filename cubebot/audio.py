@@ -1,16 +1,22 @@
 import os
 import errno
 import logging
-from vlc import State, Instance
-from time import sleep
-from pn532 import PN532_SPI
+import queue
+import threading
+from collections import deque
+from vlc import State, Instance, EventType
+from time import monotonic
+from nfc_scanner import get_pn532, NFC_Scanner
 import config
-from model import session, CubeList, DeckList, Card, Cube
+import uid_resolver
+from model import session, session_scope, CubeList, DeckList, Card, Cube
 
 def audio_scan(cube, context):
-    pn532 = PN532_SPI(debug=False, reset=20, cs=4)
+    pn532 = get_pn532(emulated_uids=uid_resolver.tagged_uids)
     pn532.SAM_configuration()
+    cube_id = cube.id
     loop = True
+    last_seen = {}
     logging.info("audio scan ready")
     while loop:
         # Check if a card is available to read
@@ -18,6 +24,12 @@ def audio_scan(cube, context):
         # Try again if no card is available.
         if uid is None:
             continue
+        # Ignore a card left on the reader, like NFC_Scanner does
+        uid, now = bytes(uid), monotonic()
+        last = last_seen.get(uid, None)
+        last_seen[uid] = now
+        if last is not None and now - last < NFC_Scanner.debounce:
+            continue
         # Check if uid is known
         # cube, card, deck = session.query(CubeList, Card, DeckList).join(Card).join(DeckList).filter(CubeList.cube_id == cube.id,
         #                    CubeList.uid == uid).filter(or_(CubeList.signature != None, DeckList.note != None)).first()
@@ -25,24 +37,26 @@ def audio_scan(cube, context):
 ##        cubelist, decklist = session.query(CubeList, DeckList).filter(CubeList.card_id == DeckList.card_id).filter(CubeList.cube_id == cube.id,
 ##                             CubeList.uid == uid).filter(or_(CubeList.signature != None, DeckList.note != None)).first()
 
-        cubelist, decklist= None, None
-        result = session.query(CubeList, DeckList).filter(CubeList.card_id == DeckList.card_id).filter(CubeList.cube_id == cube.id,
-                             CubeList.uid == uid).first()
-        if result is not None:
-            cubelist, decklist = result
-            if decklist.note:
-                # TODO: envoyer la note en mp aux joueurs
-                context.bot.send_message(chat_id=config.chat_id,
-                                         text=decklist.note)
-                if not cubelist.signature:
-                    sleep(3)
-            if cubelist.signature:
-                s = os.path.join(config.src_dir, "resources", "sounds", cubelist.signature)
-                play_sound(s)
+        record = uid_resolver.resolve(cube_id, uid)
+        if record is None:
+            continue
+        with session_scope() as s:
+            result = s.query(DeckList.note).filter(DeckList.card_id == record.card_id).first()
+        if result is None:
+            continue
+        note, signature = result.note, record.signature
+        if note:
+            # TODO: envoyer la note en mp aux joueurs
+            context.bot.send_message(chat_id=config.chat_id,
+                                     text=note)
+        if signature:
+            s = os.path.join(config.src_dir, "resources", "sounds", signature)
+            play_sound(s)
 
 def audio_scan_test(cube):
-    pn532 = PN532_SPI(debug=False, reset=20, cs=4)
+    pn532 = get_pn532(emulated_uids=uid_resolver.tagged_uids)
     pn532.SAM_configuration()
+    cube_id = cube.id
     loop = True
     logging.info("audio scan ready")
     while loop:
@@ -51,30 +65,157 @@ def audio_scan_test(cube):
         # Try again if no card is available.
         if uid is None:
             continue
-        cubelist = None
-        session.commit() # update the session in case db changed
-        result = session.query(CubeList).filter(CubeList.cube_id == cube.id, CubeList.uid == uid).first()
-        if result is not None:
-            cubelist = result
-            cardname = session.query(Card).filter(Card.id == cubelist.card_id).first()
-            print(cubelist.signature, cardname.name)
-            if cubelist.signature:
-                s = os.path.join(config.src_dir, "resources", "sounds", cubelist.signature)
-                play_sound(s)
-
-def play_sound(sound, wait_until_done=True):
-    """Play various type of sound based on vlc media player
+        record = uid_resolver.resolve(cube_id, uid)
+        if record is not None:
+            print(record.signature, record.name)
+        if record and record.signature:
+            s = os.path.join(config.src_dir, "resources", "sounds", record.signature)
+            play_sound(s)
+
+class AudioEngine:
+    """One long lived vlc instance with a pool of players and preloaded media.
+    Sounds play in background, the end of a sound is signaled by vlc events.
+    Sounds asked while every player is busy wait in a bounded queue, the oldest
+    waiting sound is dropped when it is full."""
+
+    pool_size = 2
+    queue_size = 4
+
+    def __init__(self, pool_size=None, queue_size=None):
+        self.instance = Instance("--quiet") # --quiet to avoid vlcpulse error
+        self.media = {}
+        self.idle = []
+        self.playing = {}   # player: done event
+        self.pending = deque()
+        self.lock = threading.Lock()
+        self.queue_size = queue_size or self.queue_size
+        # vlc forbids calling libvlc from its event callbacks, ends are handled on another thread
+        self.ended = queue.Queue()
+        for i in range(pool_size or self.pool_size):
+            player = self.instance.media_player_new()
+            events = player.event_manager()
+            events.event_attach(EventType.MediaPlayerEndReached, self.on_end, player)
+            events.event_attach(EventType.MediaPlayerEncounteredError, self.on_end, player)
+            self.idle.append(player)
+        # Counters
+        self.played = 0
+        self.dropped = 0
+        self.interrupted = 0
+        threading.Thread(target=self.end_loop, name="audio-engine", daemon=True).start()
+
+    def load(self, sound):
+        """Return the vlc media of a sound file, parsed once"""
+        with self.lock:
+            media = self.media.get(sound, None)
+        if media is None:
+            if not os.path.exists(sound):
+                raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), sound)
+            media = self.instance.media_new(sound)
+            media.parse()
+            with self.lock:
+                media = self.media.setdefault(sound, media)
+        return media
+
+    def preload(self, sounds):
+        """Load sound files in advance, missing files are skipped"""
+        for sound in sounds:
+            try:
+                self.load(sound)
+            except FileNotFoundError:
+                logging.info(f"Sound file not found: {sound}")
+
+    def play(self, sound, interrupt=False):
+        """Play a sound file or media without blocking. interrupt stops the sounds playing
+        and waiting. Return a threading.Event set when the sound ended or was dropped"""
+        media = self.load(sound) if isinstance(sound, str) else sound
+        done = threading.Event()
+        with self.lock:
+            if interrupt:
+                self.stop_all()
+            if self.idle:
+                self.start(self.idle.pop(), media, done)
+            else:
+                if len(self.pending) >= self.queue_size:
+                    media_dropped, done_dropped = self.pending.popleft()
+                    done_dropped.set()
+                    self.dropped += 1
+                self.pending.append((media, done))
+        return done
+
+    def start(self, player, media, done):
+        player.set_media(media)
+        self.playing[player] = done
+        self.played += 1
+        player.play()
+
+    def stop_all(self):
+        """Stop sounds playing and waiting, lock must be held"""
+        for player, done in self.playing.items():
+            player.stop()
+            done.set()
+            self.idle.append(player)
+            self.interrupted += 1
+        self.playing = {}
+        for media, done in self.pending:
+            done.set()
+            self.dropped += 1
+        self.pending.clear()
+
+    def stop(self):
+        with self.lock:
+            self.stop_all()
+
+    def on_end(self, event, player):
+        """vlc event callback"""
+        self.ended.put(player)
+
+    def end_loop(self):
+        while True:
+            player = self.ended.get()
+            with self.lock:
+                done = self.playing.get(player, None)
+                if done is None or player.get_state() not in (State.Ended, State.Error):
+                    # Player was stopped, maybe restarted, since this event
+                    continue
+                del self.playing[player]
+                done.set()
+                if self.pending:
+                    media, done = self.pending.popleft()
+                    self.start(player, media, done)
+                else:
+                    self.idle.append(player)
+
+    def stats(self):
+        with self.lock:
+            return {"played": self.played,
+                    "dropped": self.dropped,
+                    "interrupted": self.interrupted,
+                    "playing": len(self.playing),
+                    "pending": len(self.pending),
+                    "media": len(self.media)}
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+def get_engine():
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = AudioEngine()
+        return _engine
+
+def load_sound(sound):
+    """Return a vlc media parsed in advance, to be played later with play_sound"""
+    return get_engine().load(sound)
+
+def play_sound(sound, wait_until_done=True, interrupt=False):
+    """Play various type of sound based on vlc media player, sound is a path or a media from load_sound
     Doc: https://www.olivieraubert.net/vlc/python-ctypes/doc/"""
-    if not os.path.exists(sound):
-        raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), sound)
-    vlc = Instance("--quiet") # --quiet to avoid vlcpulse error
-    player = vlc.media_player_new()
-    media = vlc.media_new(sound)
-    player.set_media(media)
-    player.play()
-    while wait_until_done and player.get_state() != State.Ended:
-        continue
-    return
+    done = get_engine().play(sound, interrupt=interrupt)
+    if wait_until_done:
+        done.wait()
+    return done
 
 if __name__ == "__main__":
     cube = session.query(Cube).first()
@@ -0,0 +1,201 @@
+import sys
+import logging
+import random
+from array import array
+from collections import Counter
+from time import perf_counter
+from sqlalchemy import not_
+from model import session_scope, card_infos, Card, CubeList, Draft, Booster
+
+"""Booster generation driven by per cube profiles"""
+
+
+class Pool:
+    """Cards of a cube matching SQL criteria (basic lands excluded), plus cards of the cube given by name"""
+
+    def __init__(self, cube_id, *criteria, names=()):
+        self.cube_id = cube_id
+        self.criteria = criteria
+        self.names = names
+
+    def load(self):
+        """Return card ids and names of the pool in compact arrays"""
+        with session_scope() as s:
+            q = s.query(Card.id, Card.name).join(CubeList).filter(CubeList.cube_id == self.cube_id,
+                                                                Card.type_line != "Basic Land",
+                                                                *self.criteria)
+            rows = q.all()
+            for name in self.names:
+                row = s.query(Card.id, Card.name).join(CubeList).filter(CubeList.cube_id == self.cube_id,
+                                                                        Card.name == name).first()
+                if row:
+                    rows.append(row)
+        return CardArray([row[0] for row in rows], [row[1] for row in rows])
+
+    def __repr__(self):
+        return f"<Pool(cube_id={self.cube_id}, criteria={len(self.criteria)}, names={len(self.names)})>"
+
+
+class CardArray:
+
+    def __init__(self, ids, names):
+        self.ids = array("i", ids)
+        self.names = names
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class Boosters:
+    """`count` boosters per drafter, each one made of slots: (pool name, number of cards)"""
+
+    def __init__(self, count, slots):
+        self.count = count
+        self.slots = slots
+
+    @property
+    def size(self):
+        return sum(n for pool, n in self.slots)
+
+
+class Profile:
+    """Declarative booster configuration of a cube.
+    Boosters are given to the draft in order, so the last ones are opened first.
+    booster_size and round_num are set on the draft when given.
+    extra_cards are card names added to the pool of every drafter.
+    remaining is the pool name whose unused cards are listed at the start of the draft."""
+
+    def __init__(self, pools, boosters, booster_size=None, round_num=None, extra_cards=(), remaining=None):
+        self.pools = pools
+        self.boosters = boosters
+        self.booster_size = booster_size
+        self.round_num = round_num
+        self.extra_cards = extra_cards
+        self.remaining = remaining
+
+
+def standard_profile(cube_id):
+    return Profile(pools={"main": Pool(cube_id, Card.tags != "Draft")},
+                   boosters=[Boosters(5, [("main", 9)])],
+                   booster_size=9,
+                   round_num=5,
+                   remaining="main")
+
+
+PROFILES = {1: standard_profile(1),
+            5: standard_profile(5),
+            # Greg Cube Draft: main boosters from cube 4 and a booster of commanders from cube 3
+            4: Profile(pools={"main": Pool(4),
+                              "commanders": Pool(3, not_(Card.tags.contains("partnerWith")),
+                                                 names=[p["name"] for p in Draft.partners])},
+                       boosters=[Boosters(5, [("main", 12)]),
+                                 Boosters(1, [("commanders", 6)])],
+                       extra_cards=["Command Tower"],
+                       remaining="main")}
+
+
+class BoosterEngine:
+    """Generate boosters of a profile from pools loaded once"""
+
+    def __init__(self, profile, pools=None):
+        self.profile = profile
+        self.pools = pools or {name: pool.load() for name, pool in profile.pools.items()}
+
+    def needed(self, drafters):
+        """Number of cards needed per pool"""
+        counts = Counter()
+        for boosters in self.profile.boosters:
+            for pool, n in boosters.slots:
+                counts[pool] += n * boosters.count * drafters
+        return counts
+
+    def generate(self, drafters, seed=None):
+        """Return a list of boosters as lists of card ids and a dict of unused card ids by pool.
+        Every pool is drawn from a single permutation of the seeded generator"""
+        rng = random.Random(seed)
+        for pool, n in self.needed(drafters).items():
+            if n > len(self.pools[pool]):
+                raise ValueError(f"Not enough cards in pool {pool}: {len(self.pools[pool])} for {n} needed")
+        permutations = {}
+        for name, pool in self.pools.items():
+            permutation = pool.ids.tolist()
+            rng.shuffle(permutation)
+            permutations[name] = permutation
+        positions = dict.fromkeys(self.pools, 0)
+        boosters = []
+        for spec in self.profile.boosters:
+            for drafter in range(drafters):
+                for i in range(spec.count):
+                    cards = []
+                    for pool, n in spec.slots:
+                        start = positions[pool]
+                        cards += permutations[pool][start:start+n]
+                        positions[pool] = start + n
+                    boosters.append(cards)
+        remaining = {name: permutation[positions[name]:] for name, permutation in permutations.items()}
+        return boosters, remaining
+
+    def apply(self, draft, seed=None):
+        """Set boosters of a draft, return the list of remaining card names.
+        Cards of boosters and pools are CardInfo"""
+        boosters, remaining = self.generate(len(draft.drafters), seed=seed)
+        ids = {card_id for booster in boosters for card_id in booster}
+        with session_scope() as s:
+            cards = {card.id: card for card in card_infos(s.query(Card).filter(Card.id.in_(ids)))}
+            extra_cards = [card for name in self.profile.extra_cards
+                           for card in card_infos(s.query(Card).filter(Card.name == name).limit(1))]
+        draft.boosters = [Booster(id=n, cards=[cards[card_id] for card_id in booster])
+                          for n, booster in enumerate(boosters)]
+        if self.profile.booster_size:
+            draft.booster_size = self.profile.booster_size
+        if self.profile.round_num:
+            draft.round_num = self.profile.round_num
+        for card in extra_cards:
+            for drafter in draft.drafters:
+                drafter.pool.append(card)
+        if not self.profile.remaining:
+            return []
+        pool = self.pools[self.profile.remaining]
+        names = dict(zip(pool.ids, pool.names))
+        return [names[card_id] for card_id in remaining[self.profile.remaining]]
+
+
+def set_boosters(draft, seed=None):
+    """Set boosters of a draft from the profile of its cube.
+    Return the content and the filename of the remaining cards file"""
+    profile = PROFILES.get(draft.cube_id, None)
+    if not profile:
+        logging.info("No specific configuration for this cube")
+        return None, None
+    engine = BoosterEngine(profile)
+    remaining = engine.apply(draft, seed=seed)
+    logging.info(f"{len(draft.boosters)} boosters generated, {len(remaining)} cards remaining.")
+    return "".join(f"{name}\n" for name in remaining), "Cartes restantes.txt"
+
+
+def chi_square(counts, expected, cards=360):
+    return sum((counts[i] - expected) ** 2 / expected for i in range(cards))
+
+
+if __name__ == "__main__":
+    # Benchmark and fairness audit on a synthetic 360 cards pool
+    # Usage: python boosters.py [number of drafts] [drafters]
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    drafters = int(sys.argv[2]) if len(sys.argv) > 2 else 6
+    pools = {"main": CardArray(range(360), [f"Card {i}" for i in range(360)])}
+    engine = BoosterEngine(PROFILES[1], pools=pools)
+    start = perf_counter()
+    first_picks = Counter()
+    drafted = Counter()
+    for seed in range(n):
+        boosters, remaining = engine.generate(drafters, seed=seed)
+        first_picks.update(booster[0] for booster in boosters)
+        drafted.update(card_id for booster in boosters for card_id in booster)
+    elapsed = perf_counter() - start
+    print(f"{n} drafts of {drafters} drafters in {elapsed:.2f}s: {n/elapsed:.0f} drafts/s")
+    expected = n * drafters * 5 * 9 / 360
+    print(f"Card drafted: expected {expected:.0f}, min {min(drafted.values())}, max {max(drafted.values())}")
+    print(f"Chi-square over 359 degrees of freedom: {chi_square(drafted, expected):.1f}")
+    expected = n * drafters * 5 / 360
+    print(f"First slot: expected {expected:.0f}, min {min(first_picks.values())}, max {max(first_picks.values())}")
+    print(f"Chi-square over 359 degrees of freedom: {chi_square(first_picks, expected):.1f}")
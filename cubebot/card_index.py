@@ -0,0 +1,155 @@
+import re
+import logging
+import threading
+import unicodedata
+from bisect import bisect_left
+from collections import Counter
+from time import time
+from model import session_scope, Card, CubeList
+
+
+def normalize(name):
+    """Lower case, remove accents and extra spaces"""
+    name = unicodedata.normalize("NFKD", name.strip().lower()).replace("æ", "ae")
+    name = "".join(c for c in name if not unicodedata.combining(c))
+    return re.sub(r"\s+", " ", name)
+
+
+def trigrams(name):
+    name = f"  {name} "
+    return {name[i:i+3] for i in range(len(name) - 2)}
+
+
+class Candidate:
+
+    def __init__(self, name, card_ids, score):
+        self.name = name
+        self.card_ids = card_ids
+        self.score = score
+
+    @property
+    def card_id(self):
+        return self.card_ids[0]
+
+    def __repr__(self):
+        return f"<Candidate(name={self.name}, card_ids={self.card_ids}, score={self.score:.2f})>"
+
+
+class CardNameIndex:
+    """In memory index of card names.
+    Prefix lookup uses a sorted array of names (and face names), typo tolerant lookup uses trigrams."""
+
+    fuzzy_threshold = 0.3
+
+    def __init__(self, cards):
+        """cards: iterable of (card_id, name)"""
+        self.names = {}     # card name: list of card ids
+        keys = {}           # normalized name or face name: card name
+        for card_id, name in cards:
+            if not name: continue
+            self.names.setdefault(name, []).append(card_id)
+            keys[normalize(name)] = name
+            if " // " in name:
+                for face in name.split(" // "):
+                    keys.setdefault(normalize(face), name)
+        self.keys = sorted(keys)
+        self.values = [keys[key] for key in self.keys]
+        self.trigrams = {}
+        self.sizes = []
+        for i, key in enumerate(self.keys):
+            key_trigrams = trigrams(key)
+            self.sizes.append(len(key_trigrams))
+            for trigram in key_trigrams:
+                self.trigrams.setdefault(trigram, []).append(i)
+
+    def candidate(self, i, score):
+        name = self.values[i]
+        return Candidate(name, self.names[name], score)
+
+    def prefix(self, text):
+        """Return indexes of keys starting with text"""
+        i = bisect_left(self.keys, text)
+        matches = []
+        while i < len(self.keys) and self.keys[i].startswith(text):
+            matches.append(i)
+            i += 1
+        return matches
+
+    def fuzzy(self, text, limit):
+        """Return (score, index) of keys sharing the most trigrams with text"""
+        query = trigrams(text)
+        counts = Counter(i for trigram in query for i in self.trigrams.get(trigram, []))
+        scores = []
+        for i, shared in counts.items():
+            score = shared / (len(query) + self.sizes[i] - shared)
+            if score >= self.fuzzy_threshold:
+                scores.append((score, i))
+        scores.sort(key=lambda s: (-s[0], self.keys[s[1]]))
+        return scores[:limit]
+
+    def lookup(self, text, limit=10):
+        """Return a ranked list of Candidate: exact match, then prefix matches, then close names"""
+        text = normalize(text)
+        if not text:
+            return []
+        results, seen = [], set()
+
+        def add(i, score):
+            if self.values[i] not in seen and (limit is None or len(results) < limit):
+                seen.add(self.values[i])
+                results.append(self.candidate(i, score))
+
+        matches = self.prefix(text)
+        # Shortest names first so exact match comes first
+        for i in sorted(matches, key=lambda i: len(self.keys[i])):
+            add(i, 1.0 if self.keys[i] == text else 0.9)
+        if not results:
+            for score, i in self.fuzzy(text, limit):
+                add(i, score)
+        return results
+
+    def resolve(self, text):
+        """Return a list of Candidate, a single one if text designates a card without ambiguity"""
+        candidates = self.lookup(text)
+        if not candidates:
+            return []
+        best = candidates[0]
+        if best.score == 1.0 or len(candidates) == 1:
+            return [best]
+        if best.score < 0.9 and best.score - candidates[1].score >= 0.1:
+            # Typo with a clear best match
+            return [best]
+        return candidates
+
+    def __len__(self):
+        return len(self.names)
+
+    def __repr__(self):
+        return f"<CardNameIndex(cards={len(self.names)}, keys={len(self.keys)})>"
+
+
+_indexes = {}
+_lock = threading.Lock()
+
+
+def get_index(cube_id):
+    """Return name index of a cube, build it if needed"""
+    with _lock:
+        index = _indexes.get(cube_id, None)
+        if index is None:
+            start = time()
+            with session_scope() as s:
+                cards = s.query(Card.id, Card.name).join(CubeList).filter(CubeList.cube_id == cube_id).all()
+            index = CardNameIndex(cards)
+            _indexes[cube_id] = index
+            logging.info(f"Card name index built for cube {cube_id}: {index} in {time()-start:.3f}s")
+        return index
+
+
+def invalidate(cube_id=None):
+    """Drop name index of a cube (or all indexes) to rebuild it on next lookup"""
+    with _lock:
+        if cube_id is None:
+            _indexes.clear()
+        else:
+            _indexes.pop(cube_id, None)
@@ -0,0 +1,191 @@
+import os
+import re
+import sys
+import json
+import sqlite3
+import logging
+import threading
+import config
+import scryfall
+from time import time
+
+"""Local card catalog built from scryfall bulk data: https://scryfall.com/docs/api/bulk-data"""
+
+# Card fields kept in the catalog, the rest of the bulk data is dropped
+CARD_FIELDS = ["object", "id", "name", "set", "uri", "layout", "image_uris",
+               "card_faces", "all_parts", "color_identity", "power", "toughness"]
+FACE_FIELDS = ["name", "image_uris", "power", "toughness"]
+
+_SEPARATORS = re.compile(r"[\s,]*")
+
+
+def iter_json_array(f, chunk_size=1024*1024):
+    """Yield objects of a json array file one by one without loading the whole file"""
+    decoder = json.JSONDecoder()
+    buffer, pos, started = "", 0, False
+    while True:
+        pos = _SEPARATORS.match(buffer, pos).end()
+        if pos == len(buffer) or (started and buffer[pos] != "]"):
+            # Make sure next object is fully loaded before decoding it
+            try:
+                obj, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    if pos == len(buffer) and not started:
+                        return
+                    raise ValueError("Unexpected end of json array")
+                buffer = buffer[pos:] + chunk
+                pos = 0
+                continue
+            pos = end
+            yield obj
+        elif not started:
+            if buffer[pos] != "[":
+                raise ValueError("Bulk data file is not a json array")
+            started = True
+            pos += 1
+        else:
+            # End of array
+            return
+
+
+def compact(card):
+    """Keep only the fields of a card object used by the bot"""
+    c = {key: card[key] for key in CARD_FIELDS if key in card}
+    if "card_faces" in c:
+        c["card_faces"] = [{key: face[key] for key in FACE_FIELDS if key in face}
+                           for face in c["card_faces"]]
+    if "all_parts" in c:
+        c["all_parts"] = [{"id": part["id"], "component": part["component"]}
+                          for part in c["all_parts"]]
+    return c
+
+
+class Catalog:
+    """Cards indexed by scryfall id, name, face names and set code in a SQLite file"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = None
+
+    def connect(self):
+        if self.db is None:
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+        return self.db
+
+    @property
+    def is_available(self):
+        if not os.path.exists(self.path):
+            return False
+        with self.lock:
+            row = self.connect().execute("SELECT name FROM sqlite_master "
+                                         "WHERE type='table' AND name='card'").fetchone()
+        return row is not None
+
+    def build(self, bulk_file, batch_size=2000):
+        """Ingest a scryfall bulk data json file, replacing current catalog"""
+        start = time()
+        count = 0
+        with self.lock, open(bulk_file, "r", encoding="utf-8") as f:
+            db = self.connect()
+            db.execute("DROP TABLE IF EXISTS card")
+            db.execute("DROP TABLE IF EXISTS face_name")
+            db.execute("CREATE TABLE card (id TEXT PRIMARY KEY, name TEXT, name_lower TEXT, "
+                       "set_code TEXT, data TEXT)")
+            db.execute("CREATE TABLE face_name (name_lower TEXT, card_id TEXT)")
+            cards, faces = [], []
+            for card in iter_json_array(f):
+                if card.get("object", None) != "card":
+                    continue
+                c = compact(card)
+                cards.append((c["id"], c["name"], c["name"].lower(), c.get("set", None),
+                              json.dumps(c, separators=(",", ":"))))
+                for face in c.get("card_faces", []):
+                    if face.get("name", None) and face["name"] != c["name"]:
+                        faces.append((face["name"].lower(), c["id"]))
+                if len(cards) >= batch_size:
+                    count += self._insert(db, cards, faces)
+                    cards, faces = [], []
+            count += self._insert(db, cards, faces)
+            db.execute("CREATE INDEX ix_card_name_lower ON card (name_lower, set_code)")
+            db.execute("CREATE INDEX ix_card_set_code ON card (set_code)")
+            db.execute("CREATE INDEX ix_face_name_lower ON face_name (name_lower)")
+            db.commit()
+        logging.info(f"Catalog built with {count} cards in {time()-start:.1f}s")
+        return count
+
+    @staticmethod
+    def _insert(db, cards, faces):
+        db.executemany("INSERT OR REPLACE INTO card VALUES (?, ?, ?, ?, ?)", cards)
+        db.executemany("INSERT INTO face_name VALUES (?, ?)", faces)
+        return len(cards)
+
+    def get_card_by_id(self, scryfall_id):
+        return self.get_cards_by_id([scryfall_id]).get(scryfall_id, None)
+
+    def get_cards_by_id(self, scryfall_ids):
+        """Return a dict of card objects by scryfall id"""
+        scryfall_ids = list(scryfall_ids)
+        cards = {}
+        with self.lock:
+            db = self.connect()
+            # Stay under SQLite max number of variables
+            for i in range(0, len(scryfall_ids), 500):
+                batch = scryfall_ids[i:i+500]
+                rows = db.execute(f"SELECT data FROM card WHERE id IN ({','.join('?'*len(batch))})", batch)
+                for data, in rows:
+                    card = json.loads(data)
+                    cards[card["id"]] = card
+        return cards
+
+    def get_card_by_name(self, name, set_code=None):
+        """Return a card object from its full or face name, printed in set_code if possible"""
+        name = name.lower()
+        with self.lock:
+            rows = self.connect().execute("SELECT data, set_code FROM card WHERE name_lower = ? "
+                                          "UNION ALL "
+                                          "SELECT card.data, card.set_code FROM face_name "
+                                          "JOIN card ON card.id = face_name.card_id "
+                                          "WHERE face_name.name_lower = ?", (name, name)).fetchall()
+        if not rows:
+            return None
+        data = next((data for data, s in rows if set_code and s == set_code.lower()), rows[0][0])
+        return json.loads(data)
+
+    def get_cards_by_name(self, names):
+        """Return a list of card objects matching a list of (name, set_code) tuples.
+        A card which can't be found is returned as None"""
+        return [self.get_card_by_name(name, set_code) for name, set_code in names]
+
+    def __repr__(self):
+        return f"<Catalog(path={self.path})>"
+
+
+def download_bulk_data(path, bulk_type="default_cards"):
+    """Download scryfall bulk data file to path"""
+    bulk = scryfall.get_bulk_data(bulk_type)
+    if not bulk:
+        return False
+    logging.info(f"Download {bulk['download_uri']} ({bulk.get('size', '?')} bytes)")
+    with scryfall.http_session.get(bulk["download_uri"], stream=True) as r:
+        r.raise_for_status()
+        with open(path, "wb") as f:
+            for chunk in r.iter_content(chunk_size=1024*1024):
+                f.write(chunk)
+    return path
+
+
+catalog = Catalog(getattr(config, "catalog_db", os.path.join(config.src_dir, "db", "catalog.db")))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                        level=config.log_level)
+    # Usage: python catalog.py [bulk_file.json]
+    if len(sys.argv) > 1:
+        bulk_file = sys.argv[1]
+    else:
+        bulk_file = download_bulk_data(os.path.join(config.src_dir, "db", "default-cards.json"))
+    catalog.build(bulk_file)
@@ -1,20 +1,21 @@
-import os
 import logging
 import config
-import requests
 import audio
+import signature
+import outbox
 import utils
+import card_index
+import uid_resolver
+import scan_actions
 import deckstat_interface as deckstat
 from nfc_scanner import NFC_Scanner
-from time import sleep
 from random import shuffle
 from filters import restrict, UserType, SignConv, WinConv, GameStates, SealedConv
-from model import session, Cube, CubeList, Game, Player, Card, Deck, DeckList
+from model import session_scope, Cube, CubeList, Game, Player, Card, Deck
 from deckHandler import DeckHandler
 from draftHandler import DraftHandler
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, MessageEntity, ReplyKeyboardRemove
 from telegram.ext import Filters, CommandHandler, ConversationHandler, MessageHandler, CallbackQueryHandler
-from telegram.ext.dispatcher import run_async
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy import create_engine
 
@@ -22,25 +23,24 @@ class CubeHandler():
 
     def __init__(self, dispatcher):
 
-        # Update cube based on cubecobra
-        # update_count = utils.update_cube(self.cube)
-        # context.bot.send_message(chat_id=config.chat_id,
-                                 # text=f"{update_count} mise(s) à jour effectuée(s).")
         # Create handlers
-        self.nfc_scan = NFC_Scanner()
+        self.nfc_scan = NFC_Scanner(emulated_uids=uid_resolver.tagged_uids)
         self.join_handler = CommandHandler("start", self.join)
         dispatcher.add_handler(self.join_handler)
         self.new_game_handler = CommandHandler("init", self.new_game)
         dispatcher.add_handler(self.new_game_handler)
         self.rematch_handler = CommandHandler("rematch", self.rematch)
         dispatcher.add_handler(self.rematch_handler)
+        # Update cube based on cubecobra
+        self.update_cube_handler = CommandHandler("update", self.update_cube)
+        dispatcher.add_handler(self.update_cube_handler)
         self.play_game_handler = CommandHandler("play", self.play_game)
         self.deckHandler = None
         self.win_handler = self.get_win_convHandler()
         self.sign_handler = self.get_sign_handler()
         dispatcher.add_handler(self.sign_handler)
-        # model
-        self.cube, self.game = None, None
+        # model, ids only: each handler works in a session of its own
+        self.cube_id, self.game_id, self.game_state = None, None, None
         self.draftHandler = DraftHandler(dispatcher)
 
     @restrict(UserType.ADMIN)
@@ -49,24 +49,23 @@ class CubeHandler():
         context.dispatcher.remove_handler(self.new_game_handler)
         context.dispatcher.remove_handler(self.sign_handler)
         context.dispatcher.remove_handler(self.rematch_handler)
-        # Create SQL Object
-        self.cube = session.query(Cube).first()
-        # Update cube based on cubecobra
-        # update_count = utils.update_cube(self.cube)
-        # Create new game
-        self.game = Game(state=GameStates.INIT.name)
-        self.cube.games.append(self.game)
-        session.commit()
+        with session_scope() as s:
+            cube = s.query(Cube).first()
+            # Create new game
+            game = Game(state=GameStates.INIT.name)
+            cube.games.append(game)
+            s.flush()
+            self.cube_id, self.game_id, self.game_state = cube.id, game.id, game.state
         logging.info("New game created")
         # Enable deck handlers
-        self.deckHandler = DeckHandler(context.dispatcher, self.game, self.nfc_scan)
+        self.deckHandler = DeckHandler(context.dispatcher, self.game_id, self.cube_id, self.nfc_scan)
         # Next state is now available for admin
         context.dispatcher.add_handler(self.play_game_handler)
         # Send ok message
         text = "Les joueurs peuvent commencer à scanner leur deck en tapant /scan."
         context.bot.send_message(chat_id=config.chat_id,
-                                 text=text)
-        sleep(0.5)
+                                 text=text,
+                                 priority=outbox.NOTIFICATION)
         context.bot.send_message(chat_id=config.admin_id,
                                  text="Pour lancer la partie: /play [mode]")
     
@@ -76,38 +75,58 @@ class CubeHandler():
         context.dispatcher.remove_handler(self.new_game_handler)
         context.dispatcher.remove_handler(self.sign_handler)
         context.dispatcher.remove_handler(self.rematch_handler)
-        # Create SQL Object
-        self.cube = session.query(Cube).first()
-        # Update cube based on cubecobra
-        # update_count = utils.update_cube(self.cube)
-        # Create new game
-        last_game = session.query(Game).order_by(Game.id.desc()).first()
-        self.game = Game(state=GameStates.INIT.name)
-        for deck in last_game.decks:
-            d = Deck(player=deck.player, name=deck.name, description=deck.description)
-            for deck_card in deck.cards:
-                DeckList(deck=d, card=deck_card.card, amount=deck_card.amount, note=deck_card.note)
-            self.game.decks.append(d)
-        
-        self.cube.games.append(self.game)
-        session.commit()
-        logging.info(f"New game created from game [{last_game}]")
+        with session_scope() as s:
+            cube = s.query(Cube).first()
+            # Create new game
+            last_game = s.query(Game).order_by(Game.id.desc()).first()
+            game = Game(state=GameStates.INIT.name)
+            cube.games.append(game)
+            s.flush()
+            for deck in last_game.decks:
+                s.add(deck.copy(game.id))
+            self.cube_id, self.game_id, self.game_state = cube.id, game.id, game.state
+            logging.info(f"New game created from game [{last_game}]")
         # Enable deck handlers
-        self.deckHandler = DeckHandler(context.dispatcher, self.game, self.nfc_scan)
+        self.deckHandler = DeckHandler(context.dispatcher, self.game_id, self.cube_id, self.nfc_scan)
         # Next state is now available for admin
         context.dispatcher.add_handler(self.play_game_handler)
         # Send ok message
         text = "Les joueurs peuvent visualiser et éditer leur ancien deck avec la commande: /mydeck."
         context.bot.send_message(chat_id=config.chat_id,
-                                 text=text)
-        sleep(0.5)
+                                 text=text,
+                                 priority=outbox.NOTIFICATION)
         context.bot.send_message(chat_id=config.admin_id,
                                  text="Pour lancer la partie: /play [mode]")
     
     @restrict(UserType.ADMIN)
-    @run_async
+    def update_cube(self, update, context):
+        """/update
+        Synchronize the cube with its cubecobra list, in background"""
+        if self.game_id and self.game_state != GameStates.END.name:
+            text = "Une partie est en cours, mets le cube à jour après la partie."
+            context.bot.send_message(chat_id=update.effective_chat.id, text=text)
+            return False
+        with session_scope() as s:
+            cube_id = s.query(Cube.id).first()[0]
+        context.bot.send_message(chat_id=update.effective_chat.id, text="Mise à jour du cube...")
+        context.dispatcher.run_async(self.sync_cube, context, update.effective_chat.id, cube_id)
+
+    @staticmethod
+    def sync_cube(context, chat_id, cube_id):
+        """Runs on a dispatcher worker thread, in a session of its own"""
+        try:
+            with session_scope() as s:
+                cube = s.query(Cube).filter(Cube.id == cube_id).one()
+                result = utils.sync_cube(cube)
+            text = f"Cube mis à jour: {result['added']} ajout(s), {result['removed']} retrait(s), "\
+                   f"{result['swapped']} échange(s)."
+        except Exception as e:
+            logging.exception(e)
+            text = "La mise à jour du cube a échoué."
+        context.bot.send_message(chat_id=chat_id, text=text)
+
+    @restrict(UserType.ADMIN)
     def play_game(self, update, context):
-        self.game.state = GameStates.PLAY.name
         # Control if game has players ?
         # Remove entry point to only have one game at time
         if not self.deckHandler.stop_deck_preparation(context):
@@ -116,10 +135,13 @@ class CubeHandler():
                                      text=text)
             return False
 
-        if context.args:
-            # Add a specific game type instead of default Free for All
-            self.game.type = " ".join(context.args)
-            session.commit()
+        self.game_state = GameStates.PLAY.name
+        with session_scope() as s:
+            game = s.query(Game).filter(Game.id == self.game_id).one()
+            game.state = self.game_state
+            if context.args:
+                # Add a specific game type instead of default Free for All
+                game.mode = " ".join(context.args)
         
         context.dispatcher.remove_handler(self.join_handler)
         context.dispatcher.remove_handler(self.new_game_handler)
@@ -128,43 +150,45 @@ class CubeHandler():
         
         logging.info("Game start")
         text = "La partie peut commencer !"
-        context.bot.send_message(chat_id=config.chat_id, text=text)
-        sleep(0.5)
+        context.bot.send_message(chat_id=config.chat_id, text=text, priority=outbox.NOTIFICATION)
         context.bot.send_message(chat_id=config.admin_id,
                                  text="Pour terminer la partie: /win")
         
-        # Start nfc sanner
-        self.nfc_scan.start(self.game_scanner, context)
+        # Compile what to do for each tag of the game
+        scan_actions.get_table(self.game_id, self.cube_id)
+        # Start nfc sanner in background
+        self.nfc_scan.max_targets = 1
+        self.nfc_scan.start(self.game_scanner,
+                            context,
+                            game_id=self.game_id,
+                            cube_id=self.cube_id)
 
-    def game_scanner(self, uid, context):
-        cubelist, decklist = None, None
-        result = session.query(CubeList, DeckList).join(Deck).filter(CubeList.card_id == DeckList.card_id, Deck.game_id == self.game.id).filter(CubeList.cube_id == self.cube.id,
-                             CubeList.uid == uid).first()
-        print(result)
-        if result is not None:
-            cubelist, decklist = result
-            if decklist.note:
-                context.bot.send_message(chat_id=config.chat_id,
-                                         text=decklist.note)
-                if not cubelist.signature:
-                    sleep(3)
-            if cubelist.signature:
-                s = os.path.join(config.src_dir, "resources", "sounds", cubelist.signature)
-                audio.play_sound(s)
+    def game_scanner(self, uid, context, game_id, cube_id):
+        """NFC callback, runs on the scanner thread. A card left on the reader is
+        ignored by the scanner debounce, the callback never waits"""
+        action = scan_actions.get_table(game_id, cube_id).get(uid)
+        if action is None:
+            return
+        if action.note:
+            context.bot.send_message(chat_id=config.chat_id,
+                                     text=action.note)
+        if action.sound:
+            # Scanning goes on while the sound plays, a new sound cuts the previous one
+            audio.play_sound(action.media or action.sound, wait_until_done=False, interrupt=True)
 
     def join(self, update, context):
         # first interaction with the bot
         user = update.message.from_user
-        known_players_id = [id for id, in session.query(Player.id)]
-        if not user.id in known_players_id and context.args and context.args[0] == config.password:
-            new_player = Player(id=user.id, name=user.first_name)
-            session.add(new_player)
-            context.bot.send_message(chat_id=update.effective_chat.id,
+        with session_scope() as s:
+            known_players_id = [id for id, in s.query(Player.id)]
+            if not user.id in known_players_id and context.args and context.args[0] == config.password:
+                new_player = Player(id=user.id, name=user.first_name)
+                s.add(new_player)
+                logging.info(f"{new_player} has joined")
+            else:
+                return False
+        context.bot.send_message(chat_id=update.effective_chat.id,
                                  text=f"Bienvenue {user.first_name}!")
-            session.commit()
-            logging.info(f"{new_player} has joined")
-        else:
-            return False
 
     def get_sign_handler(self):
         
@@ -186,7 +210,8 @@ class CubeHandler():
 
     @restrict(UserType.PLAYER)
     def sign_card(self, update, context):
-        self.cube = session.query(Cube).first()
+        with session_scope() as s:
+            self.cube_id = s.query(Cube.id).first()[0]
         text = "Envoie moi le nom de la carte que tu souhaites signer.\n(/stop pour quitter)"
         update.message.reply_text(text)
         return SignConv.CHOOSING
@@ -194,29 +219,22 @@ class CubeHandler():
     def choose_card(self, update, context):
         answer = update.message.text
         # Search card in current cube list
-        c = session.query(CubeList).join(Card).filter(CubeList.cube_id == self.cube.id).filter(Card.name.like(f"{answer}%")).first()
+        candidates = card_index.get_index(self.cube_id).lookup(answer, limit=1)
+        c = None
+        if candidates:
+            with session_scope() as s:
+                c = s.query(CubeList.signature, Card.name, Card.id).join(Card)\
+                     .filter(CubeList.cube_id == self.cube_id, CubeList.card_id == candidates[0].card_id).first()
         avert = "Attention cette carte est déjà signée !\n"
         if c:
             if c.signature:
-                path = os.path.join(config.src_dir, "resources", "sounds", c.signature)
-                filename, file_extension = os.path.splitext(path)
-                audio_formats = [".mp3", ".m4a"]
-                voice_formats = [".ogg", ".oga"]
-                if file_extension in audio_formats:
-                    context.bot.sendAudio(chat_id=update.message.chat_id,
-                                          audio=open(path, 'rb'),
-                                          title=c.card.name,
-                                          performer="cubebot")
-                elif file_extension in voice_formats:
-                    context.bot.sendVoice(chat_id=update.message.chat_id,
-                                          voice=open(path, 'rb'),
-                                          caption=c.card.name)
-            text = f"{avert if c.signature  else ''}{c.card.name} - Est-ce bien ta carte ?"
+                signature.send(context.bot, update.message.chat_id, c.signature, c.name)
+            text = f"{avert if c.signature  else ''}{c.name} - Est-ce bien ta carte ?"
             keyboard = [[InlineKeyboardButton("Annuler", callback_data='0'),
                          InlineKeyboardButton("Retenter", callback_data='2')],
                         [InlineKeyboardButton("Oui", callback_data='1')]]
             markup = InlineKeyboardMarkup(keyboard)
-            context.user_data["sign_card_id"] = c.card.id
+            context.user_data["sign_card_id"] = c.id
             update.message.reply_text(text=text,
                                       reply_markup=markup)
             return SignConv.CONFIRM
@@ -244,53 +262,24 @@ class CubeHandler():
         
     def save_signature(self, update, context):
         card_id = context.user_data["sign_card_id"]
-        if update.message.audio:
-            file = context.bot.getFile(update.message.audio.file_id)
-            filename, file_extension = os.path.splitext(file.file_path)
-            dl_path = os.path.join(config.src_dir,"resources",
-                                   "sounds",f"{self.cube.id}_{card_id}{file_extension}")
-            file.download(dl_path)
-            logging.info(f"audio downloaded ({dl_path})")
-
-        elif update.message.voice:
-            file = context.bot.getFile(update.message.voice.file_id)
-            filename, file_extension = os.path.splitext(file.file_path)
-            dl_path = os.path.join(config.src_dir,"resources",
-                                   "sounds",f"{self.cube.id}_{card_id}{file_extension}")
-            file.download(dl_path)
-            logging.info(f"audio downloaded ({dl_path})")
-
-        elif update.message.entities:
-            url = update.message.parse_entity(update.message.entities[0])
-            filename, file_extension = os.path.splitext(url)
-            logging.info(f"Audio to download from url: {url}")
-            audio_formats = [".mp3", ".m4a", ".ogg"]
-            if file_extension in audio_formats: 
-                r = requests.get(url)
-                if r.ok:
-                    dl_path = os.path.join(config.src_dir,"resources",
-                                   "sounds",f"{self.cube.id}_{card_id}{file_extension}")
-                    with open(dl_path, 'wb') as f:
-                        f.write(r.content)
-                        logging.info(f"audio downloaded ({dl_path})")
-                else:
-                    text = f"Le serveur répond avec un code d'erreur {r.status_code}. Essaye avec un autre lien.\n(/stop pour quitter)"
-                    update.message.reply_text(text=text)
-                    return SignConv.SENDING
-            else:
-                text = f"Format audio inconnu. Essaye avec un autre lien avec l'un des formats suivant {audio_formats}.\n(/stop pour quitter)"
-                update.message.reply_text(text=text)
-                return SignConv.SENDING
+        try:
+            source = signature.download(update.message, context.bot)
+        except signature.DownloadError as e:
+            text = f"Le serveur répond avec un code d'erreur {e.status_code}. Essaye avec un autre lien.\n(/stop pour quitter)"
+            update.message.reply_text(text=text)
+            return SignConv.SENDING
+        except signature.UnknownFormat:
+            text = f"Format audio inconnu. Essaye avec un autre lien avec l'un des formats suivant {signature.URL_FORMATS}.\n(/stop pour quitter)"
+            update.message.reply_text(text=text)
+            return SignConv.SENDING
 
-        else:
+        if source is None:
             text = "Format audio inconnu. Essayes-en un autre.\n(/stop pour quitter)"
             update.message.reply_text(text=text)
             return SignConv.SENDING
-        
-        c = session.query(CubeList).filter(CubeList.card_id==card_id, CubeList.cube_id==self.cube.id).first()
-        c.signature = f"{self.cube.id}_{card_id}{file_extension}"
-        session.commit()
-        logging.info(f"{c} signed with {c.signature}")
+
+        # Sound is processed and saved in background
+        signature.ingest(source, self.cube_id, card_id)
         text = "J'ai bien récupéré ton fichier audio. Ta carte est desormais signée."
         update.message.reply_text(text=text)
         return ConversationHandler.END
@@ -307,12 +296,19 @@ class CubeHandler():
 
         return conv_handler
 
+    def get_players(self, ids=None):
+        """Return (id, name) of the players of the game, or of the given player ids"""
+        with session_scope() as s:
+            if ids is None:
+                return s.query(Player.id, Player.name).join(Deck).filter(Deck.game_id == self.game_id).all()
+            return s.query(Player.id, Player.name).filter(Player.id.in_(ids)).all()
+
     @restrict(UserType.ADMIN)
     def set_winner(self, update, context):
         text = "Qui est le vainqueur de cette partie ?"
         keyboard = []
-        for deck in self.game.decks:
-            keyboard.append([InlineKeyboardButton(deck.player.name, callback_data=deck.player.id)])
+        for player in self.get_players():
+            keyboard.append([InlineKeyboardButton(player.name, callback_data=player.id)])
         markup = InlineKeyboardMarkup(keyboard)
         context.user_data["winners"] = []
         update.message.reply_text(text=text,
@@ -322,11 +318,11 @@ class CubeHandler():
     def choose_winner(self, update, context):
         query = update.callback_query
         if query.data == "0":
-            for deck in self.game.decks:
-                if str(deck.player.id) in context.user_data["winners"]:
-                    deck.is_winner = True
-                    logging.info(f"{deck} set as winner")
-            session.commit()
+            with session_scope() as s:
+                for deck in s.query(Deck).filter(Deck.game_id == self.game_id):
+                    if str(deck.player_id) in context.user_data["winners"]:
+                        deck.is_winner = True
+                        logging.info(f"{deck} set as winner")
             text = "Ok ! Maintenant, envoie moi une description de la partie."
             query.edit_message_text(text=text)
             return WinConv.DESCRIPT
@@ -334,15 +330,15 @@ class CubeHandler():
         elif query.data == "X":
             del context.user_data["winners"][-1]
             keyboard = []
-            for deck in self.game.decks:
-                if not str(deck.player_id) in context.user_data["winners"]:
-                    keyboard.append([InlineKeyboardButton(deck.player.name, callback_data=deck.player_id)])
+            for player in self.get_players():
+                if not str(player.id) in context.user_data["winners"]:
+                    keyboard.append([InlineKeyboardButton(player.name, callback_data=player.id)])
             if len(context.user_data["winners"]) > 0:
                 keyboard.append([InlineKeyboardButton("Corriger", callback_data="X"),
                                  InlineKeyboardButton("Finir la partie", callback_data="0")])
             markup = InlineKeyboardMarkup(keyboard)
             text = "Qui est le vainqueur de cette partie ?\n"
-            winners = session.query(Player).filter(Player.id.in_(context.user_data["winners"])).all()
+            winners = self.get_players(context.user_data["winners"])
             for winner in winners:
                 text += f"\n<a href='tg://user?id={winner.id}'>{winner.name}</a>"
             query.edit_message_text(text=text,
@@ -353,14 +349,14 @@ class CubeHandler():
         else:
             context.user_data["winners"].append(query.data)
             keyboard = []
-            for deck in self.game.decks:
-                if not str(deck.player_id) in context.user_data["winners"]:
-                    keyboard.append([InlineKeyboardButton(deck.player.name, callback_data=deck.player_id)])
+            for player in self.get_players():
+                if not str(player.id) in context.user_data["winners"]:
+                    keyboard.append([InlineKeyboardButton(player.name, callback_data=player.id)])
             keyboard.append([InlineKeyboardButton("Corriger", callback_data="X"),
                              InlineKeyboardButton("Finir la partie", callback_data="0")])
             markup = InlineKeyboardMarkup(keyboard)
             text = "Qui est le vainqueur de cette partie ?"
-            winners = session.query(Player).filter(Player.id.in_(context.user_data["winners"])).all()
+            winners = self.get_players(context.user_data["winners"])
             for winner in winners:
                 text += f"\n<a href='tg://user?id={winner.id}'>{winner.name}</a>"
             query.edit_message_text(text=text,
@@ -369,21 +365,25 @@ class CubeHandler():
             return WinConv.CHOOSING
 
     def descript_game(self, update, context):
-        self.game.state = GameStates.END.name
+        self.game_state = GameStates.END.name
         answer = update.message.text
-        self.game.description = answer
-        session.commit()
+        with session_scope() as s:
+            game = s.query(Game).filter(Game.id == self.game_id).one()
+            game.state = self.game_state
+            game.description = answer
+            duration = game.duration
+            decks = [(deck.id, deck.player.name, deck.is_winner) for deck in game.decks]
         logging.info("Game description saved")
         medal_emoji = " \U0001F947"
-        text = f"Bien joué à tous, la partie est terminée.\n\n<u>Durée:</u> {self.game.duration}\n\n<u>Decks utilisés:</u>"
-        for deck in self.game.decks:
-            text += f"\n- <a href='{deck.deckstats}'>Deck de {deck.player.name}</a> {medal_emoji if deck.is_winner else ''}"
-        text += f"\n\n<u>Résumé :</u>\n<i>{self.game.description}</i>"
-        sleep(0.5)
+        text = f"Bien joué à tous, la partie est terminée.\n\n<u>Durée:</u> {duration}\n\n<u>Decks utilisés:</u>"
+        for deck_id, player_name, is_winner in decks:
+            text += f"\n- <a href='{self.deckHandler.deckstats.get(deck_id)}'>Deck de {player_name}</a> {medal_emoji if is_winner else ''}"
+        text += f"\n\n<u>Résumé :</u>\n<i>{answer}</i>"
         context.bot.send_message(chat_id=config.chat_id,
                                  text=text,
                                  parse_mode="HTML",
-                                 disable_web_page_preview=True)
+                                 disable_web_page_preview=True,
+                                 priority=outbox.NOTIFICATION)
         text = "Merci, la partie est bien enregistrée et terminée."\
                "\nPour en lancer une autre: /init"\
                "\nPour recommencer avec les mêmes decks et joueurs: /rematch"
@@ -392,6 +392,7 @@ class CubeHandler():
                                   disable_web_page_preview=True)
         # RESET all states to init
         self.nfc_scan.stop()
+        scan_actions.invalidate(self.game_id)
         context.job_queue.stop()
         context.dispatcher.remove_handler(self.win_handler)
         context.dispatcher.remove_handler(self.sign_handler)
@@ -1,34 +1,44 @@
 import re
-import os
 import logging
-import json
-import binascii
 import config
-import scryfall
-import requests
-from time import sleep
-from datetime import datetime
+import card_index
+import uid_resolver
+import scan_actions
+import signature
+import outbox
 import deckstat_interface as deckstat
 from filters import restrict, UserType, DeckConv, GameStates
-from model import session, Player, Deck, Card, CubeList, DeckList
+from model import session_scope, Game, Player, Deck, Card, CubeList, DeckList
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardRemove, MessageEntity
 from telegram.ext import CommandHandler, CallbackQueryHandler, ConversationHandler, MessageHandler, Filters
-from telegram.ext.dispatcher import run_async
-from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
 
 class DeckHandler:
     """ Chacun scan son deck l'un après l'autre
     Puis l'édition du deck peut se faire après
     """
 
-    def __init__(self, dispatcher, game, nfc_scan):
-        self.game = game
+    def __init__(self, dispatcher, game_id, cube_id, nfc_scan):
+        # Ids only, each handler loads what it needs in a session of its own
+        self.game_id = game_id
+        self.game_state = GameStates.INIT.name
         self.nfc_scan = nfc_scan
-        self.cubelist = session.query(CubeList).filter(CubeList.cube_id == game.cube.id,
-                                                       CubeList.uid != None).all()
+        self.cube_id = cube_id
+        # Build uid resolver now rather than on first scan
+        uid_resolver.get_resolver(self.cube_id)
+        # Deckstats url by deck id
+        self.deckstats = {}
 
+        # (id, name) of the player scanning and id of his deck, None until it is saved
         self.current_user = None
-        self.deck = None
+        self.deck_id = None
+        # Cards scanned by current user: (card id, card name), saved in deck on submit
+        self.scanned = []
+        self.scanned_ids = set()
+        # Lines of the scanned cards, built card after card
+        self.scanned_text = ""
+        # Edits of the scan message, at most one per interval
+        self.scan_message = None
+        self.edit_interval = getattr(config, "scan_edit_interval", outbox.EDIT_INTERVAL)
         
         # Handlers
         self.scan_handler = CommandHandler("scan", self.new_deck)
@@ -50,23 +60,33 @@ class DeckHandler:
         dispatcher.remove_handler(self.load_deckstats_handler)
         dispatcher.remove_handler(self.deck_conv_handler)
 
+    def get_deck(self, s, player_id):
+        """Return deck of a player for this game, loaded in session s"""
+        return s.query(Deck).filter(Deck.game_id == self.game_id, Deck.player_id == player_id).first()
+
+    def get_deck_url(self, deck_id):
+        """Update deckstats url of a deck, the request is sent once the session is closed"""
+        with session_scope() as s:
+            decklist = deckstat.get_deck_decklist(s.query(Deck).filter(Deck.id == deck_id).one())
+        self.deckstats[deck_id] = deckstat.get_url(*decklist) if decklist else None
+        return self.deckstats[deck_id]
+
     def load_deckstats(self, update, context):
-        player = session.query(Player).filter(Player.id==update.message.from_user.id).first()
+        player_id = update.message.from_user.id
         if context.args:
             url = context.args[0]
             # Add a specific game type instead of default Free for All
-            logging.info(f"{player.name} loads deck from url: {url}")
-            deck = self.game.get_deck_from_player_id(player.id)
-            if not deck:
-                deck = Deck(player=player, game=self.game)
+            with session_scope() as s:
+                player = s.query(Player).filter(Player.id==player_id).first()
+                logging.info(f"{player.name} loads deck from url: {url}")
+                deck = self.get_deck(s, player_id)
+                if not deck:
+                    deck = Deck(player=player, game=s.query(Game).filter(Game.id == self.game_id).one())
+                    s.add(deck)
                 errors = deck.load_deckstats_data(url)
-                session.add(deck)
-                self.game.decks.append(deck)
-                context.user_data['deck'] = deck
-            else:
-                errors= deck.load_deckstats_data(url)
-            session.commit()
-            context.user_data['deck'].deckstats = url
+                s.flush()
+                context.user_data['deck_id'] = deck.id
+            self.deckstats[context.user_data['deck_id']] = url
 
             text = "J'ai bien chargé ton deck."
             if errors:
@@ -81,7 +101,7 @@ class DeckHandler:
             text = "N'oublie pas de m'envoyer l'url de ton deck comme dans l'exemple suivant:\n"\
                     "[/load_deckstats https://mydeckurl.com]"
 
-        context.bot.send_message(chat_id=player.id,
+        context.bot.send_message(chat_id=player_id,
                                  text=text,
                                  disable_web_page_preview=True,
                                  parse_mode="HTML")
@@ -89,26 +109,26 @@ class DeckHandler:
     @restrict(UserType.PLAYER)
     def load_last_deck(self, update, context):
         player_id = update.message.from_user.id
-        last_deck = session.query(Deck).filter(Deck.player_id == player_id, Deck.game_id != self.game.id).order_by(Deck.id.desc()).first()
-        if not last_deck:
+        deck_id = None
+        with session_scope() as s:
+            last_deck = s.query(Deck).filter(Deck.player_id == player_id, Deck.game_id != self.game_id).order_by(Deck.id.desc()).first()
+            if last_deck:
+                current_deck = self.get_deck(s, player_id)
+                if current_deck:
+                    s.delete(current_deck)
+                deck = last_deck.copy(self.game_id)
+                s.add(deck)
+                s.flush()
+                logging.info(f"{last_deck.player.name} reloads deck: {deck}")
+                deck_id = deck.id
+        if not deck_id:
             text = "Je n'ai pas trouvé d'ancien deck à toi."
             context.bot.send_message(chat_id=player_id,
                                      text=text)
             return False
 
-        last_deck = Deck(player=last_deck.player, name=last_deck.name, game=self.game, description=last_deck.description, cards=last_deck.cards)
-
-        current_deck = self.game.get_deck_from_player_id(player_id)
-        if current_deck:
-            self.game.decks.remove(current_deck)
-
-        session.add(last_deck)    
-        self.game.decks.append(last_deck)
-        session.commit()
-        context.user_data['deck'] = last_deck
-        context.user_data['deck'].deckstats = deckstat.get_deck_url(last_deck)
-        
-        logging.info(f"{last_deck.player.name} reloads deck: {last_deck}")
+        context.user_data['deck_id'] = deck_id
+        self.get_deck_url(deck_id)
 
         text = "J'ai bien chargé le deck de ta dernière partie. Pour le consulter: /mydeck"
         context.bot.send_message(chat_id=player_id,
@@ -128,7 +148,7 @@ class DeckHandler:
         """Get Keyboard depending of game and dialog state
         game state avoid modifying notes once the game is on
         """
-        if self.game.state == GameStates.INIT.name :
+        if self.game_state == GameStates.INIT.name :
                 keyboard = [[InlineKeyboardButton("Nom", callback_data="deck_action="+DeckConv.NAME.name),
                          InlineKeyboardButton("Description", callback_data="deck_action="+DeckConv.DESCR.name)],
                          [InlineKeyboardButton("Cartes", callback_data="deck_action="+DeckConv.CARDS.name),
@@ -146,16 +166,14 @@ class DeckHandler:
         return keyboard
         
     @restrict(UserType.PLAYER)
-    @run_async
     def new_deck(self, update, context):
         """/scan
         NFC Scan each player deck turn by turn
         Use InlineKeyboardMarkup to correct a card or submit your deck or see stats about it
         """
         user = update.message.from_user
-        deck = self.game.get_deck_from_player_id(user.id)
         # Remove entry point to ensure one user is scanning only
-        if self.current_user and user != self.current_user:
+        if self.current_user and user.id != self.current_user.id:
             text = f"{self.current_user.name} est déjà en train de scanner."
             context.bot.send_message(chat_id=user.id,
                                      text=text)
@@ -168,59 +186,66 @@ class DeckHandler:
                                      text=text)
             return False
 
-        # Avoid multiple deck per user
-        elif deck:
-            logging.info(f"{user} starts scanning new cards for his existing deck")
-            self.deck = deck
-            self.current_user = session.query(Player).filter(Player.id==user.id).first()
-        # elif user.id in self.user_scanned:
-            # text = f"{self.current_user.name}, tu as déjà un deck chargé, utilise /mydeck pour le consulter."
-            # context.bot.send_message(chat_id=user.id,
-                                     # text=text)
-            # return False
-        else:
-            logging.info(f"{user} starts scanning his new deck")
-            self.current_user = session.query(Player).filter(Player.id==user.id).first()
-            self.deck = Deck(player=self.current_user, name=f"Deck de {self.current_user.name}", game=self.game)
-            session.add(self.deck)
-        text = f"Yo {self.current_user.name}, commence à scanner tes cartes !"
-        for deck_card in self.deck.cards:
-            text += f"\n- {deck_card.card.name}"
-        reply_markup = InlineKeyboardMarkup(self.get_scan_keyboard(len(self.deck.cards)))
+        with session_scope() as s:
+            self.current_user = s.query(Player.id, Player.name).filter(Player.id==user.id).first()
+            deck = self.get_deck(s, user.id)
+            # Avoid multiple deck per user
+            if deck:
+                logging.info(f"{user} starts scanning new cards for his existing deck")
+                self.deck_id = deck.id
+                scanned = s.query(DeckList.card_id, Card.name).join(Card).filter(DeckList.deck_id == deck.id).all()
+            # elif user.id in self.user_scanned:
+                # text = f"{self.current_user.name}, tu as déjà un deck chargé, utilise /mydeck pour le consulter."
+                # context.bot.send_message(chat_id=user.id,
+                                         # text=text)
+                # return False
+            else:
+                # Deck is created when scanned cards are submitted
+                logging.info(f"{user} starts scanning his new deck")
+                self.deck_id = None
+                scanned = []
+        self.set_scanned([(card_id, name) for card_id, name in scanned])
+        text = f"Yo {self.current_user.name}, commence à scanner tes cartes !{self.scanned_text}"
+        reply_markup = InlineKeyboardMarkup(self.get_scan_keyboard(len(self.scanned)))
         message = context.bot.send_message(chat_id=user.id,
                                            text=text,
-                                           reply_markup=reply_markup)
+                                           reply_markup=reply_markup).result()
+        self.scan_message = outbox.MessageEditor(context.bot, user.id, message.message_id,
+                                                 interval=self.edit_interval)
         context.dispatcher.add_handler(self.scan_buttons_handler)
         
-        # Start scanning
+        # Start scanning in background, two cards can be put on the scanner together
+        self.nfc_scan.max_targets = 2
         self.nfc_scan.start(self.add_card_to_deck,
                             context=context,
                             user=user,
                             message=message)
 
+    def set_scanned(self, scanned):
+        self.scanned = scanned
+        self.scanned_ids = {card_id for card_id, name in scanned}
+        self.scanned_text = "".join(f"\n- {name}" for card_id, name in scanned)
+
     def add_card_to_deck(self, uid, context, user, message):
-        card = next((c.card for c in self.cubelist if c.uid == uid), None)
-        if not card:
+        """NFC callback, runs on the scanner thread. Message edits are coalesced, never waited for"""
+        scan_message = self.scan_message
+        if scan_message is None:
+            # Scan was stopped
+            return
+        record = uid_resolver.resolve(self.cube_id, uid)
+        if not record:
             # unknown card detected
-            reply_markup = InlineKeyboardMarkup(self.get_scan_keyboard(len(self.deck.cards)))
-            context.bot.editMessageText(chat_id=user.id,
-                                        message_id=message.message_id,
-                                        text="Carte non reconnue, continue à scanner",
-                                        reply_markup=reply_markup)
+            reply_markup = InlineKeyboardMarkup(self.get_scan_keyboard(len(self.scanned)))
+            scan_message.update("Carte non reconnue, continue à scanner", reply_markup)
         # Check if card is already scanned
-        elif not any(card.id == deck_card.card_id for deck_card in self.deck.cards):
-            DeckList(deck=self.deck, card=card)
-            session.flush()
-            edit = f"Continue à scanner...\nCartes scannées ({len(self.deck.cards)}):"
-            for deck_card in self.deck.cards:
-                edit += f"\n- {deck_card.card.name}"
-            reply_markup = InlineKeyboardMarkup(self.get_scan_keyboard(len(self.deck.cards)))
-            context.bot.editMessageText(chat_id=user.id,
-                                        message_id=message.message_id,
-                                        text=edit,
-                                        reply_markup=reply_markup)
-            sleep(0.1) # Avoid spam limit
-                               
+        elif record.card_id not in self.scanned_ids:
+            self.scanned.append((record.card_id, record.name))
+            self.scanned_ids.add(record.card_id)
+            self.scanned_text += f"\n- {record.name}"
+            edit = f"Continue à scanner...\nCartes scannées ({len(self.scanned)}):{self.scanned_text}"
+            reply_markup = InlineKeyboardMarkup(self.get_scan_keyboard(len(self.scanned)))
+            scan_message.update(edit, reply_markup)
+
 
     def scan_buttons(self, update, context):
         """ InlineKeyboardMarkup response 4 types
@@ -233,27 +258,27 @@ class DeckHandler:
         reg = re.compile(r"scan_button=(\d)")
         match = reg.findall(query.data)[0]
         
+        if match in ("0", "2"):
+            # Pending scan edits must not overwrite the answer
+            self.scan_message.close()
+
         if match == "0":
             # Cancel is called
             text = "Scan annulé, ton deck n'a pas été enregistré.\n"\
                    "Pour recommencer: /scan"
-            session.delete(self.deck)
+            if self.deck_id:
+                with session_scope() as s:
+                    s.delete(s.query(Deck).filter(Deck.id == self.deck_id).one())
             query.edit_message_text(text=text,
                                     parse_mode="HTML")
             self.reset_state(context.dispatcher)
             
-        if match == "1" and self.deck.cards:
+        if match == "1" and self.scanned:
             # Remove last element of decklist
-            # del self.deck.cards[-1]
-            self.deck.cards.remove(self.deck.cards[-1])
-##            session.delete(self.deck.cards[-1])
-##            session.flush()
-            edit = f"Cartes scannées ({len(self.deck.cards)}):"
-            for deck_card in self.deck.cards:
-                edit += f"\n- {deck_card.card.name}"
-            reply_markup = InlineKeyboardMarkup(self.get_scan_keyboard(len(self.deck.cards)))
-            query.edit_message_text(text=edit,
-                                    reply_markup=reply_markup)
+            self.set_scanned(self.scanned[:-1])
+            edit = f"Cartes scannées ({len(self.scanned)}):{self.scanned_text}"
+            reply_markup = InlineKeyboardMarkup(self.get_scan_keyboard(len(self.scanned)))
+            self.scan_message.update(edit, reply_markup)
 
         elif match == "2":
             # Submit decklist
@@ -261,18 +286,35 @@ class DeckHandler:
                    "ou consulter des infos le concernant:\n/mydeck"
             query.edit_message_text(text=text,
                                     parse_mode="HTML")
-            context.user_data["deck"] = self.deck
-            context.user_data['deck'].deckstats = deckstat.get_deck_url(self.deck)
+            context.user_data["deck_id"] = self.save_scanned_cards()
+            self.get_deck_url(context.user_data["deck_id"])
             # Append user to list of player who already has scanned their deck
             # self.user_scanned.append(query.from_user.id)
-            if not self.deck in self.game.decks:
-                self.game.decks.append(self.deck)
-            session.commit()
-            logging.info(f"{self.deck} saved")
             self.reset_state(context.dispatcher)
         
         return False
     
+    def save_scanned_cards(self):
+        """Update deck cards with scanned cards, create the deck if needed. Return the deck id"""
+        scanned_id = [card_id for card_id, name in self.scanned]
+        with session_scope() as s:
+            if self.deck_id:
+                deck = s.query(Deck).filter(Deck.id == self.deck_id).one()
+            else:
+                deck = Deck(player_id=self.current_user.id, name=f"Deck de {self.current_user.name}", game_id=self.game_id)
+                s.add(deck)
+            for deck_card in [deck_card for deck_card in deck.cards if deck_card.card_id not in scanned_id]:
+                deck.cards.remove(deck_card)
+            deck_cards_id = {deck_card.card_id for deck_card in deck.cards}
+            new_cards_id = [card_id for card_id in scanned_id if card_id not in deck_cards_id]
+            if new_cards_id:
+                cards = {card.id: card for card in s.query(Card).filter(Card.id.in_(new_cards_id))}
+                for card_id in new_cards_id:
+                    DeckList(deck=deck, card=cards[card_id])
+            s.flush()
+            logging.info(f"{deck} saved")
+            return deck.id
+
     def deck_conv_handler(self):
         """Get ConversationHandler for deck management"""
         conv_handler = ConversationHandler(
@@ -294,13 +336,17 @@ class DeckHandler:
         return conv_handler
 
     def get_deck_info(self, context):
-        if context.user_data['deck'].deckstats:
-            deckstat_text = f"<a href='{context.user_data['deck'].deckstats}'>{context.user_data['deck'].name}</a>"
+        deck_id = context.user_data['deck_id']
+        with session_scope() as s:
+            deck = s.query(Deck).filter(Deck.id == deck_id).one()
+            name, description, card_count = deck.name, deck.description, deck.card_count
+        if self.deckstats.get(deck_id, None):
+            deckstat_text = f"<a href='{self.deckstats[deck_id]}'>{name}</a>"
         else:
             deckstat_text = None
-        text = f"Titre: {deckstat_text if deckstat_text else context.user_data['deck'].name}\n" \
-               f"Description: {context.user_data['deck'].description if context.user_data['deck'].description else 'Aucune'}\n" \
-               f"Nombres de cartes: {context.user_data['deck'].card_count}\n" \
+        text = f"Titre: {deckstat_text if deckstat_text else name}\n" \
+               f"Description: {description if description else 'Aucune'}\n" \
+               f"Nombres de cartes: {card_count}\n" \
                f"Que souhaites-tu voir ou modifier dans ton deck ?"
         return text
         
@@ -314,17 +360,18 @@ class DeckHandler:
         This handler is available once you have created a deck and until end of the game
         """
         # Check if user has a deck
-        deck = self.game.get_deck_from_player_id(update.message.from_user.id)
-        if not deck:
-            p = session.query(Player).filter(Player.id==update.message.from_user.id).first()
-            d = Deck(player=p, name=f"Deck de {p.name}", game=self.game)
-            self.game.decks.append(d)
-            session.commit()
-            context.user_data['deck'] = d
-        elif not context.user_data.get("deck", None):
-            # If user has deck but not in context_data, had it
-            context.user_data['deck'] = deck
-            context.user_data['deck'].deckstats = deckstat.get_deck_url(deck)
+        player_id = update.message.from_user.id
+        with session_scope() as s:
+            deck = self.get_deck(s, player_id)
+            if not deck:
+                p = s.query(Player).filter(Player.id==player_id).first()
+                deck = Deck(player=p, name=f"Deck de {p.name}", game_id=self.game_id)
+                s.add(deck)
+                s.flush()
+            context.user_data['deck_id'] = deck.id
+        if context.user_data['deck_id'] not in self.deckstats:
+            # Deck not shown yet in this game
+            self.get_deck_url(context.user_data['deck_id'])
 
         # Send deck_editor menu
         context.bot.send_message(chat_id=update.message.from_user.id,
@@ -340,7 +387,8 @@ class DeckHandler:
         match = reg.findall(query.data)[0]
         
         if match == DeckConv.NAME.name:
-            name = context.user_data['deck'].name
+            with session_scope() as s:
+                name = s.query(Deck.name).filter(Deck.id == context.user_data['deck_id']).scalar()
             text = f"Le nom actuel de ton deck est <b>{name}</b>, "\
                      "envoie moi un nouveau nom pour ton deck. (/stop pour quitter)"
             query.edit_message_text(text=text,
@@ -348,7 +396,8 @@ class DeckHandler:
             return DeckConv.NAME
         
         elif match == DeckConv.DESCR.name:
-            description = context.user_data['deck'].description
+            with session_scope() as s:
+                description = s.query(Deck.description).filter(Deck.id == context.user_data['deck_id']).scalar()
             text = f"La description actuelle de ton deck est {'<b>' + description + '</b>' if description else 'vide' }, "\
                      "envoie moi une nouvelle description pour ton deck. (/stop pour quitter)"
             query.edit_message_text(text=text,
@@ -379,17 +428,18 @@ class DeckHandler:
             return DeckConv.SIGN
             
         elif match == DeckConv.TOKEN.name:
-            deck = session.query(Deck).filter(Deck.id==context.user_data["deck"].id).first()
             text = "Voici la liste des tokens dont tu auras besoin:\n"
             tokens = []
-            for deck_card in deck.cards:
-                for token in deck_card.card.tokens:
-                    if token in tokens: continue
-                    tokens.append(token)
-                    if isinstance(token.power, int) and isinstance(token.toughness, int):
-                        text+= f"- <a href='{token.image_url}'>{token.power}/{token.toughness} {token.color} {token.name}</a>\n"
-                    else:
-                        text+= f"- <a href='{token.image_url}'>{token.color} {token.name}</a>\n"
+            with session_scope() as s:
+                deck = s.query(Deck).filter(Deck.id==context.user_data["deck_id"]).first()
+                for deck_card in deck.cards:
+                    for token in deck_card.card.tokens:
+                        if token in tokens: continue
+                        tokens.append(token)
+                        if isinstance(token.power, int) and isinstance(token.toughness, int):
+                            text+= f"- <a href='{token.image_url}'>{token.power}/{token.toughness} {token.color} {token.name}</a>\n"
+                        else:
+                            text+= f"- <a href='{token.image_url}'>{token.color} {token.name}</a>\n"
             if not tokens:
                 text = "Ton deck n'a pas besoin de token.\n"
             text += self.get_deck_info(context)
@@ -406,7 +456,8 @@ class DeckHandler:
             return ConversationHandler.END
         
     def set_deck_name(self, update, context):
-        context.user_data['deck'].name = update.message.text
+        with session_scope() as s:
+            s.query(Deck).filter(Deck.id == context.user_data['deck_id']).one().name = update.message.text
         text = f"Modification sauvegardée.\n" + self.get_deck_info(context)
         update.message.reply_text(text=text,
                                   reply_markup=InlineKeyboardMarkup(self.get_deck_keyboard()),
@@ -414,7 +465,8 @@ class DeckHandler:
         return DeckConv.ACTION
 
     def set_deck_desc(self, update, context):
-        context.user_data['deck'].description = update.message.text
+        with session_scope() as s:
+            s.query(Deck).filter(Deck.id == context.user_data['deck_id']).one().description = update.message.text
         text = f"Modification sauvegardée.\n" + self.get_deck_info(context)
         update.message.reply_text(text=text,
                                   reply_markup=InlineKeyboardMarkup(self.get_deck_keyboard()),
@@ -428,23 +480,26 @@ class DeckHandler:
         matches = r.findall(answer)
         errors = []
         modif = 0
-        for cardname, note in matches:
-            try:
-                card = session.query(Card).filter(Card.name.like(cardname.strip() + "%")).one()
-            except MultipleResultsFound:
-                errors.append((cardname, "plusieurs cartes trouvées"))
-                continue
-            except NoResultFound:
-                errors.append((cardname, "pas de carte trouvée"))
-                continue
-            if any(card.id == deck_card.card_id for deck_card in context.user_data['deck'].cards):
-                deck_card = session.query(DeckList).filter(DeckList.card_id == card.id, DeckList.deck_id == context.user_data["deck"].id).first()
-                deck_card.note = note
-                modif += 1
-            else:
-                errors.append((cardname, "carte absente du deck"))
-        session.commit()
-        if modif: context.user_data['deck'].deckstats = deckstat.get_deck_url(context.user_data['deck'])
+        index = card_index.get_index(self.cube_id)
+        with session_scope() as s:
+            deck = s.query(Deck).filter(Deck.id == context.user_data['deck_id']).one()
+            for cardname, note in matches:
+                candidates = index.resolve(cardname)
+                if len(candidates) > 1:
+                    errors.append((cardname, "plusieurs cartes trouvées"))
+                    continue
+                elif not candidates:
+                    errors.append((cardname, "pas de carte trouvée"))
+                    continue
+                deck_card = next((deck_card for deck_card in deck.cards
+                                  if deck_card.card_id in candidates[0].card_ids), None)
+                if deck_card:
+                    deck_card.note = note
+                    modif += 1
+                else:
+                    errors.append((cardname, "carte absente du deck"))
+        scan_actions.invalidate(self.game_id)
+        if modif: self.get_deck_url(context.user_data['deck_id'])
         text = "J'ai bien modifié les notes de ton deck."
         if errors:
             text +=  " Cependant j'ai un problème avec les cartes suivantes:"
@@ -458,31 +513,27 @@ class DeckHandler:
 
     def choose_card(self, update, context):
         answer = update.message.text
-        c = session.query(CubeList).join(Card).join(DeckList).join(Deck).filter(Deck.player_id==update.message.from_user.id,
-                                                                 Deck.game_id==self.game.id,
-                                                                 Card.name.like(f"{answer}%")).first()
+        with session_scope() as s:
+            deck_cards_id = {card_id for card_id, in s.query(DeckList.card_id).join(Deck)
+                             .filter(Deck.game_id == self.game_id, Deck.player_id == update.message.from_user.id)}
+        c = None
+        for candidate in card_index.get_index(self.cube_id).lookup(answer, limit=None):
+            card_id = next((i for i in candidate.card_ids if i in deck_cards_id), None)
+            if card_id:
+                with session_scope() as s:
+                    c = s.query(CubeList.signature, Card.name, Card.id).join(Card)\
+                         .filter(CubeList.card_id == card_id, CubeList.cube_id == self.cube_id).first()
+                break
         avert = "Attention cette carte est déjà signée !\n"
         if c:
             if c.signature:
-                path = os.path.join(config.src_dir, "resources", "sounds", c.signature)
-                filename, file_extension = os.path.splitext(path)
-                audio_formats = [".mp3", ".m4a"]
-                voice_formats = [".ogg", ".oga"]
-                if file_extension in audio_formats:
-                    context.bot.sendAudio(chat_id=update.message.chat_id,
-                                          audio=open(path, 'rb'),
-                                          title=c.card.name,
-                                          performer="cubebot")
-                elif file_extension in voice_formats:
-                    context.bot.sendVoice(chat_id=update.message.chat_id,
-                                          voice=open(path, 'rb'),
-                                          caption=c.card.name)
-            text = f"{avert if c.signature  else ''}{c.card.name} - Est-ce bien ta carte ?"
+                signature.send(context.bot, update.message.chat_id, c.signature, c.name)
+            text = f"{avert if c.signature  else ''}{c.name} - Est-ce bien ta carte ?"
             keyboard = [[InlineKeyboardButton("Annuler", callback_data='confirm_card=0'),
                          InlineKeyboardButton("Retenter", callback_data='confirm_card=2')],
                         [InlineKeyboardButton("Oui", callback_data='confirm_card=1')]]
             markup = InlineKeyboardMarkup(keyboard)
-            context.user_data["sign_card_id"] = c.card.id
+            context.user_data["sign_card_id"] = c.id
             update.message.reply_text(text=text,
                                       reply_markup=markup)
             return DeckConv.CONFIRM
@@ -518,53 +569,24 @@ class DeckHandler:
 
     def save_signature(self, update, context):
         card_id = context.user_data["sign_card_id"]
-        if update.message.audio:
-            file = context.bot.getFile(update.message.audio.file_id)
-            filename, file_extension = os.path.splitext(file.file_path)
-            dl_path = os.path.join(config.src_dir,"resources",
-                                   "sounds",f"{self.game.cube.id}_{card_id}{file_extension}")
-            file.download(dl_path)
-            logging.info(f"audio downloaded ({dl_path})")
-
-        elif update.message.voice:
-            file = context.bot.getFile(update.message.voice.file_id)
-            filename, file_extension = os.path.splitext(file.file_path)
-            dl_path = os.path.join(config.src_dir,"resources",
-                                   "sounds",f"{self.game.cube.id}_{card_id}{file_extension}")
-            file.download(dl_path)
-            logging.info(f"audio downloaded ({dl_path})")
-
-        elif update.message.entities:
-            url = update.message.parse_entity(update.message.entities[0])
-            filename, file_extension = os.path.splitext(url)
-            logging.info(f"Audio to download from url: {url}")
-            audio_formats = [".mp3", ".m4a", ".ogg"]
-            if file_extension in audio_formats: 
-                r = requests.get(url)
-                if r.ok:
-                    dl_path = os.path.join(config.src_dir,"resources",
-                                   "sounds",f"{self.game.cube.id}_{card_id}{file_extension}")
-                    with open(dl_path, 'wb') as f:
-                        f.write(r.content)
-                        logging.info(f"audio downloaded ({dl_path})")
-                else:
-                    text = f"Le serveur répond avec un code d'erreur {r.status_code}. Essaye avec un autre lien."
-                    update.message.reply_text(text=text)
-                    return DeckConv.SENDING
-            else:
-                text = f"Format audio inconnu. Essaye avec un autre lien avec l'un des formats suivant {audio_formats}."
-                update.message.reply_text(text=text)
-                return DeckConv.SENDING
+        try:
+            source = signature.download(update.message, context.bot)
+        except signature.DownloadError as e:
+            text = f"Le serveur répond avec un code d'erreur {e.status_code}. Essaye avec un autre lien."
+            update.message.reply_text(text=text)
+            return DeckConv.SENDING
+        except signature.UnknownFormat:
+            text = f"Format audio inconnu. Essaye avec un autre lien avec l'un des formats suivant {signature.URL_FORMATS}."
+            update.message.reply_text(text=text)
+            return DeckConv.SENDING
 
-        else:
+        if source is None:
             text = "Format audio inconnu. Essayes-en un autre.\n(/stop pour sortir)"
             update.message.reply_text(text=text)
             return DeckConv.SENDING
-        
-        c = session.query(CubeList).filter(CubeList.card_id==card_id, CubeList.cube_id==self.game.cube.id).first()
-        c.signature = f"{self.game.cube.id}_{card_id}{file_extension}"
-        session.commit()
-        logging.info(f"{c} signed with {c.signature}")
+
+        # Sound is processed and saved in background
+        signature.ingest(source, self.cube_id, card_id, game_id=self.game_id)
         text = "Ta carte est desormais signée.\n" + self.get_deck_info(context)
         update.message.reply_text(text=text,
                                   reply_markup=InlineKeyboardMarkup(self.get_deck_keyboard()),
@@ -573,10 +595,12 @@ class DeckHandler:
         
     def set_deck_cards(self, update, context):
         answer = update.message.text
+        deck_id = context.user_data['deck_id']
         if answer == "REMOVE ALL CARDS":
-            context.user_data['deck'].cards[:] = []
-            session.commit()
-            context.user_data['deck'].deckstats = None
+            with session_scope() as s:
+                s.query(Deck).filter(Deck.id == deck_id).one().cards[:] = []
+            scan_actions.invalidate(self.game_id)
+            self.deckstats[deck_id] = None
             text = "Jai bien supprimé toutes les cartes de ton deck.\n"
             update.message.reply_text(text=text+self.get_deck_info(context),
                                       reply_markup=InlineKeyboardMarkup(self.get_deck_keyboard()),
@@ -587,6 +611,10 @@ class DeckHandler:
         reg = re.compile(regex)
         errors = []
         modif = 0
+        index = card_index.get_index(self.cube_id)
+        with session_scope() as s:
+            deck_cards_id = {card_id for card_id, in s.query(DeckList.card_id).filter(DeckList.deck_id == deck_id)}
+        changes = []
         for line in answer.split("\n"):
             # Import note after # mark with this syntax: 1 [CN2] Arcane Savant #Summon the pack
             note = None
@@ -604,29 +632,39 @@ class DeckHandler:
                 num = 1
             else:
                 num = int(num)
-            try:
-                card = session.query(Card).join(CubeList).filter(Card.name.like(cardname + "%"),
-                                                                 CubeList.cube_id == self.game.cube_id).one()
-            except MultipleResultsFound:
+            candidates = index.resolve(cardname)
+            if len(candidates) > 1:
                 errors.append((cardname, "plusieurs cartes trouvées"))
                 continue
-            except NoResultFound:
+            elif not candidates:
                 errors.append((cardname, "pas de carte trouvée"))
                 continue
-            if mode == "" or mode == "+":
-                context.user_data['deck'].add_card(card=card, amount=num, note=note)
-                modif += 1
-            elif mode == "-":
-                r = context.user_data['deck'].remove_card(card, num)
-                if not r: errors.append((cardname, "carte absente du deck"))
-                modif += 1
-        session.commit()
+            card_id = candidates[0].card_id
+            if mode == "-":
+                # Remove the copy which is in the deck
+                card_id = next((i for i in candidates[0].card_ids if i in deck_cards_id), card_id)
+            changes.append((mode, num, note, cardname, card_id))
+        with session_scope() as s:
+            deck = s.query(Deck).filter(Deck.id == deck_id).one()
+            # Load all cards at once
+            cards_id = {card_id for mode, num, note, cardname, card_id in changes}
+            cards = {card.id: card for card in s.query(Card).filter(Card.id.in_(cards_id))} if cards_id else {}
+            for mode, num, note, cardname, card_id in changes:
+                card = cards[card_id]
+                if mode == "" or mode == "+":
+                    deck.add_card(card=card, amount=num, note=note)
+                    modif += 1
+                elif mode == "-":
+                    r = deck.remove_card(card, num)
+                    if not r: errors.append((cardname, "carte absente du deck"))
+                    modif += 1
+        scan_actions.invalidate(self.game_id)
         text = "J'ai bien modifié le contenu de ton deck."
         if errors:
             text +=  " Cependant je n'ai pas trouvé les cartes suivantes:"
             for cardname, error in errors:
                 text += f"\n- {cardname} ({error})"
-        if modif: context.user_data['deck'].deckstats = deckstat.get_deck_url(context.user_data['deck'])
+        if modif: self.get_deck_url(deck_id)
         text += "\n" + self.get_deck_info(context)
         update.message.reply_text(text=text,
                                   reply_markup=InlineKeyboardMarkup(self.get_deck_keyboard()),
@@ -642,17 +680,21 @@ class DeckHandler:
         """Reset state of all conversation variables and handlers"""
         dispatcher.remove_handler(self.scan_buttons_handler)
         self.nfc_scan.stop()
-        self.deck = None
+        if self.scan_message:
+            self.scan_message.close()
+            self.scan_message = None
+        self.deck_id = None
         self.current_user = None
+        self.set_scanned([])
 
     def stop_deck_preparation(self, context):
-        """reset all state and handlers and return game object"""
+        """reset all state and handlers, decks are already saved"""
         # A user is scanning or has not finished is deck yet
         if self.current_user:
             return False
         # Nobody is scanning stop all DeckHandlers
         context.dispatcher.remove_handler(self.scan_handler)
         context.dispatcher.remove_handler(self.scan_buttons_handler)
-        session.commit()
+        self.game_state = GameStates.PLAY.name
         return True
         # return self.game       
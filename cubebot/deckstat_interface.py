@@ -3,6 +3,7 @@ import json
 import requests
 import logging
 import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 def load_deck(url):
     """Load deck from target deckstat url"""
@@ -30,6 +31,12 @@ def get_deck_url(deck):
     """Get deck url on deckstat.net from given deck.
     Code inspired from cockatrice:
     https://github.com/Cockatrice/Cockatrice/blob/master/cockatrice/src/deckstats_interface.cpp"""
+    decklist = get_deck_decklist(deck)
+    return get_url(*decklist) if decklist else None
+
+def get_deck_decklist(deck):
+    """Return decklist and title of a deck, None if it has no cards.
+    Read the deck in its session, the request can be sent once it is closed"""
     if not deck.cards:
         return None
     #Prepare request
@@ -38,9 +45,20 @@ def get_deck_url(deck):
         br = "\n"
         note = " #"
         decklist += f"{deck_card.amount}x {deck_card.card.name}{note+deck_card.note if deck_card.note else ''}{br if i<len(deck.cards)-1 else ''}"
-    return get_url(decklist, deck.name)
+    return decklist, deck.name
 
 def get_sealed_url(cards, title):
+    return get_url(*get_sealed_decklist(cards, title))
+
+def get_sealed_urls(pools, max_workers=8):
+    """Get urls of several (cards, title) pools, up to max_workers requests at a time"""
+    decks = [get_sealed_decklist(cards, title) for cards, title in pools]
+    if not decks:
+        return []
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(decks))) as executor:
+        return list(executor.map(lambda deck: get_url(*deck), decks))
+
+def get_sealed_decklist(cards, title):
     decklist = ""
     for i, card in enumerate(cards):
         # if card.type_line == "Regalia":
@@ -50,7 +68,7 @@ def get_sealed_url(cards, title):
     
     timestamp = datetime.date.today().strftime("%d-%m-%Y")
     decktitle = f"{title} du {timestamp}"
-    return get_url(decklist, decktitle)
+    return decklist, decktitle
 
 def get_url(decklist, decktitle):
     url = 'https://deckstats.net/index.php'
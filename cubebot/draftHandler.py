@@ -3,11 +3,11 @@ import io
 import deckstat_interface as deckstat
 import logging
 from utils import set_boosters
-from time import sleep
+import outbox
 from random import shuffle
 from filters import restrict, SealedConv, UserType
 from functools import partial
-from model import session, Cube, CubeList, Game, Player, Card, Deck, DeckList, Draft, Drafter
+from model import session_scope, card_infos, Cube, CubeList, Player, Card, Draft, Drafter
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, MessageEntity, ReplyKeyboardRemove
 from telegram.ext import Filters, CommandHandler, ConversationHandler, MessageHandler, CallbackQueryHandler
 
@@ -16,6 +16,7 @@ class DraftHandler:
 
     def __init__(self, dispatcher):
         self.dispatcher = dispatcher
+        # Rows of (id, name), not bound to a session
         self.players = []
         self.subscribers = []
         self.cube = None
@@ -58,7 +59,8 @@ class DraftHandler:
     @restrict(UserType.ADMIN)
     def start_select_cube(self, update, context):
         keyboard = []
-        cubes = session.query(Cube).all()
+        with session_scope() as s:
+            cubes = s.query(Cube.id, Cube.name).all()
         for cube in cubes:
             keyboard.append([InlineKeyboardButton(cube.name, callback_data=f"cube_id={cube.id}")])
         keyboard.append([InlineKeyboardButton("Annuler", callback_data="cube_id=0")])
@@ -79,9 +81,10 @@ class DraftHandler:
             return ConversationHandler.END
 
         else:
-            self.cube = session.query(Cube).filter(Cube.id == match).one()
-            # TODO: load here cube specific draft behaviour
-            self.players = session.query(Player).all()
+            with session_scope() as s:
+                self.cube = s.query(Cube.id, Cube.name).filter(Cube.id == match).one()
+                # TODO: load here cube specific draft behaviour
+                self.players = s.query(Player.id, Player.name).all()
             reply_markup = InlineKeyboardMarkup(self.get_select_player_keyboard())
             text = f"Cube sélectionné: {self.cube.name}\nSélectionne maintenant les joueurs qui participeront :"
             query.edit_message_text(text=text,
@@ -119,7 +122,7 @@ class DraftHandler:
         
         else:
             # Add player
-            player = session.query(Player).filter(Player.id == int(match)).first()
+            player = next(player for player in self.players if player.id == int(match))
             self.subscribers.append(player)
             text = "Joueurs selectionnés:\n"
             for player in self.subscribers:
@@ -133,7 +136,9 @@ class DraftHandler:
         
     def start_sealed(self, update, context):
         # Send sealed
-        cards = session.query(Card).join(CubeList).join(Cube).filter(Cube.id == self.cube.id, Card.type_line != "Basic Land").all()
+        with session_scope() as s:
+            cards = card_infos(s.query(Card).join(CubeList).filter(CubeList.cube_id == self.cube.id,
+                                                                   Card.type_line != "Basic Land"))
         shuffle(cards)
         shuffle(self.subscribers)
         sealed_size = 90
@@ -149,13 +154,13 @@ class DraftHandler:
                     "ou si tu n'as pas de compte fait les modifs sur deckstat puis cliques sur export et copie colle ta decklist terminée dans le chat.</i>"
             context.bot.send_message(chat_id=player.id,
                                      text=text,
-                                     parse_mode="HTML")
+                                     parse_mode="HTML",
+                                     priority=outbox.DRAFT)
             final_text += f"- {player.name}\n"
-            sleep(1)
         
         update.callback_query.edit_message_text(text=final_text)
 
-    def get_booster_dialogue(self, drafter, is_new_booster=True, row_length=3):
+    def get_booster_dialogue(self, drafter, is_new_booster=True, row_length=3, pool_urls=None):
         text = f"Un booster tout frais est disponible !\n\n"
         booster = drafter.get_booster()
         if booster and booster.from_drafter:
@@ -174,8 +179,10 @@ class DraftHandler:
             text += "\nChoix pris en compte. En attente des autres joueurs...\n"
         
         if not booster:
-            session.commit()
-            url = deckstat.get_sealed_url(drafter.pool, title=f"Draft de {drafter.name}")
+            if pool_urls is not None:
+                url = pool_urls[drafter.id]
+            else:
+                url = deckstat.get_sealed_url(drafter.pool, title=f"Draft de {drafter.name}")
             text = f"Draft terminé. Voici ton <a href='{url}'>pool</a>"
             # TODO : function to clean draft data and handlers
             if self.drafted_card_handler:
@@ -198,7 +205,7 @@ class DraftHandler:
             max = i + row_length
             if max > len(cards): max = len(cards)
             for n in range(i, max, 1):
-                if drafter.choice and cards[n] == drafter.choice.card:
+                if drafter.choice and cards[n] == drafter.choice:
                     text += f"{n+1}) <b><a href='{cards[n].image_url}'>{cards[n].name}</a></b>{choice_emoji}\n"
                 else:
                     callback_data = f"[{self.get_callback_pattern(id_only=True)}]card_id={cards[n].id}"
@@ -220,7 +227,7 @@ class DraftHandler:
     def start_draft(self, update, context):
         # Remove entry point
         self.dispatcher.remove_handler(self.draft_handler)
-        self.draft = Draft(cube=self.cube)
+        self.draft = Draft(cube_id=self.cube.id)
         [self.draft.add_drafter(Drafter(s.id, s.name)) for s in self.subscribers]
         remaining_cards, filename = set_boosters(self.draft)
         self.send_doc(chat_id=update.callback_query.from_user.id,
@@ -242,14 +249,19 @@ class DraftHandler:
                                      reply_markup=reply_markup,
                                      parse_mode="HTML",
                                      disable_web_page_preview=True,
-                                     disable_notification=False)
+                                     disable_notification=False,
+                                     priority=outbox.DRAFT)
         
     def choose_card(self, update, context):
         query = update.callback_query
         drafter = self.draft.get_drafter_by_id(query.from_user.id)
         reg = re.compile(r"card_id=(\d*)")
         match = int(reg.findall(query.data)[0])
-        card = session.query(Card).filter(Card.id == match).first()
+        booster = drafter.get_booster()
+        card = next((card for card in booster.cards if card.id == match), None) if booster else None
+        if card is None:
+            # Card of a booster already passed
+            return
         pick_count = drafter.pick_count
         round_count = self.draft.round_count
         is_new_booster, is_new_round = drafter.choose(card)
@@ -259,6 +271,13 @@ class DraftHandler:
         if is_new_booster or is_new_round:
             # Update callback pattern to avoid an old callback to to send wrong data
             self.drafted_card_handler.pattern = self.get_callback_pattern()
+            # Messages are sent by the outbox workers, all drafters at once. Pools of the
+            # end of the draft are uploaded at once too, not one drafter after the other
+            pool_urls = None
+            if self.draft.state == "END":
+                drafters = self.draft.drafters
+                urls = deckstat.get_sealed_urls([(d.pool, f"Draft de {d.name}") for d in drafters])
+                pool_urls = {d.id: url for d, url in zip(drafters, urls)}
             for drafter in self.draft.drafters:
                 # If auto pick is activated, send the auto pick to drafter
                 if is_new_round and self.draft.auto_pick_last_card:
@@ -274,21 +293,22 @@ class DraftHandler:
                                    msg_data=drafter.data["query"],
                                    title=f"Ronde {round_count} Pick {pick_count}")
 
-                text, reply_markup = self.get_booster_dialogue(drafter, is_new_booster=is_new_booster)
-                sleep(0.5)
+                text, reply_markup = self.get_booster_dialogue(drafter, is_new_booster=is_new_booster, pool_urls=pool_urls)
                 context.bot.send_message(chat_id=drafter.id,
                                          text=text,
                                          reply_markup=reply_markup,
                                          parse_mode="HTML",
                                          disable_web_page_preview=True,
-                                         disable_notification=False)
+                                         disable_notification=False,
+                                         priority=outbox.DRAFT)
         # If a choice is made but not all users made one, we show choosed card
         else:
             text, reply_markup = self.get_booster_dialogue(drafter, is_new_booster)
             query.edit_message_text(text=text,
                                     reply_markup=reply_markup,
                                     parse_mode="HTML",
-                                    disable_web_page_preview=True)
+                                    disable_web_page_preview=True,
+                                    priority=outbox.DRAFT)
     
     def get_drafter_pool(self, update, context):
         text = "Il te faut au moins avoir drafté 2 cartes pour voir ton pool."
@@ -307,20 +327,19 @@ class DraftHandler:
             context.bot.send_message(chat_id=msg_data,
                                      text=text,
                                      parse_mode="HTML",
-                                     disable_web_page_preview=False)
+                                     disable_web_page_preview=False,
+                                     priority=outbox.DRAFT)
         else:
             msg_data.edit_message_text(text=text,
                                     parse_mode="HTML",
-                                    disable_web_page_preview=False)
-
-        sleep(0.5)
+                                    disable_web_page_preview=False,
+                                    priority=outbox.DRAFT)
 
     @staticmethod
     def send_doc(chat_id, context, content, filename):
-        s = io.StringIO(content)
-        s.seek(0)
-        document = io.BytesIO()
-        document.write(s.getvalue().encode())
-        document.seek(0)
+        # No document when the cube has no booster profile
+        if content is None:
+            return
+        document = io.BytesIO(content.encode())
         document.name = filename
         context.bot.send_document(chat_id=chat_id, document=document)
@@ -2,7 +2,7 @@ import config
 import logging
 from telegram.ext import BaseFilter
 from enum import Enum, auto
-from model import session, Player
+from model import session_scope, Player
 from functools import wraps
 
 class GameStates(Enum):
@@ -57,10 +57,11 @@ def restrict(user_type):
         @wraps(func)
         def command_func(self, update, context, *args, **kwargs):
             users_id = None
-            if user_type is UserType.ADMIN:
-                users_id = [id for id, in session.query(Player.id).filter(Player.is_admin==True).all()]
-            elif user_type is UserType.PLAYER:
-                users_id = [id for id, in session.query(Player.id).all()]
+            with session_scope() as s:
+                if user_type is UserType.ADMIN:
+                    users_id = [id for id, in s.query(Player.id).filter(Player.is_admin==True).all()]
+                elif user_type is UserType.PLAYER:
+                    users_id = [id for id, in s.query(Player.id).all()]
             if not update.effective_user.id in users_id:
                 logging.info(f"Unauthorized access denied for {update.effective_user}.")
                 return
@@ -0,0 +1,99 @@
+import io
+import os
+import logging
+import hashlib
+import threading
+from telegram.error import BadRequest
+from model import session_scope, TelegramFile
+
+"""Telegram keeps the files sent by the bot: a media sent once is sent again with its file_id
+instead of being uploaded again. file_ids are stored by content hash, so a changed file
+(e.g. a new signature with the same filename) is uploaded again"""
+
+# kind of media: bot method
+SENDERS = {"audio": "send_audio",
+           "voice": "send_voice",
+           "document": "send_document",
+           "photo": "send_photo"}
+
+# (hash, kind): file_id, loaded from the database on first use
+_file_ids = {}
+# path: (mtime, size, hash) of files already hashed
+_file_hashes = {}
+_lock = threading.Lock()
+
+
+def content_hash(content):
+    return hashlib.sha256(content).hexdigest()
+
+
+def get_file_id(digest, kind):
+    with _lock:
+        if (digest, kind) not in _file_ids:
+            with session_scope() as s:
+                f = s.query(TelegramFile).filter(TelegramFile.hash == digest, TelegramFile.kind == kind).first()
+                _file_ids[(digest, kind)] = f.file_id if f else None
+        return _file_ids[(digest, kind)]
+
+
+def set_file_id(digest, kind, file_id):
+    """Remember a file_id, None forgets it"""
+    with _lock:
+        _file_ids[(digest, kind)] = file_id
+        with session_scope() as s:
+            f = s.query(TelegramFile).filter(TelegramFile.hash == digest, TelegramFile.kind == kind).first()
+            if file_id is None:
+                if f:
+                    s.delete(f)
+            elif f:
+                f.file_id = file_id
+            else:
+                s.add(TelegramFile(hash=digest, kind=kind, file_id=file_id))
+
+
+def read(path):
+    """Return content hash of a file and its content if it has to be read"""
+    stat = os.stat(path)
+    with _lock:
+        cached = _file_hashes.get(path, None)
+    if cached and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+        return cached[2], None
+    with open(path, 'rb') as f:
+        content = f.read()
+    digest = content_hash(content)
+    with _lock:
+        _file_hashes[path] = (stat.st_mtime_ns, stat.st_size, digest)
+    return digest, content
+
+
+def send(bot, kind, chat_id, media, filename=None, **kwargs):
+    """Send a media (file path or bytes) of a kind of SENDERS to a chat, by file_id if it was sent before.
+    Other keyword arguments are given to the bot method. Return the message"""
+    method = getattr(bot, SENDERS[kind])
+    if isinstance(media, str):
+        filename = filename or os.path.basename(media)
+        digest, content = read(media)
+    else:
+        digest, content = content_hash(media), media
+    file_id = get_file_id(digest, kind)
+    if file_id:
+        try:
+            return method(chat_id=chat_id, **{kind: file_id}, **kwargs)
+        except BadRequest as e:
+            # e.g. file sent by another bot token
+            logging.info(f"Telegram file {file_id} not sent again ({e}), upload it")
+            set_file_id(digest, kind, None)
+    if content is None:
+        with open(media, 'rb') as f:
+            content = f.read()
+    upload = io.BytesIO(content)
+    upload.name = filename or kind
+    message = method(chat_id=chat_id, **{kind: upload}, **kwargs)
+    sent = getattr(message, kind, None)
+    if isinstance(sent, list):
+        # Photos are sent in several sizes, the largest is last
+        sent = sent[-1] if sent else None
+    if sent is not None:
+        set_file_id(digest, kind, sent.file_id)
+        logging.info(f"Telegram file {filename} uploaded ({len(content)} bytes)")
+    return message
@@ -0,0 +1,149 @@
+import os
+import sys
+import logging
+import sqlite3
+import tempfile
+from time import perf_counter
+
+"""Versioned schema migrations of the SQLite database.
+Schema version is stored in PRAGMA user_version, every migration with a higher version
+is applied in a single transaction. Migrations must be idempotent and never drop data.
+A statement is SQL or a function called with the connection."""
+
+# Performance settings applied on every new connection
+PRAGMAS = ["PRAGMA journal_mode = WAL",
+           "PRAGMA synchronous = NORMAL",
+           "PRAGMA cache_size = -16000",  # 16MB
+           "PRAGMA temp_store = MEMORY"]
+
+def add_column(table, column, column_type):
+    """Migration statement adding a column if the table does not have it yet
+    (tables created by the model already have it)"""
+    def statement(connection):
+        columns = [row[1] for row in connection.execute(f"PRAGMA table_info({table})")]
+        if column not in columns:
+            connection.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+    return statement
+
+
+MIGRATIONS = [
+    (1, "Indexes on hot query paths", [
+        "CREATE INDEX IF NOT EXISTS ix_cubelist_cube_id_uid ON cubelist (cube_id, uid)",
+        "CREATE INDEX IF NOT EXISTS ix_cubelist_uid ON cubelist (uid)",
+        "CREATE INDEX IF NOT EXISTS ix_cubelist_card_id ON cubelist (card_id)",
+        "CREATE INDEX IF NOT EXISTS ix_card_name ON card (name)",
+        # Used by case insensitive LIKE 'prefix%'
+        "CREATE INDEX IF NOT EXISTS ix_card_name_nocase ON card (name COLLATE NOCASE)",
+        "CREATE INDEX IF NOT EXISTS ix_decklist_card_id ON decklist (card_id)",
+        "CREATE INDEX IF NOT EXISTS ix_deck_game_id ON deck (game_id, player_id)",
+        "CREATE INDEX IF NOT EXISTS ix_deck_player_id ON deck (player_id)",
+        "CREATE INDEX IF NOT EXISTS ix_token_name ON token (name, power, toughness, color)",
+        "CREATE INDEX IF NOT EXISTS ix_tokenlist_token_id ON tokenlist (token_id)",
+        "ANALYZE"]),
+    (2, "Metadata of processed signatures", [
+        add_column("cubelist", "signature_duration", "FLOAT"),
+        add_column("cubelist", "signature_source", "VARCHAR")]),
+]
+
+
+def set_pragmas(dbapi_connection, connection_record=None):
+    """Engine connect event listener"""
+    cursor = dbapi_connection.cursor()
+    for pragma in PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+
+
+def get_version(connection):
+    return connection.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(engine):
+    """Apply pending migrations, return the schema version"""
+    if engine.dialect.name != "sqlite":
+        logging.info(f"No migration for {engine.dialect.name} databases")
+        return None
+    with engine.begin() as connection:
+        version = get_version(connection)
+        for migration_version, description, statements in MIGRATIONS:
+            if migration_version <= version:
+                continue
+            logging.info(f"Apply migration {migration_version}: {description}")
+            for statement in statements:
+                if callable(statement):
+                    statement(connection)
+                else:
+                    connection.execute(statement)
+            connection.execute(f"PRAGMA user_version = {migration_version}")
+            version = migration_version
+    return version
+
+
+def fill_synthetic_db(path, cubes=10, cards=2000, games=500, players=50):
+    """Create a large database with the model schema and random looking data"""
+    from sqlalchemy import create_engine
+    from model import Base
+    engine = create_engine("sqlite:///" + path)
+    Base.metadata.create_all(engine)
+    engine.dispose()
+    db = sqlite3.connect(path)
+    n = cubes * cards
+    db.executemany("INSERT INTO cube (id, name) VALUES (?, ?)", [(i, f"Cube {i}") for i in range(cubes)])
+    db.executemany("INSERT INTO card (id, name, type_line) VALUES (?, ?, ?)",
+                   [(i, f"Card {i * 7919 % n:06d}", "Creature") for i in range(n)])
+    db.executemany("INSERT INTO cubelist (cube_id, card_id, uid) VALUES (?, ?, ?)",
+                   [(i // cards, i, i.to_bytes(7, "big")) for i in range(n)])
+    db.executemany("INSERT INTO token (id, name, power, toughness, color) VALUES (?, ?, ?, ?, ?)",
+                   [(i, f"Token {i % 500}", i % 5, i % 7, "G") for i in range(n // 4)])
+    db.executemany("INSERT INTO tokenlist (card_id, token_id) VALUES (?, ?)",
+                   [(i, i // 4) for i in range(n)])
+    db.executemany("INSERT INTO deck (id, player_id, game_id) VALUES (?, ?, ?)",
+                   [(i, i % players, i // 4) for i in range(games * 4)])
+    db.executemany("INSERT INTO decklist (deck_id, card_id) VALUES (?, ?)",
+                   [(d, (d * 45 + j) % n) for d in range(games * 4) for j in range(45)])
+    db.commit()
+    db.close()
+
+
+BENCHMARK_QUERIES = [
+    ("CubeList by uid", "SELECT * FROM cubelist WHERE cube_id = 3 AND uid = ?", ((6001).to_bytes(7, "big"),)),
+    ("Card by name", "SELECT * FROM card WHERE name = 'Card 001234'", ()),
+    ("Card by name prefix", "SELECT * FROM card WHERE name LIKE 'Card 0012%'", ()),
+    ("DeckList by card", "SELECT * FROM decklist WHERE card_id = 1234", ()),
+    ("Decks of a game", "SELECT * FROM deck WHERE game_id = 123", ()),
+    ("Last deck of a player", "SELECT * FROM deck WHERE player_id = 7 AND game_id != 123 "
+                              "ORDER BY id DESC LIMIT 1", ()),
+    ("Token by characteristics", "SELECT * FROM token WHERE name = 'Token 42' AND power = 2 "
+                                 "AND toughness = 0 AND color = 'G'", ()),
+    ("Scan in game", "SELECT * FROM cubelist JOIN decklist ON cubelist.card_id = decklist.card_id "
+                     "JOIN deck ON deck.id = decklist.deck_id WHERE deck.game_id = 123 "
+                     "AND cubelist.cube_id = 0 AND cubelist.uid = ?", ((180).to_bytes(7, "big"),))]
+
+
+def time_queries(path, repeat=20):
+    db = sqlite3.connect(path)
+    timings = {}
+    for name, query, params in BENCHMARK_QUERIES:
+        start = perf_counter()
+        for i in range(repeat):
+            db.execute(query, params).fetchall()
+        timings[name] = (perf_counter() - start) / repeat
+    db.close()
+    return timings
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                        level=logging.INFO)
+    # Usage: python migrations.py [cards per cube]
+    cards = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    from sqlalchemy import create_engine
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "synthetic.db")
+        fill_synthetic_db(path, cards=cards)
+        before = time_queries(path)
+        migrate(create_engine("sqlite:///" + path))
+        after = time_queries(path)
+    print(f"{'Query':<28}{'Before (ms)':>12}{'After (ms)':>12}{'Speedup':>10}")
+    for name in before:
+        print(f"{name:<28}{before[name]*1000:>12.3f}{after[name]*1000:>12.3f}{before[name]/after[name]:>9.1f}x")
@@ -2,15 +2,22 @@ import config
 import logging
 from datetime import datetime
 from deckstat_interface import load_deck
-from sqlalchemy import Column, Integer, String, Binary, Boolean, DateTime, create_engine
-from sqlalchemy.orm import sessionmaker, relationship, backref
+from sqlalchemy import Column, Integer, String, Binary, Boolean, DateTime, Float, create_engine, event
+from sqlalchemy.orm import sessionmaker, scoped_session, relationship, backref, object_session
+from sqlalchemy.pool import QueuePool
+from contextlib import contextmanager
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.hybrid import hybrid_method, hybrid_property
 from sqlalchemy.sql.schema import ForeignKey
-from collections import deque
+from collections import deque, namedtuple
 from random import shuffle
-engine = create_engine(config.db, connect_args={'check_same_thread': False})
+from migrations import set_pragmas, migrate
+# Connections are pooled and shared by threads, each thread has its own session
+engine = create_engine(config.db, poolclass=QueuePool, pool_size=5, max_overflow=10,
+                       connect_args={'check_same_thread': False})
+if engine.dialect.name == "sqlite":
+    event.listen(engine, "connect", set_pragmas)
 Base = declarative_base()
 
 class Card(Base):
@@ -37,6 +44,17 @@ class Card(Base):
                f"status={self.status}, tags={self.tags}, scryfall_id={self.scryfall_id}, "\
                f"image_url={self.image_url})>"
 
+
+# Plain copy of a card, still usable once the session which loaded it is closed
+CardInfo = namedtuple("CardInfo", ["id", "name", "set_code", "scryfall_id", "image_url"])
+
+
+def card_infos(query):
+    """Return CardInfo of the cards selected by a query on Card"""
+    columns = (Card.id, Card.name, Card.set_code, Card.scryfall_id, Card.image_url)
+    return [CardInfo(*row) for row in query.with_entities(*columns)]
+
+
 class Token(Base):
     
     __tablename__ = 'token'
@@ -93,6 +111,9 @@ class CubeList(Base):
     cube_id = Column(Integer, ForeignKey("cube.id"), primary_key=True)
     card_id = Column(Integer, ForeignKey("card.id"), primary_key=True)
     signature = Column(String)
+    # Set when signature was processed: duration in seconds, codec of the file sent
+    signature_duration = Column(Float)
+    signature_source = Column(String)
     uid = Column(Binary)
 
     cube = relationship(Cube)
@@ -102,6 +123,20 @@ class CubeList(Base):
         return f"<CubeList(cube_id={self.cube_id}, card_id={self.card_id}, "\
                f"signature={self.signature}, uid={self.uid})>"
 
+
+class TelegramFile(Base):
+    """file_id of a media already uploaded to Telegram, by content hash and kind of media"""
+
+    __tablename__ = "telegram_file"
+
+    hash = Column(String, primary_key=True)
+    kind = Column(String, primary_key=True)
+    file_id = Column(String)
+    date = Column(DateTime, default=datetime.now)
+
+    def __repr__(self):
+        return f"<TelegramFile(hash={self.hash}, kind={self.kind}, file_id={self.file_id})>"
+
     
 class Game(Base):
      
@@ -167,8 +202,6 @@ class Deck(Base):
 
     cards = association_proxy('cards', 'decklist')# relationship("DeckList")
     
-    deckstats = None
-    
     def set_is_winner(self, is_winner):
         self.is_winner = is_winner
 
@@ -201,13 +234,22 @@ class Deck(Base):
                 return True
         return False
 
+    @hybrid_method
+    def copy(self, game_id):
+        """Return a new deck with the same cards, for another game"""
+        deck = Deck(player_id=self.player_id, game_id=game_id, name=self.name, description=self.description)
+        for deck_card in self.cards:
+            DeckList(deck=deck, card=deck_card.card, amount=deck_card.amount, note=deck_card.note)
+        return deck
+
     @hybrid_method
     def load_deckstats_data(self, url):
+        """The deck must be in a session"""
         deckstats_deck = load_deck(url)
         if not deckstats_deck: return False
         errors = []
         for card in deckstats_deck["cards"]:
-            db_card = session.query(Card).join(CubeList).filter(Card.name == card.get("name", ""),
+            db_card = object_session(self).query(Card).join(CubeList).filter(Card.name == card.get("name", ""),
                                                                 CubeList.cube_id == self.game.cube_id).first()
             if db_card:
                 self.add_card(db_card, amount=card.get("amount", 1), note=card.get("comment",None))
@@ -270,8 +312,8 @@ class Draft(Base):
                 {"name": "Ukkima, Stalking Shadow", "partner": "Cazur, Ruthless Stalker"},
                 {"name": "Yannik, Scavenging Sentinel", "partner": "Nikara, Lair Scavenger"}]
 
-    def __init__(self, cube, round_num=5, booster_size=9, auto_pick_last_card=True):
-        self.cube = cube
+    def __init__(self, cube_id, round_num=5, booster_size=9, auto_pick_last_card=True):
+        self.cube_id = cube_id
         self.boosters = []
         self.booster_size = booster_size
         self.round_num = round_num
@@ -294,13 +336,20 @@ class Draft(Base):
             logging.info("No boosters loaded")
             return False
         logging.info("DRAFT STARTS")
-        session.add(self)
         self.round = self.get_round()
         self.state = "PLAY"
-        session.commit()
+        self.save()
         logging.info(self)
         return True
 
+    @hybrid_method
+    def save(self):
+        """Save the draft in a short lived session, the draft stays usable once it is closed"""
+        with session_scope() as s:
+            s.add(self)
+            s.flush()
+            s.expunge(self)
+
     @hybrid_method    
     def get_round(self):
         if self.round_count < self.round_num:
@@ -315,7 +364,7 @@ class Draft(Base):
         else:
             logging.info("DRAFT ENDS")
             self.state = "END"
-            session.commit()
+            self.save()
             return []
 
     @hybrid_method
@@ -332,8 +381,9 @@ class Draft(Base):
     @hybrid_method
     def control_choices(self):
         if all(drafter.choice for drafter in self.drafters):
-            for drafter in self.drafters:
-                drafter.pick()
+            choices = [drafter.pick() for drafter in self.drafters]
+            with session_scope() as s:
+                s.add_all(choice for choice in choices if choice)
             is_new_booster, is_new_round = self.rotate_boosters()
             # Auto pick last card
             if self.auto_pick_last_card:
@@ -389,27 +439,29 @@ class Drafter:
         self.pick_count = 1
         
     def choose(self, card):
+        """card: CardInfo of the current booster"""
         if card in self.get_booster().cards:
-            self.choice = Choice(self, card, self.draft.round_count, self.pick_count)
+            self.choice = card
             return self.draft.control_choices()
         
     def pick(self):
+        """Move chosen card to the pool, return the Choice to save"""
         booster = self.get_booster()
         if self.choice and booster:
-            logging.info(self.choice)
-            self.choice.booster_id = booster.id
-            session.add(self.choice)
+            choice = Choice(self, self.choice, self.draft.round_count, self.pick_count)
+            choice.booster_id = booster.id
+            logging.info(choice)
             booster.from_drafter = self
-            session.commit()
-            booster.remove_card(self.choice.card)
+            booster.remove_card(self.choice)
             # Control if partner with TODO : Wrapper
             for partner in self.draft.partners:
-                if self.choice.card.name == partner["name"]:
-                    self.pool.append(session.query(Card).filter(Card.name == partner["partner"]).first())
-            self.pool.append(self.choice.card)
+                if self.choice.name == partner["name"]:
+                    with session_scope() as s:
+                        self.pool += card_infos(s.query(Card).filter(Card.name == partner["partner"]).limit(1))
+            self.pool.append(self.choice)
             self.choice = None
             self.pick_count += 1
-            return True
+            return choice
     
     def get_booster(self):
         i = self.draft.drafters.index(self)
@@ -436,15 +488,14 @@ class Choice(Base):
     
     
     def __init__(self, drafter, card, round_count, pick_count):
-        self.drafter = drafter
-        self.drafter_id = self.drafter.id
-        self.draft = drafter.draft
-        self.card = card
+        self.drafter_id = drafter.id
+        self.draft_id = drafter.draft.id
+        self.card_id = card.id
         self.round_count = round_count
         self.pick_count = pick_count
         
     def __repr__(self):
-        return f"<Choice(drafter={self.drafter}, card={self.card}, round_count={self.round_count}, "\
+        return f"<Choice(drafter_id={self.drafter_id}, card_id={self.card_id}, round_count={self.round_count}, "\
                f"pick_count={self.pick_count})>"
             
             
@@ -465,5 +516,24 @@ class Booster:
         
     
 Base.metadata.create_all(engine)
+migrate(engine)
 DBSession = sessionmaker(bind=engine)
-session = DBSession()
+# Thread local session: handlers running on the dispatcher thread share the same session
+# while NFC callbacks and async workers get their own
+Session = scoped_session(DBSession)
+session = Session
+
+
+@contextmanager
+def session_scope():
+    """Short lived session for a unit of work, committed at the end and closed.
+    Objects loaded in this session must not be used outside of the block"""
+    s = DBSession()
+    try:
+        yield s
+        s.commit()
+    except:
+        s.rollback()
+        raise
+    finally:
+        s.close()
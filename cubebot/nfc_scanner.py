@@ -1,41 +1,225 @@
+import sys
+import queue
 import logging
-from pn532 import PN532_SPI
+import threading
+from time import monotonic, thread_time, sleep
+from collections import namedtuple
+from pn532 import PN532_SPI, PN532_Emulator
+from pn532.emulator import Trace
+import config
+
+ScanEvent = namedtuple("ScanEvent", ["uid", "timestamp"])
+
+
+def get_pn532(debug=False, reset=20, cs=4, emulated_uids=None):
+    """PN532 on the SPI bus, or an emulator when config.nfc_emulator is set (runs without
+    the NFC hat). The emulator presents the uids returned by emulated_uids(), random ones if None"""
+    if not getattr(config, "nfc_emulator", False):
+        if PN532_SPI is None:
+            raise RuntimeError("PN532 SPI transport is not available (spidev and RPi.GPIO could not be imported), "
+                               "set nfc_emulator = True in config.py to run without the NFC hat")
+        return PN532_SPI(debug=debug, reset=reset, cs=cs, irq=getattr(config, "nfc_irq", None),
+                         fast=getattr(config, "nfc_fast_spi", False))
+    uids = emulated_uids() if emulated_uids else None
+    logging.info(f"Using PN532 emulator with {len(uids) if uids else 'random'} tags")
+    return PN532_Emulator(trace=Trace.random(1000, uids=uids or None), debug=debug)
+
+
+class ScanRun:
+    """State of one start() to stop() run: its own stop flag, event queue and debounce,
+    so threads of a stopping run never see scans of the next one"""
+
+    def __init__(self, queue_size):
+        self.stopped = threading.Event()
+        self.events = queue.Queue(maxsize=queue_size)
+        self.last_seen = {}
 
 
 class NFC_Scanner():
+    """Read tags on a dedicated thread and publish ScanEvent to a bounded queue.
+    Callbacks run one at a time on another thread so they never stall tag polling.
+    Callbacks must not use the thread local model.session (use session_scope)."""
 
-    is_on = False
     debug = False
     timeout = 0.1
     reset = 20
     cs = 4
+    # Reads of the same uid are ignored until the tag has been away for this long (seconds)
+    debounce = 1.0
+    queue_size = 32
+    # "list": one InListPassiveTarget per timeout, "autopoll": the PN532 polls by itself
+    # and the host only wakes up when a tag is found
+    mode = getattr(config, "nfc_scan_mode", "list")
+    autopoll_timeout = 1.0
+    # Tags read per RF cycle in "list" mode, the PN532 handles up to 2
+    max_targets = 1
     pn532 = None
 
-    def __init__(self):
-        self.pn532 = PN532_SPI(debug=self.debug, reset=self.reset, cs=self.cs)
+    def __init__(self, pn532=None, emulated_uids=None):
+        self.pn532 = pn532 or get_pn532(debug=self.debug, reset=self.reset, cs=self.cs,
+                                        emulated_uids=emulated_uids)
         self.pn532.SAM_configuration()
+        # Readers of a stopping and a new run take turns, pn532 frames are not thread safe
+        self.pn532_lock = threading.Lock()
+        self.callbacks = []
+        self.lock = threading.Lock()
+        self.run = None
+        # Counters
+        self.reads = 0
+        self.debounced = 0
+        self.dropped = 0
+        self.reader_cpu = 0.0
+        self.reader_time = 0.0
 
-    def start(self, behaviour, *args, **kwargs):
-        self.is_on = True
+    @property
+    def is_on(self):
+        return self.run is not None and not self.run.stopped.is_set()
+
+    def register(self, behaviour, *args, **kwargs):
+        """Call behaviour(uid, *args, **kwargs) for each scanned tag"""
+        with self.lock:
+            self.callbacks.append((behaviour, args, kwargs))
+
+    def unregister(self, behaviour=None):
+        """Remove callbacks of behaviour, or all callbacks"""
+        with self.lock:
+            self.callbacks = [c for c in self.callbacks if behaviour is not None and c[0] != behaviour]
+
+    def start(self, behaviour=None, *args, **kwargs):
+        """Start scanning in background, replacing callbacks with behaviour if given.
+        Does nothing if scanner is already on. Never waits for a stopping run"""
+        with self.lock:
+            if behaviour:
+                self.callbacks = [(behaviour, args, kwargs)]
+            if self.is_on:
+                return
+            run = self.run = ScanRun(self.queue_size)
+        threading.Thread(target=self.read_loop, args=(run,), name="nfc-reader", daemon=True).start()
+        threading.Thread(target=self.dispatch_loop, args=(run,), name="nfc-callbacks", daemon=True).start()
         logging.info("NFC_Scanner turned ON")
-        while self.is_on:
-            uid = None
-            try:
-                uid = self.pn532.read_passive_target(timeout=self.timeout)
-            except RuntimeError as e:
-                logging.exception(e)
-            if uid is None:
-                continue
-            behaviour(uid, *args, **kwargs)
 
     def stop(self):
-        self.is_on = False
+        """Stop scanning and remove callbacks, without waiting for threads to end"""
+        with self.lock:
+            self.callbacks = []
+            if not self.is_on:
+                return
+            self.run.stopped.set()
         logging.info("NFC_Scanner turned OFF")
 
+    def read(self):
+        if self.mode == "autopoll":
+            return self.pn532.auto_poll(timeout=self.autopoll_timeout)
+        elif self.max_targets > 1:
+            return self.pn532.read_passive_targets(self.max_targets, timeout=self.timeout)
+        uid = self.pn532.read_passive_target(timeout=self.timeout)
+        return [uid] if uid is not None else None
+
+    def read_loop(self, run):
+        start, cpu = monotonic(), thread_time()
+        while not run.stopped.is_set():
+            uids, failed = None, False
+            with self.pn532_lock:
+                if run.stopped.is_set():
+                    break
+                try:
+                    uids = self.read()
+                except Exception as e:
+                    # e.g. invalid frame or SPI error, keep polling
+                    logging.exception(e)
+                    failed = True
+            if failed:
+                run.stopped.wait(self.timeout)
+            if not uids:
+                continue
+            timestamp = monotonic()
+            for uid in uids:
+                self.publish(run, bytes(uid), timestamp)
+        self.reader_cpu += thread_time() - cpu
+        self.reader_time += monotonic() - start
+
+    def publish(self, run, uid, timestamp):
+        self.reads += 1
+        last = run.last_seen.get(uid, None)
+        run.last_seen[uid] = timestamp
+        if last is not None and timestamp - last < self.debounce:
+            # Same tag still on the reader
+            self.debounced += 1
+            return
+        try:
+            run.events.put_nowait(ScanEvent(uid, timestamp))
+        except queue.Full:
+            # Keep the most recent scans
+            self.dropped += 1
+            try:
+                run.events.get_nowait()
+            except queue.Empty:
+                pass
+            run.events.put_nowait(ScanEvent(uid, timestamp))
+
+    def dispatch_loop(self, run):
+        while not run.stopped.is_set():
+            try:
+                event = run.events.get(timeout=self.timeout)
+            except queue.Empty:
+                continue
+            with self.lock:
+                if run is not self.run:
+                    return
+                callbacks = list(self.callbacks)
+            for behaviour, args, kwargs in callbacks:
+                try:
+                    behaviour(event.uid, *args, **kwargs)
+                except Exception as e:
+                    logging.exception(e)
+
+    def stats(self):
+        """Counters, host CPU use of the reader thread is known once a run has stopped"""
+        return {"reads": self.reads,
+                "debounced": self.debounced,
+                "dropped": self.dropped,
+                "queued": self.run.events.qsize() if self.run else 0,
+                "reader_cpu": self.reader_cpu,
+                "reader_cpu_percent": 100 * self.reader_cpu / self.reader_time if self.reader_time else 0.0}
+
+
+def compare_modes(count=30, speed=5.0, seed=1):
+    """Detection latency and reader CPU use of each scanning mode on the same emulated trace"""
+    for mode in ("list", "autopoll"):
+        trace = Trace.random(count, seed=seed)
+        pn532 = PN532_Emulator(trace=trace, speed=speed)
+        scanner = NFC_Scanner(pn532)
+        scanner.mode = mode
+        latencies = []
+        def detected(uid):
+            t = pn532.clock()
+            presentation = next((p for p in trace.presentations if p.uid == uid and p.start <= t), None)
+            if presentation:
+                latencies.append(t - presentation.start)
+        scanner.start(detected)
+        sleep(trace.end / speed + 0.5)
+        scanner.stop()
+        sleep(max(scanner.timeout, scanner.autopoll_timeout) + 0.1)
+        stats = scanner.stats()
+        latencies.sort()
+        median = latencies[len(latencies)//2] * 1000 if latencies else float("nan")
+        print(f"{mode:<9} {len(latencies)}/{count} detected, latency median {median:.0f}ms "
+              f"max {latencies[-1]*1000 if latencies else float('nan'):.0f}ms, "
+              f"{pn532.frames_in} commands, reader CPU {stats['reader_cpu_percent']:.1f}%")
+
+
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    if sys.argv[1:] == ["compare"]:
+        compare_modes()
+        sys.exit()
     scan = NFC_Scanner()
+    if sys.argv[1:] == ["autopoll"]:
+        scan.mode = "autopoll"
     def hello(uid, ok):
         logging.info(f"test uid = [{uid}] {ok}")
 
     scan.start(hello, ["test1", "test2"])
-
+    input("Scanning, press Enter to stop...\n")
+    scan.stop()
+    logging.info(scan.stats())
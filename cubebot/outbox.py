@@ -0,0 +1,319 @@
+import logging
+import itertools
+import threading
+from collections import deque
+from concurrent.futures import Future
+from time import monotonic
+from telegram import Bot
+from telegram.error import RetryAfter, BadRequest
+from ratelimit import TokenBucket
+
+"""Outgoing Telegram messages are sent by a scheduler which keeps the bot inside Telegram limits:
+30 messages per second overall, about 1 per second in a private chat and 20 per minute in a group.
+Messages of a chat are sent in order, chats are served by message priority then age."""
+
+# Priorities, lower is sent first
+DRAFT = 0
+DEFAULT = 1
+NOTIFICATION = 2
+
+GLOBAL_RATE = 30
+PRIVATE_RATE = 1.0
+GROUP_RATE = 20 / 60
+BURST = 3
+MAX_RETRIES = 3
+EDIT_INTERVAL = 1.0     # seconds between two edits of a MessageEditor
+
+
+class Job:
+
+    def __init__(self, priority, number, function, args, kwargs):
+        self.priority = priority
+        self.number = number
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+        self.created = monotonic()
+        self.retries = 0
+
+    @property
+    def order(self):
+        return (self.priority, self.number)
+
+
+class ChatQueue:
+    """Messages waiting for a chat and rate limit of the chat"""
+
+    def __init__(self, chat_id):
+        # Group ids are negative
+        is_group = isinstance(chat_id, int) and chat_id < 0
+        self.bucket = TokenBucket(GROUP_RATE if is_group else PRIVATE_RATE, BURST)
+        self.jobs = deque()
+        self.busy = False
+        self.blocked_until = 0.0
+
+
+class Outbox:
+    """Send messages with bot methods on worker threads, within global and per chat rate limits"""
+
+    def __init__(self, workers=1, rate=GLOBAL_RATE):
+        self.bucket = TokenBucket(rate)
+        self.chats = {}
+        self.condition = threading.Condition()
+        self.numbers = itertools.count()
+        # Counters
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.max_queued = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        for i in range(workers):
+            threading.Thread(target=self.work, name=f"outbox-{i}", daemon=True).start()
+
+    def submit(self, chat, priority, function, *args, **kwargs):
+        """Queue function(*args, **kwargs) for a chat id, return a Future of its result"""
+        job = Job(priority, next(self.numbers), function, args, kwargs)
+        with self.condition:
+            queue = self.chats.get(chat, None)
+            if queue is None:
+                queue = self.chats[chat] = ChatQueue(chat)
+            queue.jobs.append(job)
+            self.max_queued = max(self.max_queued, self.queued)
+            self.condition.notify()
+        return job.future
+
+    @property
+    def queued(self):
+        return sum(len(chat.jobs) for chat in self.chats.values())
+
+    def next_job(self):
+        """Wait for the first job which can be sent now, condition must be held"""
+        while True:
+            now = monotonic()
+            best, wait = None, None
+            for chat in self.chats.values():
+                if chat.busy or not chat.jobs:
+                    continue
+                ready = max(chat.blocked_until - now, chat.bucket.delay())
+                if ready > 0:
+                    wait = ready if wait is None else min(wait, ready)
+                elif best is None or chat.jobs[0].order < best.jobs[0].order:
+                    best = chat
+            if best is not None:
+                ready = self.bucket.delay()
+                if ready <= 0:
+                    self.bucket.reserve()
+                    best.bucket.reserve()
+                    best.busy = True
+                    return best, best.jobs.popleft()
+                wait = ready if wait is None else min(wait, ready)
+            self.condition.wait(wait)
+
+    def work(self):
+        while True:
+            with self.condition:
+                chat, job = self.next_job()
+            try:
+                result = job.function(*job.args, **job.kwargs)
+            except RetryAfter as e:
+                logging.info(f"Outbox: flood control, retry in {e.retry_after}s")
+                with self.condition:
+                    chat.blocked_until = monotonic() + e.retry_after
+                    if job.retries < MAX_RETRIES:
+                        job.retries += 1
+                        self.retried += 1
+                        chat.jobs.appendleft(job)
+                        job = None
+                if job is not None:
+                    self.fail(job, e)
+            except BadRequest as e:
+                # e.g. edit with an unchanged text
+                logging.info(f"Outbox: {e}")
+                self.fail(job, e)
+            except Exception as e:
+                logging.exception(e)
+                self.fail(job, e)
+            else:
+                latency = monotonic() - job.created
+                with self.condition:
+                    self.sent += 1
+                    self.total_latency += latency
+                    self.max_latency = max(self.max_latency, latency)
+                job.future.set_result(result)
+                if self.sent % 100 == 0:
+                    logging.info(f"Outbox stats: {self.stats()}")
+            with self.condition:
+                chat.busy = False
+                self.condition.notify_all()
+
+    def fail(self, job, error):
+        with self.condition:
+            self.failed += 1
+        job.future.set_exception(error)
+
+    def stats(self):
+        with self.condition:
+            return {"queued": self.queued,
+                    "max_queued": self.max_queued,
+                    "sent": self.sent,
+                    "failed": self.failed,
+                    "retried": self.retried,
+                    "mean_latency": self.total_latency / self.sent if self.sent else 0.0,
+                    "max_latency": self.max_latency}
+
+
+class QueuedBot(Bot):
+    """Bot whose send_message and edit_message_text go through an Outbox and return a Future
+    of the message. The priority keyword sets the priority of a message"""
+
+    def __init__(self, *args, outbox_workers=1, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.outbox = Outbox(workers=outbox_workers)
+
+    def send_message(self, chat_id, *args, priority=DEFAULT, **kwargs):
+        return self.outbox.submit(chat_id, priority, super().send_message, chat_id, *args, **kwargs)
+
+    def edit_message_text(self, *args, priority=DEFAULT, **kwargs):
+        chat_id = kwargs.get("chat_id", args[1] if len(args) > 1 else None)
+        return self.outbox.submit(chat_id, priority, super().edit_message_text, *args, **kwargs)
+
+    def edit_message_text_now(self, *args, **kwargs):
+        """Edit without queuing, for jobs already running in the outbox"""
+        return super().edit_message_text(*args, **kwargs)
+
+    # camelCase aliases
+    sendMessage = send_message
+    editMessageText = edit_message_text
+
+
+class MessageEditor:
+    """Keep a message of a QueuedBot showing the latest text given to update().
+    Updates are coalesced into at most one edit per interval, identical edits are skipped
+    and update() never waits for Telegram"""
+
+    def __init__(self, bot, chat_id, message_id, interval=EDIT_INTERVAL, priority=DEFAULT):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.interval = interval
+        self.priority = priority
+        self.lock = threading.Lock()
+        self.latest = None
+        # State shown by the message, and state of the edit being sent
+        self.shown = None
+        self.sending = None
+        # An edit is waiting for its time or is in the outbox
+        self.pending = False
+        self.closed = False
+        self.next_edit = 0.0
+        # Counters
+        self.updates = 0
+        self.edits = 0
+
+    @staticmethod
+    def key(text, reply_markup):
+        return text, reply_markup.to_dict() if reply_markup is not None else None
+
+    def update(self, text, reply_markup=None):
+        """Show text and reply_markup with the next edit"""
+        with self.lock:
+            if self.closed:
+                return
+            self.updates += 1
+            self.latest = (text, reply_markup)
+            if self.pending:
+                return
+            self.pending = True
+            delay = self.next_edit - monotonic()
+        self.schedule(delay)
+
+    def close(self):
+        """Drop edits not sent yet, e.g. before the message is edited by someone else"""
+        with self.lock:
+            self.closed = True
+
+    def schedule(self, delay):
+        if delay > 0:
+            timer = threading.Timer(delay, self.submit)
+            timer.daemon = True
+            timer.start()
+        else:
+            self.submit()
+
+    def submit(self):
+        self.bot.outbox.submit(self.chat_id, self.priority, self.edit).add_done_callback(self.edited)
+
+    def edit(self):
+        """Runs on an outbox worker: edit the message with the state of now"""
+        with self.lock:
+            self.sending = None
+            if self.closed or self.latest is None:
+                return None
+            text, reply_markup = self.latest
+            key = self.key(text, reply_markup)
+            if key == self.shown:
+                return None
+            # Shown once sent: an edit retried after flood control is sent again
+            self.sending = key
+            self.edits += 1
+        return self.bot.edit_message_text_now(chat_id=self.chat_id, message_id=self.message_id,
+                                              text=text, reply_markup=reply_markup)
+
+    def edited(self, future):
+        """Schedule the next edit if the state changed while this one was sent,
+        or if it failed (flood control retries exhausted, network error)"""
+        with self.lock:
+            error = future.exception()
+            # BadRequest is final, e.g. "message is not modified"
+            if self.sending is not None and (error is None or isinstance(error, BadRequest)):
+                self.shown = self.sending
+            self.sending = None
+            self.next_edit = monotonic() + self.interval
+            if self.closed or self.key(*self.latest) == self.shown:
+                self.pending = False
+                return
+        self.schedule(self.interval)
+
+
+if __name__ == "__main__":
+    # Regression check of MessageEditor under flood control: python outbox.py
+    import time
+
+    class FloodedBot(QueuedBot):
+        """Bot whose first edits get RetryAfter, then records the texts shown"""
+
+        def __init__(self, floods):
+            super().__init__("123:check")
+            self.floods = floods
+            self.shown = []
+
+        def edit_message_text_now(self, text, **kwargs):
+            if self.floods:
+                self.floods -= 1
+                raise RetryAfter(0.2)
+            self.shown.append(text)
+            return text
+
+    def wait_shown(text, timeout=10):
+        """The chat rate limit spaces edits, wait for text to be shown"""
+        end = time.monotonic() + timeout
+        while time.monotonic() < end and (not bot.shown or bot.shown[-1] != text):
+            time.sleep(0.05)
+        assert bot.shown and bot.shown[-1] == text, bot.shown
+
+    bot = FloodedBot(floods=1)
+    editor = MessageEditor(bot, 1, 1, interval=0.1)
+    editor.update("1 card")
+    wait_shown("1 card")
+    # Same state again is not sent twice, a new one is
+    editor.update("1 card")
+    editor.update("2 cards")
+    wait_shown("2 cards")
+    assert bot.shown == ["1 card", "2 cards"], bot.shown
+    # Retries exhausted: the state is sent again at the next interval
+    bot.floods = MAX_RETRIES + 1
+    editor.update("3 cards")
+    wait_shown("3 cards")
+    print(f"MessageEditor ok, outbox {bot.outbox.stats()}")
@@ -3,11 +3,24 @@ __all__ = [
     'i2c',
     'spi',
     'uart',
+    'emulator',
     'PN532_I2C',
     'PN532_SPI',
-    'PN532_UART'
+    'PN532_UART',
+    'PN532_Emulator'
 ]
 from . import pn532
-from .i2c import PN532_I2C
-from .spi import PN532_SPI
-from .uart import PN532_UART
+from .emulator import PN532_Emulator
+# Hardware transports need RPi.GPIO and their bus library
+try:
+    from .i2c import PN532_I2C
+except ImportError:
+    PN532_I2C = None
+try:
+    from .spi import PN532_SPI
+except ImportError:
+    PN532_SPI = None
+try:
+    from .uart import PN532_UART
+except ImportError:
+    PN532_UART = None
@@ -0,0 +1,106 @@
+"""
+PN532 normal information frames, encoded in a preallocated buffer and decoded
+with a single pass over the response. Frames of the fixed commands sent on
+every poll are precomputed once.
+"""
+
+from .pn532 import _PREAMBLE, _STARTCODE1, _STARTCODE2, _POSTAMBLE, _HOSTTOPN532, \
+                   _COMMAND_GETFIRMWAREVERSION, _COMMAND_SAMCONFIGURATION, \
+                   _COMMAND_INLISTPASSIVETARGET, _MIFARE_ISO14443A
+
+# Largest normal frame: 255 bytes of data and 7 bytes of framing
+_MAX_FRAME = 262
+
+
+def encode(command, params=()):
+    """Return a new frame for the command and its parameters"""
+    length = len(params) + 2
+    checksum = _HOSTTOPN532 + command + sum(params)
+    return bytes([_PREAMBLE, _STARTCODE1, _STARTCODE2, length, (-length) & 0xFF,
+                  _HOSTTOPN532, command]) + bytes(params) + bytes([(-checksum) & 0xFF, _POSTAMBLE])
+
+
+# (command, params): frame of the commands sent with constant parameters
+FIXED_FRAMES = {
+    (_COMMAND_GETFIRMWAREVERSION, ()): None,
+    (_COMMAND_SAMCONFIGURATION, (0x01, 0x14, 0x01)): None,
+    (_COMMAND_INLISTPASSIVETARGET, (0x01, _MIFARE_ISO14443A)): None,
+    (_COMMAND_INLISTPASSIVETARGET, (0x02, _MIFARE_ISO14443A)): None,
+}
+for _key in FIXED_FRAMES:
+    FIXED_FRAMES[_key] = encode(*_key)
+
+
+class FrameCodec:
+    """Encoder and decoder of one PN532, not thread safe (frames share a buffer)"""
+
+    def __init__(self):
+        self._buffer = bytearray(_MAX_FRAME)
+        self._view = memoryview(self._buffer)
+        self._buffer[0:3] = bytes([_PREAMBLE, _STARTCODE1, _STARTCODE2])
+        self._buffer[5] = _HOSTTOPN532
+
+    def encode(self, command, params=()):
+        """Return the frame of a command: a precomputed bytes object for fixed commands,
+        else a memoryview of the shared buffer valid until the next call"""
+        frame = FIXED_FRAMES.get((command, tuple(params)), None)
+        if frame is not None:
+            return frame
+        assert len(params) < 254, 'Data must be array of 1 to 255 bytes.'
+        length = len(params) + 2
+        buffer = self._buffer
+        buffer[3] = length
+        buffer[4] = (-length) & 0xFF
+        buffer[6] = command
+        buffer[7:7+len(params)] = bytes(params)
+        end = 5 + length
+        buffer[end] = (-(_HOSTTOPN532 + command + sum(params))) & 0xFF
+        buffer[end+1] = _POSTAMBLE
+        return self._view[:end+2]
+
+    @staticmethod
+    def decode(response):
+        """Return the data of a response frame.
+        Raises RuntimeError if the frame is invalid"""
+        # Swallow all the 0x00 values that preceed 0xFF.
+        offset = 0
+        length = len(response)
+        while offset < length and response[offset] == 0x00:
+            offset += 1
+        if offset >= length or response[offset] != 0xFF:
+            raise RuntimeError('Response frame preamble does not contain 0x00FF!')
+        offset += 1
+        if offset + 1 >= length:
+            raise RuntimeError('Response contains no data!')
+        # Check length & length checksum match.
+        frame_len = response[offset]
+        if (frame_len + response[offset+1]) & 0xFF != 0:
+            raise RuntimeError('Response length checksum did not match length!')
+        # Check frame checksum value matches bytes.
+        checksum = sum(response[offset+2:offset+3+frame_len]) & 0xFF
+        if checksum != 0:
+            raise RuntimeError('Response checksum did not match expected value: ', checksum)
+        # A copy of a frame this small is cheaper than a memoryview in CPython
+        return response[offset+2:offset+2+frame_len]
+
+
+if __name__ == "__main__":
+    # Microbenchmark: python -m pn532.codec
+    from timeit import timeit
+    from .pn532 import _COMMAND_INDATAEXCHANGE, MIFARE_CMD_READ
+    from .emulator import build_frame
+    codec = FrameCodec()
+    # Response to InListPassiveTarget with a 7 bytes uid, as read with response_length=19
+    response = bytearray(build_frame(b'\xD5\x4B\x01\x01\x00\x44\x00\x07\x04\xA1\xB2\xC3\xD4\xE5\xF6'))
+    response += bytes(28 - len(response))
+    n = 200000
+    benchmarks = [
+        ("Encode InListPassiveTarget (fixed)",
+         lambda: codec.encode(_COMMAND_INLISTPASSIVETARGET, (0x01, _MIFARE_ISO14443A))),
+        ("Encode InDataExchange READ",
+         lambda: codec.encode(_COMMAND_INDATAEXCHANGE, (0x01, MIFARE_CMD_READ, 4))),
+        ("Decode InListPassiveTarget response", lambda: codec.decode(response)),
+    ]
+    for name, function in benchmarks:
+        elapsed = timeit(function, number=n)
+        print(f"{name:<38}{n/elapsed/1000:>8.0f}k frames/s")
@@ -0,0 +1,364 @@
+"""
+Software PN532 speaking the frame protocol of the real chip (ACK, length and data
+checksums, InListPassiveTarget, MIFARE/NTAG read and write through InDataExchange).
+Tags are presented to the reader following a scripted or random trace with
+realistic timings, so the scanning code can run and be benchmarked without hardware.
+"""
+
+import time
+import random
+from collections import deque, namedtuple
+from .pn532 import PN532, _ACK, _HOSTTOPN532, _PN532TOHOST, \
+                   _COMMAND_GETFIRMWAREVERSION, _COMMAND_SAMCONFIGURATION, \
+                   _COMMAND_INLISTPASSIVETARGET, _COMMAND_INDATAEXCHANGE, _COMMAND_INAUTOPOLL, \
+                   AUTOPOLL_ENDLESS, AUTOPOLL_GENERIC_106, AUTOPOLL_MIFARE, AUTOPOLL_ISO14443_4A, \
+                   _COMMAND_READGPIO, _COMMAND_WRITEGPIO, \
+                   MIFARE_CMD_AUTH_A, MIFARE_CMD_AUTH_B, MIFARE_CMD_READ, \
+                   MIFARE_CMD_WRITE, MIFARE_ULTRALIGHT_CMD_WRITE
+
+# Error frame sent for unknown commands
+_ERROR_FRAME = b'\x00\x00\xFF\x01\xFF\x7F\x81\x00'
+_FIRMWARE_VERSION = b'\x32\x01\x06\x07'
+
+# Status codes of InDataExchange
+_STATUS_OK = 0x00
+_STATUS_TIMEOUT = 0x01
+_STATUS_MIFARE_AUTH = 0x14
+_STATUS_INVAL = 0x10
+
+# Timings of the chip in seconds
+ACK_DELAY = 0.0008
+BYTE_TIME = 0.000008    # 1MHz SPI clock
+COMMAND_TIME = {
+    _COMMAND_GETFIRMWAREVERSION: 0.001,
+    _COMMAND_SAMCONFIGURATION: 0.001,
+    _COMMAND_INLISTPASSIVETARGET: 0.0025,  # anticollision and select, per target
+    _COMMAND_INDATAEXCHANGE: 0.003,
+    _COMMAND_READGPIO: 0.001,
+    _COMMAND_WRITEGPIO: 0.001,
+}
+WRITE_TIME = 0.005      # EEPROM write of a tag
+AUTOPOLL_PERIOD = 0.15  # Unit of the InAutoPoll period
+
+
+def build_frame(data):
+    """Return a normal information frame around data"""
+    length = len(data)
+    return bytes([0x00, 0x00, 0xFF, length, (-length) & 0xFF]) + bytes(data) \
+           + bytes([(-sum(data)) & 0xFF, 0x00])
+
+
+def parse_frame(frame):
+    """Return data of a host frame or None if the frame is invalid"""
+    start = bytes(frame).find(b'\x00\xFF')
+    if start < 0 or start + 4 > len(frame):
+        return None
+    length, lcs = frame[start+2], frame[start+3]
+    if (length + lcs) & 0xFF or start + 5 + length > len(frame):
+        return None
+    data = frame[start+4:start+4+length]
+    if (sum(data) + frame[start+4+length]) & 0xFF:
+        return None
+    return bytes(data)
+
+
+Presentation = namedtuple("Presentation", ["uid", "start", "duration"])
+
+
+class Trace:
+    """Tags presented to the reader: uid, start time and duration in seconds"""
+
+    def __init__(self, presentations):
+        self.presentations = sorted((Presentation(bytes(uid), start, duration)
+                                     for uid, start, duration in presentations),
+                                    key=lambda p: p.start)
+
+    @classmethod
+    def random(cls, count, uids=None, gap=(0.3, 1.5), hold=(0.2, 0.8), uid_length=7, seed=None, group=1):
+        """Tags presented one after the other like a player scanning a deck, group
+        tags at a time. Uids are taken from uids (in a random order) or generated"""
+        rng = random.Random(seed)
+        if uids is None:
+            uids = [bytes([0x04] + [rng.randrange(256) for i in range(uid_length-1)]) for i in range(count)]
+        uids = list(uids)
+        rng.shuffle(uids)
+        presentations, t = [], 0.0
+        for i in range(0, count, group):
+            t += rng.uniform(*gap)
+            duration = rng.uniform(*hold)
+            for j in range(i, min(i + group, count)):
+                presentations.append((uids[j % len(uids)], t, duration))
+            t += duration
+        return cls(presentations)
+
+    def present(self, t):
+        """Presentations on the reader at time t"""
+        return [p for p in self.presentations if p.start <= t < p.start + p.duration]
+
+    def next_start(self, t):
+        """Time of the first presentation on the reader at t or after, None if trace is over"""
+        present = self.present(t)
+        if present:
+            return t
+        return next((p.start for p in self.presentations if p.start > t), None)
+
+    @property
+    def end(self):
+        return max((p.start + p.duration for p in self.presentations), default=0.0)
+
+    def __len__(self):
+        return len(self.presentations)
+
+
+class Tag:
+    """NTAG2xx memory (7 bytes uid, 4 bytes pages) or MIFARE Classic 1K (4 bytes uid, 16 bytes blocks)"""
+
+    def __init__(self, uid, key=b'\xFF' * 6):
+        self.uid = bytes(uid)
+        self.is_classic = len(self.uid) == 4
+        self.memory = bytearray(64 * 16 if self.is_classic else 135 * 4)
+        self.key = key
+        self.authenticated = set()
+
+    @property
+    def sens_res(self):
+        return b'\x00\x04' if self.is_classic else b'\x00\x44'
+
+    @property
+    def sel_res(self):
+        return 0x08 if self.is_classic else 0x00
+
+    def read(self, block):
+        if self.is_classic:
+            if block // 4 not in self.authenticated:
+                return None
+            return bytes(self.memory[block*16:block*16+16])
+        # NTAG returns 4 pages, rolling over at the end of memory
+        data = self.memory[block*4:block*4+16]
+        return bytes(data + self.memory[:16-len(data)])
+
+    def write(self, block, data):
+        if self.is_classic:
+            if block // 4 not in self.authenticated:
+                return False
+            self.memory[block*16:block*16+16] = data
+        else:
+            # Compatibility write of NTAG only writes the first 4 bytes
+            self.memory[block*4:block*4+4] = data[:4]
+        return True
+
+
+class PN532_Emulator(PN532):
+    """PN532 transport answering like the chip to frames written by the driver.
+    speed > 1 runs faster than real time (timings and trace are scaled)"""
+
+    def __init__(self, trace=None, tags=None, speed=1.0, debug=False):
+        self.trace = trace or Trace([])
+        self.tags = tags or {}
+        self.speed = speed
+        self.output = deque()   # (ready time, bytes)
+        self.selected = []
+        self.awake = False
+        self.t0 = time.monotonic()
+        # Counters
+        self.frames_in = 0
+        self.frames_out = 0
+        self.checksum_errors = 0
+        super().__init__(debug=debug)
+
+    def clock(self):
+        """Emulated time in seconds since start"""
+        return (time.monotonic() - self.t0) * self.speed
+
+    def _sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds / self.speed)
+
+    def get_tag(self, uid):
+        if uid not in self.tags:
+            self.tags[uid] = Tag(uid)
+        return self.tags[uid]
+
+    def _gpio_init(self, **kwargs):
+        pass
+
+    def _reset(self, pin):
+        self.output.clear()
+        self.awake = False
+
+    def _wakeup(self):
+        self.awake = True
+
+    def _write_data(self, framebytes):
+        self._sleep(len(framebytes) * BYTE_TIME)
+        # A new command aborts the previous one
+        self.output.clear()
+        data = parse_frame(framebytes)
+        if data is None or len(data) < 2 or data[0] != _HOSTTOPN532:
+            # Chip does not acknowledge invalid frames
+            self.checksum_errors += 1
+            return
+        self.frames_in += 1
+        now = self.clock()
+        self.output.append((now + ACK_DELAY, _ACK))
+        ready, response = self.execute(data[1], data[2:], now + ACK_DELAY)
+        if ready is not None:
+            self.output.append((ready, response))
+
+    def _wait_ready(self, timeout=1):
+        """Timeout is in emulated seconds"""
+        if not self.output:
+            self._sleep(timeout)
+            return False
+        wait = self.output[0][0] - self.clock()
+        if wait > timeout:
+            self._sleep(timeout)
+            return False
+        self._sleep(wait)
+        return True
+
+    def _read_data(self, count):
+        self._sleep(count * BYTE_TIME)
+        if not self.output or self.output[0][0] > self.clock():
+            # Chip is busy: only zeros are read
+            return bytearray(count)
+        ready, frame = self.output.popleft()
+        if frame is not _ACK:
+            self.frames_out += 1
+        return bytearray(frame[:count].ljust(count, b'\x00'))
+
+    def execute(self, command, params, now):
+        """Return the time the response is ready and the response frame"""
+        duration = COMMAND_TIME.get(command, 0.001)
+        if command == _COMMAND_GETFIRMWAREVERSION:
+            return now + duration, self.response(command, _FIRMWARE_VERSION)
+        if command == _COMMAND_SAMCONFIGURATION:
+            return now + duration, self.response(command, b'')
+        if command == _COMMAND_READGPIO:
+            return now + duration, self.response(command, b'\xFF\x07\x00')
+        if command == _COMMAND_WRITEGPIO:
+            return now + duration, self.response(command, b'')
+        if command == _COMMAND_INLISTPASSIVETARGET:
+            return self.in_list_passive_target(params, now)
+        if command == _COMMAND_INDATAEXCHANGE:
+            return self.in_data_exchange(params, now)
+        if command == _COMMAND_INAUTOPOLL:
+            return self.in_auto_poll(params, now)
+        return now + duration, _ERROR_FRAME
+
+    def response(self, command, data):
+        return build_frame(bytes([_PN532TOHOST, command + 1]) + bytes(data))
+
+    def in_list_passive_target(self, params, now):
+        """Chip keeps polling until a tag enters the field"""
+        max_targets = min(params[0], 2) if params else 1
+        t = self.trace.next_start(now)
+        if t is None:
+            return None, None
+        present = self.trace.present(t)[:max_targets]
+        ready = t + COMMAND_TIME[_COMMAND_INLISTPASSIVETARGET] * len(present)
+        self.selected = [p.uid for p in present]
+        data = bytearray([len(present)])
+        for i, presentation in enumerate(present):
+            data += self.target_data(i + 1, presentation.uid)
+        return ready, self.response(_COMMAND_INLISTPASSIVETARGET, data)
+
+    def in_auto_poll(self, params, now):
+        """Chip polls every period and answers at the first poll finding a tag"""
+        poll_count, period, types = params[0], params[1] * AUTOPOLL_PERIOD, params[2:]
+        target_type = next((t for t in types if t in (AUTOPOLL_MIFARE, AUTOPOLL_GENERIC_106,
+                                                      AUTOPOLL_ISO14443_4A)), None)
+        polls, t = 0, now
+        while target_type is not None and (poll_count == AUTOPOLL_ENDLESS or polls < poll_count):
+            start = self.trace.next_start(t)
+            if start is None:
+                return None, None
+            # Next poll on the period grid
+            polls = max(polls, int(-(-(start - now) // period)))
+            t = now + polls * period
+            present = self.trace.present(t)[:2]
+            if present and (poll_count == AUTOPOLL_ENDLESS or polls < poll_count):
+                ready = t + COMMAND_TIME[_COMMAND_INLISTPASSIVETARGET] * len(present)
+                self.selected = [p.uid for p in present]
+                data = bytearray([len(present)])
+                for i, presentation in enumerate(present):
+                    target = self.target_data(i + 1, presentation.uid)
+                    data += bytes([target_type, len(target)]) + target
+                return ready, self.response(_COMMAND_INAUTOPOLL, data)
+            polls += 1
+            t = now + polls * period
+        return now + poll_count * period, self.response(_COMMAND_INAUTOPOLL, b'\x00')
+
+    def target_data(self, number, uid):
+        """Tg, SENS_RES, SEL_RES, NFCIDLength, NFCID"""
+        tag = self.get_tag(uid)
+        tag.authenticated = set()
+        return bytes([number]) + tag.sens_res + bytes([tag.sel_res, len(tag.uid)]) + tag.uid
+
+    def in_data_exchange(self, params, now):
+        ready = now + COMMAND_TIME[_COMMAND_INDATAEXCHANGE]
+        status, data = self.exchange(params, ready)
+        if status == _STATUS_OK and params[1] in (MIFARE_CMD_WRITE, MIFARE_ULTRALIGHT_CMD_WRITE):
+            ready += WRITE_TIME
+        return ready, self.response(_COMMAND_INDATAEXCHANGE, bytes([status]) + data)
+
+    def exchange(self, params, t):
+        if len(params) < 3 or not 0 < params[0] <= len(self.selected):
+            return _STATUS_INVAL, b''
+        uid = self.selected[params[0] - 1]
+        if uid not in [p.uid for p in self.trace.present(t)]:
+            # Tag left the field
+            return _STATUS_TIMEOUT, b''
+        tag = self.get_tag(uid)
+        command, block = params[1], params[2]
+        if command in (MIFARE_CMD_AUTH_A, MIFARE_CMD_AUTH_B):
+            key, key_uid = params[3:9], params[9:]
+            if not tag.is_classic or bytes(key) != tag.key or bytes(key_uid) != tag.uid[:4]:
+                return _STATUS_MIFARE_AUTH, b''
+            tag.authenticated.add(block // 4)
+            return _STATUS_OK, b''
+        if command == MIFARE_CMD_READ:
+            data = tag.read(block)
+            return (_STATUS_OK, data) if data is not None else (_STATUS_MIFARE_AUTH, b'')
+        if command in (MIFARE_CMD_WRITE, MIFARE_ULTRALIGHT_CMD_WRITE):
+            if not tag.write(block, bytes(params[3:])):
+                return _STATUS_MIFARE_AUTH, b''
+            return _STATUS_OK, b''
+        return _STATUS_INVAL, b''
+
+    def stats(self):
+        return {"frames_in": self.frames_in,
+                "frames_out": self.frames_out,
+                "checksum_errors": self.checksum_errors}
+
+
+if __name__ == "__main__":
+    # Benchmark: python -m pn532.emulator [presentations] [speed] [tags presented together]
+    import sys
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 60
+    speed = float(sys.argv[2]) if len(sys.argv) > 2 else 10.0
+    group = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    trace = Trace.random(count, seed=1, group=group)
+    pn532 = PN532_Emulator(trace=trace, speed=speed)
+    pn532.SAM_configuration()
+    start = time.monotonic()
+    detected, latencies, polls = {}, [], 0
+    while pn532.clock() < trace.end:
+        uids = pn532.read_passive_targets(max_targets=min(group, 2), timeout=0.1)
+        polls += 1
+        if uids is None:
+            continue
+        t = pn532.clock()
+        for uid in uids:
+            presentation = next((p for p in trace.present(t) if p.uid == bytes(uid)), None)
+            if presentation and presentation not in detected:
+                detected[presentation] = t
+                latencies.append(t - presentation.start)
+    elapsed = time.monotonic() - start
+    latencies.sort()
+    print(f"{len(detected)}/{len(trace)} tags detected in {elapsed:.2f}s ({trace.end:.1f}s emulated, x{speed})")
+    print(f"{polls / (elapsed * speed):.1f} polls/s, {len(detected) / (elapsed * speed):.2f} scans/s emulated")
+    if latencies:
+        print(f"Detection latency: median {latencies[len(latencies)//2]*1000:.1f}ms, "
+              f"max {latencies[-1]*1000:.1f}ms")
+    print(pn532.stats())
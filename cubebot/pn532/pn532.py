@@ -32,8 +32,6 @@ This module will let you communicate with a PN532 NFC Hat using I2C, SPI or UART
 The main difference is the interfaces implements.
 """
 
-import RPi.GPIO as GPIO
-
 
 # pylint: disable=bad-whitespace
 _PREAMBLE                      = 0x00
@@ -85,6 +83,12 @@ _WAKEUP                        = 0x55
 
 _MIFARE_ISO14443A              = 0x00
 
+# InAutoPoll target types
+AUTOPOLL_GENERIC_106           = 0x00
+AUTOPOLL_MIFARE                = 0x10
+AUTOPOLL_ISO14443_4A           = 0x20
+AUTOPOLL_ENDLESS               = 0xFF
+
 # Mifare Commands
 MIFARE_CMD_AUTH_A                   = 0x60
 MIFARE_CMD_AUTH_B                   = 0x61
@@ -140,6 +144,9 @@ _ACK                           = b'\x00\x00\xFF\x00\xFF\x00'
 _FRAME_START                   = b'\x00\x00\xFF'
 # pylint: enable=bad-whitespace
 
+# Needs the constants above
+from .codec import FrameCodec  # pylint: disable=wrong-import-position
+
 PN532_ERRORS = {
     0x01: 'PN532 ERROR TIMEOUT',
     0x02: 'PN532 ERROR CRC',
@@ -190,6 +197,7 @@ class PN532:
         """Create an instance of the PN532 class
         """
         self.debug = debug
+        self._codec = FrameCodec()
         if reset:
             if debug:
                 print("Resetting")
@@ -230,33 +238,11 @@ class PN532:
         # Send special command to wake up
         raise NotImplementedError
 
-    def _write_frame(self, data):
-        """Write a frame to the PN532 with the specified data bytearray."""
-        assert data is not None and 1 < len(data) < 255, 'Data must be array of 1 to 255 bytes.'
-        # Build frame to send as:
-        # - Preamble (0x00)
-        # - Start code  (0x00, 0xFF)
-        # - Command length (1 byte)
-        # - Command length checksum
-        # - Command bytes
-        # - Checksum
-        # - Postamble (0x00)
-        length = len(data)
-        frame = bytearray(length+7)
-        frame[0] = _PREAMBLE
-        frame[1] = _STARTCODE1
-        frame[2] = _STARTCODE2
-        checksum = sum(frame[0:3])
-        frame[3] = length & 0xFF
-        frame[4] = (~length + 1) & 0xFF
-        frame[5:-2] = data
-        checksum += sum(data)
-        frame[-2] = ~checksum & 0xFF
-        frame[-1] = _POSTAMBLE
-        # Send frame.
+    def _write_frame(self, frame):
+        """Write a frame built by the codec to the PN532."""
         if self.debug:
             print('Write frame: ', [hex(i) for i in frame])
-        self._write_data(bytes(frame))
+        self._write_data(frame)
 
     def _read_frame(self, length):
         """Read a response frame from the PN532 of at most length bytes in size.
@@ -268,28 +254,7 @@ class PN532:
         response = self._read_data(length+7)
         if self.debug:
             print('Read frame:', [hex(i) for i in response])
-
-        # Swallow all the 0x00 values that preceed 0xFF.
-        offset = 0
-        while response[offset] == 0x00:
-            offset += 1
-            if offset >= len(response):
-                raise RuntimeError('Response frame preamble does not contain 0x00FF!')
-        if response[offset] != 0xFF:
-            raise RuntimeError('Response frame preamble does not contain 0x00FF!')
-        offset += 1
-        if offset >= len(response):
-            raise RuntimeError('Response contains no data!')
-        # Check length & length checksum match.
-        frame_len = response[offset]
-        if (frame_len + response[offset+1]) & 0xFF != 0:
-            raise RuntimeError('Response length checksum did not match length!')
-        # Check frame checksum value matches bytes.
-        checksum = sum(response[offset+2:offset+2+frame_len+1]) & 0xFF
-        if checksum != 0:
-            raise RuntimeError('Response checksum did not match expected value: ', checksum)
-        # Return frame data.
-        return response[offset+2:offset+2+frame_len]
+        return self._codec.decode(response)
 
     def call_function(self, command, response_length=0, params=None, timeout=1):
         """Send specified command to the PN532 and expect up to response_length
@@ -299,17 +264,11 @@ class PN532:
         for a response and return a bytearray of response bytes, or None if no
         response is available within the timeout.
         """
-        # Build frame data with command and parameters.
-        if params is None:
-            params = []
-        data = bytearray(2+len(params))
-        data[0] = _HOSTTOPN532
-        data[1] = command & 0xFF
-        for i, val in enumerate(params):
-            data[2+i] = val
+        # Build frame with command and parameters.
+        frame = self._codec.encode(command & 0xFF, params or ())
         # Send frame and wait for response.
         try:
-            self._write_frame(data)
+            self._write_frame(frame)
         except OSError:
             self._wakeup()
             return None
@@ -371,6 +330,64 @@ class PN532:
         # Return UID of card.
         return response[6:6+response[5]]
 
+    def read_passive_targets(self, max_targets=2, card_baud=_MIFARE_ISO14443A, timeout=1):
+        """Wait for up to max_targets (1 or 2) MiFare cards to be available and return
+        their UIDs as a list of bytearray, found in the same RF cycle.
+        Will wait up to timeout seconds and return None if no card is found.
+        """
+        assert max_targets in (1, 2), 'PN532 can only list 1 or 2 targets.'
+        try:
+            response = self.call_function(_COMMAND_INLISTPASSIVETARGET,
+                                          params=[max_targets, card_baud],
+                                          response_length=64,
+                                          timeout=timeout)
+        except BusyError:
+            return None # no card found!
+        if response is None:
+            return None
+        # Target records: Tg, SENS_RES (2 bytes), SEL_RES, NFCIDLength, NFCID
+        # then ATSLength and ATS if the target is ISO14443-4 compliant
+        uids = []
+        offset = 1
+        for _ in range(response[0]):
+            sel_res, uid_length = response[offset+3], response[offset+4]
+            if uid_length > 10:
+                raise RuntimeError('Found card with unexpectedly long UID!')
+            uids.append(response[offset+5:offset+5+uid_length])
+            offset += 5 + uid_length
+            if sel_res & 0x20:
+                offset += response[offset]
+        return uids
+
+    def auto_poll(self, poll_count=AUTOPOLL_ENDLESS, period=1, types=(AUTOPOLL_MIFARE,), timeout=1):
+        """Let the PN532 poll for targets by itself (InAutoPoll) and return the UIDs
+        of the targets found as a list of bytearray. Polling is done every period * 150ms,
+        poll_count times or endlessly. The host only waits for the response frame:
+        returns None if no target was found within timeout seconds, [] if poll_count
+        polls found nothing. Sending any other command stops the polling.
+        """
+        assert 1 <= period <= 15, 'Period must be from 1 to 15 (150ms units).'
+        assert 1 <= len(types) <= 15, 'Between 1 and 15 target types can be polled.'
+        try:
+            response = self.call_function(_COMMAND_INAUTOPOLL,
+                                          params=[poll_count, period] + list(types),
+                                          response_length=40,
+                                          timeout=timeout)
+        except BusyError:
+            return None
+        if response is None:
+            return None
+        uids = []
+        offset = 1
+        for _ in range(response[0]):
+            target_type, length = response[offset], response[offset+1]
+            data = response[offset+2:offset+2+length]
+            offset += 2 + length
+            if target_type in (AUTOPOLL_GENERIC_106, AUTOPOLL_MIFARE, AUTOPOLL_ISO14443_4A):
+                # Same target data as InListPassiveTarget: Tg, SENS_RES, SEL_RES, NFCIDLength, NFCID
+                uids.append(data[5:5+data[4]])
+        return uids
+
     def mifare_classic_authenticate_block(self, uid, block_number, key_number, key):   # pylint: disable=invalid-name
         """Authenticate specified block number for a MiFare classic card.  Uid
         should be a byte array with the UID of the card, block number should be
@@ -34,6 +34,7 @@ import time
 import spidev
 import RPi.GPIO as GPIO
 from .pn532 import PN532
+from .codec import FIXED_FRAMES
 
 # pylint: disable=bad-whitespace
 _SPI_STATREAD                  = 0x02
@@ -44,44 +45,53 @@ _SPI_READY                     = 0x01
 
 class SPIDevice:
     """Implements SPI device on spidev"""
-    def __init__(self, cs=None):
+    def __init__(self, cs=None, lsb_first=False, cs_delay=0.001):
         self.spi = spidev.SpiDev(0, 0)
         GPIO.setmode(GPIO.BCM)
         self._cs = cs
+        self._cs_delay = cs_delay
         if cs:
             GPIO.setup(self._cs, GPIO.OUT)
             GPIO.output(self._cs, GPIO.HIGH)
         self.spi.max_speed_hz = 1000000
         self.spi.mode = 0b10    # CPOL=1 & CPHA=0
+        self.lsb_first = False
+        if lsb_first:
+            try:
+                self.spi.lsbfirst = True
+                self.lsb_first = True
+            except OSError:
+                # Most controllers (Raspberry Pi included) are MSB first only
+                pass
 
-    def writebytes(self, buf):
+    def _select(self):
         if self._cs:
             GPIO.output(self._cs, GPIO.LOW)
-            time.sleep(0.001);
-        ret = self.spi.writebytes(list(buf))
+            if self._cs_delay:
+                time.sleep(self._cs_delay)
+
+    def _release(self):
         if self._cs:
-            time.sleep(0.001);
+            if self._cs_delay:
+                time.sleep(self._cs_delay)
             GPIO.output(self._cs, GPIO.HIGH)
+
+    def writebytes(self, buf):
+        self._select()
+        ret = self.spi.writebytes(list(buf))
+        self._release()
         return ret
 
     def readbytes(self, count):
-        if self._cs:
-            GPIO.output(self._cs, GPIO.LOW)
-            time.sleep(0.001);
+        self._select()
         ret = bytearray(self.spi.readbytes(count))
-        if self._cs:
-            time.sleep(0.001);
-            GPIO.output(self._cs, GPIO.HIGH)
+        self._release()
         return ret
 
     def xfer(self, buf):
-        if self._cs:
-            GPIO.output(self._cs, GPIO.LOW)
-            time.sleep(0.001);
-        buf = bytearray(self.spi.xfer(buf))
-        if self._cs:
-            time.sleep(0.001);
-            GPIO.output(self._cs, GPIO.HIGH)
+        self._select()
+        buf = bytearray(self.spi.xfer(list(buf)))
+        self._release()
         return buf
 
 
@@ -96,15 +106,38 @@ def reverse_bit(num):
     return result
 
 
+# reverse_bit of every byte, for bytes.translate
+_REVERSE = bytes(reverse_bit(i) for i in range(256))
+
+
+def reverse_bytes(buf):
+    """reverse_bit applied to every byte of buf"""
+    return bytearray(bytes(buf).translate(_REVERSE))
+
+
+# Fast mode timings in seconds. SPI timings of the datasheet are below the microsecond,
+# the guard delay between frames keeps a margin over them and over the status/data switch
+_FAST_FRAME_DELAY = 0.0001
+_FAST_POLL_MIN = 0.0002
+_FAST_POLL_MAX = 0.005
+
+
 class PN532_SPI(PN532):
     """Driver for the PN532 connected over SPI. Pass in a hardware SPI device
-    & chip select digitalInOut pin. Optional IRQ pin (not used), reset pin and
-    debugging output."""
-    def __init__(self, cs=None, irq=None, reset=None, debug=False):
+    & chip select digitalInOut pin. Optional IRQ pin, reset pin and
+    debugging output.
+    fast mode removes the fixed sleeps of every transaction: readiness is
+    given by the IRQ pin if connected, else by adaptive status polling."""
+    def __init__(self, cs=None, irq=None, reset=None, debug=False, fast=False):
         """Create an instance of the PN532 class using SPI"""
         self.debug = debug
+        self.fast = fast
         self._gpio_init(cs=cs, irq=irq, reset=reset)
-        self._spi = SPIDevice(cs)
+        self._spi = SPIDevice(cs, lsb_first=fast, cs_delay=0 if fast else 0.001)
+        # SPI transactions of the fixed frames and of read requests, in PN532 bit order
+        self._write_requests = {frame: self._lsb(bytes([_SPI_DATAWRITE]) + frame)
+                                for frame in FIXED_FRAMES.values()}
+        self._read_requests = {}
         super().__init__(debug=debug, reset=reset)
 
     def _gpio_init(self, reset=None, cs=None, irq=None):
@@ -118,7 +151,13 @@ class PN532_SPI(PN532):
             GPIO.setup(cs, GPIO.OUT)
             GPIO.output(cs, True)
         if irq:
-            GPIO.setup(irq, GPIO.IN)
+            GPIO.setup(irq, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+
+    def _lsb(self, buf):
+        """Convert bytes between host and PN532 bit order"""
+        if self._spi.lsb_first:
+            return bytearray(buf)
+        return reverse_bytes(buf)
 
     def _reset(self, pin):
         """Perform a hardware reset toggle"""
@@ -138,30 +177,52 @@ class PN532_SPI(PN532):
         self._spi.writebytes(bytearray([0x00])) #pylint: disable=no-member
         time.sleep(1)
 
+    def _status_ready(self):
+        status = self._spi.xfer(self._lsb([_SPI_STATREAD, 0])) #pylint: disable=no-member
+        return self._lsb(status)[1] == _SPI_READY  # LSB data is read in MSB
+
     def _wait_ready(self, timeout=1):
         """Poll PN532 if status byte is ready, up to `timeout` seconds"""
-        status = bytearray([reverse_bit(_SPI_STATREAD), 0])
+        if self.fast:
+            return self._wait_ready_fast(timeout)
         timestamp = time.monotonic()
         while (time.monotonic() - timestamp) < timeout:
             time.sleep(0.01)   # required
-            status = self._spi.xfer(status) #pylint: disable=no-member
-            if reverse_bit(status[1]) == _SPI_READY:  # LSB data is read in MSB
+            if self._status_ready():
                 return True      # Not busy anymore!
             else:
                 time.sleep(0.005)  # pause a bit till we ask again
         # We timed out!
         return False
 
+    def _wait_ready_fast(self, timeout):
+        if self._irq:
+            # IRQ is pulled low by the PN532 when a frame is ready (enabled by SAM_configuration)
+            if GPIO.input(self._irq) == GPIO.LOW:
+                return True
+            GPIO.wait_for_edge(self._irq, GPIO.FALLING, timeout=max(1, int(timeout * 1000)))
+            # Level check also catches an edge between the first check and the wait
+            return GPIO.input(self._irq) == GPIO.LOW
+        # Poll often at first (ACK comes within a millisecond), then back off
+        delay = _FAST_POLL_MIN
+        deadline = time.monotonic() + timeout
+        while True:
+            if self._status_ready():
+                return True
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(delay)
+            delay = min(delay * 2, _FAST_POLL_MAX)
+
     def _read_data(self, count):
         """Read a specified count of bytes from the PN532."""
-        # Build a read request frame.
-        frame = bytearray(count+1)
-        # Add the SPI data read signal byte, but LSB'ify it
-        frame[0] = reverse_bit(_SPI_DATAREAD)
-        time.sleep(0.005)   # required
-        frame = self._spi.xfer(frame) #pylint: disable=no-member
-        for i, val in enumerate(frame):
-            frame[i] = reverse_bit(val) # turn LSB data to MSB
+        # Build a read request frame: the SPI data read signal byte, LSB'ified
+        request = self._read_requests.get(count, None)
+        if request is None:
+            request = self._lsb(bytes([_SPI_DATAREAD]) + bytes(count))
+            self._read_requests[count] = request
+        time.sleep(_FAST_FRAME_DELAY if self.fast else 0.005)   # required
+        frame = self._lsb(self._spi.xfer(request)) #pylint: disable=no-member
         if self.debug:
             print("Reading: ", [hex(i) for i in frame[1:]])
         return frame[1:]
@@ -170,8 +231,35 @@ class PN532_SPI(PN532):
         """Write a specified count of bytes to the PN532"""
         # start by making a frame with data write in front,
         # then rest of bytes, and LSBify it
-        rev_frame = [reverse_bit(x) for x in bytes([_SPI_DATAWRITE]) + framebytes]
+        rev_frame = self._write_requests.get(framebytes, None) if isinstance(framebytes, bytes) else None
+        if rev_frame is None:
+            rev_frame = self._lsb(bytes([_SPI_DATAWRITE]) + framebytes)
         if self.debug:
             print("Writing: ", [hex(i) for i in rev_frame])
-        time.sleep(0.02)   # required
-        self._spi.writebytes(bytes(rev_frame))
+        time.sleep(_FAST_FRAME_DELAY if self.fast else 0.02)   # required
+        self._spi.writebytes(rev_frame)
+
+
+if __name__ == "__main__":
+    # Reads per second with a tag on the NFC hat: python -m pn532.spi [reads]
+    import sys
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    frame = bytes(range(32))
+    start = time.perf_counter()
+    for i in range(10000):
+        bytearray(reverse_bit(b) for b in frame)
+    loop = time.perf_counter() - start
+    start = time.perf_counter()
+    for i in range(10000):
+        reverse_bytes(frame)
+    table = time.perf_counter() - start
+    print(f"Bit reversal of a 32 bytes frame: {loop*100:.1f}us loop, {table*100:.2f}us table")
+    for fast in (False, True):
+        pn532 = PN532_SPI(debug=False, reset=20, cs=4, fast=fast)
+        pn532.SAM_configuration()
+        start = time.perf_counter()
+        found = sum(pn532.read_passive_target(timeout=1) is not None for i in range(count))
+        elapsed = time.perf_counter() - start
+        print(f"{'Fast' if fast else 'Standard'} mode: {count/elapsed:.1f} reads/s, "
+              f"{elapsed/count*1000:.2f}ms per read, {found}/{count} tags found")
+    GPIO.cleanup()
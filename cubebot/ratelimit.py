@@ -0,0 +1,57 @@
+import threading
+from time import monotonic, sleep
+
+
+class TokenBucket:
+    """Thread-safe token bucket: allow `rate` calls per second with bursts of `capacity` calls.
+    acquire() only sleeps when the budget is used up."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.last = monotonic()
+        self.lock = threading.Lock()
+        # Counters
+        self.requests = 0
+        self.wait_time = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def reserve(self, tokens=1):
+        """Take tokens from the bucket and return how long the caller has to wait before using them"""
+        with self.lock:
+            self._refill(monotonic())
+            self.tokens -= tokens
+            self.requests += 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            self.wait_time += wait
+            return wait
+
+    def delay(self, tokens=1):
+        """Return how long until tokens are available, without taking them"""
+        with self.lock:
+            self._refill(monotonic())
+            return max(0.0, (tokens - self.tokens) / self.rate)
+
+    def acquire(self, tokens=1):
+        """Block until tokens are available"""
+        wait = self.reserve(tokens)
+        if wait > 0:
+            sleep(wait)
+        return wait
+
+    def stats(self):
+        with self.lock:
+            return {"requests": self.requests, "wait_time": self.wait_time}
+
+    def reset_stats(self):
+        with self.lock:
+            self.requests = 0
+            self.wait_time = 0.0
+
+    def __repr__(self):
+        return f"<TokenBucket(rate={self.rate}, capacity={self.capacity}, "\
+               f"requests={self.requests}, wait_time={self.wait_time:.2f})>"
@@ -0,0 +1,87 @@
+import os
+import sys
+import logging
+import threading
+import config
+import audio
+from collections import namedtuple
+from time import time
+from model import session_scope, CubeList, DeckList, Deck
+from uid_resolver import normalize
+
+"""What to do when a tag is scanned during a game, compiled once when the game starts"""
+
+ScanAction = namedtuple("ScanAction", ["note", "sound", "media"])
+
+
+class ActionTable:
+    """Dict of tag uid: ScanAction for the cards played in a game which have a note or a signature"""
+
+    def __init__(self, game_id, cube_id, rows):
+        """rows: iterable of (uid, note, signature)"""
+        self.game_id = game_id
+        self.cube_id = cube_id
+        self.actions = {}
+        for uid, note, signature in rows:
+            sound, media = None, None
+            if signature:
+                sound = os.path.join(config.src_dir, "resources", "sounds", signature)
+                try:
+                    media = audio.load_sound(sound)
+                except FileNotFoundError:
+                    logging.info(f"Sound file not found: {sound}")
+                    sound = None
+            if note or sound:
+                self.actions[normalize(uid)] = ScanAction(note, sound, media)
+
+    def get(self, uid):
+        return self.actions.get(normalize(uid), None)
+
+    @property
+    def size(self):
+        """Approximate memory size in bytes, vlc media excluded"""
+        size = sys.getsizeof(self.actions)
+        for uid, action in self.actions.items():
+            size += sys.getsizeof(uid) + sys.getsizeof(action)
+            size += sum(sys.getsizeof(value) for value in (action.note, action.sound) if value)
+        return size
+
+    def __len__(self):
+        return len(self.actions)
+
+    def __repr__(self):
+        return f"<ActionTable(game_id={self.game_id}, actions={len(self.actions)}, size={self.size})>"
+
+
+_tables = {}
+_lock = threading.Lock()
+
+
+def build(game_id, cube_id):
+    start = time()
+    with session_scope() as s:
+        rows = s.query(CubeList.uid, DeckList.note, CubeList.signature)\
+                .join(DeckList, DeckList.card_id == CubeList.card_id).join(Deck)\
+                .filter(Deck.game_id == game_id, CubeList.cube_id == cube_id, CubeList.uid != None).all()
+    table = ActionTable(game_id, cube_id, rows)
+    logging.info(f"Scan action table built for game {game_id}: {table} in {time()-start:.3f}s")
+    return table
+
+
+def get_table(game_id, cube_id):
+    """Return action table of a game, build it if needed. Safe to call from the scanner thread"""
+    with _lock:
+        table = _tables.get(game_id, None)
+        if table is None:
+            table = build(game_id, cube_id)
+            _tables[game_id] = table
+        return table
+
+
+def invalidate(game_id=None):
+    """Drop action table of a game (or all tables) after notes, signatures or decks changed"""
+    with _lock:
+        if game_id is None:
+            _tables.clear()
+        else:
+            _tables.pop(game_id, None)
@@ -1,56 +1,152 @@
+import os
+import atexit
+import re
+import config
 import requests
 import json
 import logging
-from urllib.parse import quote, quote_plus
-from time import sleep
+from urllib.parse import quote, quote_plus, urlsplit
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from ratelimit import TokenBucket
+from scryfall_cache import ResponseCache
 
 """API Doc : https://scryfall.com/docs/api"""
 
+API_URL = "https://api.scryfall.com"
+# Max number of identifiers accepted by /cards/collection
+COLLECTION_SIZE = 75
+
+# Time limit of scryfall API: 10 requests per second
+limiter = TokenBucket(rate=10, capacity=10)
+# Keep-alive connections shared by all requests
+http_session = requests.Session()
+http_session.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=8))
+http_session.mount("http://", HTTPAdapter(pool_connections=2, pool_maxsize=8))
+
+# Responses cache, set to None to disable it
+cache = ResponseCache(getattr(config, "scryfall_cache", os.path.join(config.src_dir, "db", "scryfall_cache.db")))
+# Last access times of cache hits are written in batches
+atexit.register(lambda: cache and cache.flush())
+# Lifetime in seconds of cached responses by endpoint path, first match wins
+CACHE_TTL = [(re.compile(r"^/cards/random"), 0),
+             (re.compile(r"^/cards/search"), 24*3600),
+             (re.compile(r"^/cards/[^/]+/[^/]+$"), 30*24*3600), # translated card
+             (re.compile(r"^/cards/"), 7*24*3600),
+             (re.compile(r"^/sets"), 24*3600),
+             (re.compile(r"^/bulk-data"), 3600)]
+
+
+def get_ttl(url):
+    path = urlsplit(url).path
+    for regex, ttl in CACHE_TTL:
+        if regex.match(path):
+            return ttl
+    return 0
+
+
+def request(method, url, **kwargs):
+    """Send a rate limited request to the API using the shared session"""
+    limiter.acquire()
+    return http_session.request(method, url, **kwargs)
+
+
+def fetch(method, url, payload=None):
+    """Return status code and raw content of a request, from cache if possible.
+    Expired entries are revalidated with ETag/Last-Modified when available"""
+    ttl = get_ttl(url)
+    if not cache or not ttl:
+        r = request(method, url, json=payload)
+        return r.status_code, r.content
+    key = cache.key(method, url, payload)
+    entry = cache.get(key)
+    if entry and entry.is_fresh:
+        return requests.codes.ok, entry.content
+    headers = {}
+    if entry and entry.etag:
+        headers["If-None-Match"] = entry.etag
+    if entry and entry.last_modified:
+        headers["If-Modified-Since"] = entry.last_modified
+    r = request(method, url, json=payload, headers=headers)
+    if r.status_code == requests.codes.not_modified and entry:
+        cache.refresh(key, ttl)
+        return requests.codes.ok, entry.content
+    if r.status_code == requests.codes.ok:
+        cache.set(key, r.content, ttl,
+                  etag=r.headers.get("ETag", None),
+                  last_modified=r.headers.get("Last-Modified", None))
+    return r.status_code, r.content
+
 
 def get_content(url):
-    """Extract data from API json file. If there is multiple pages, gather them."""
+    """Extract data from API json file. Only first page of list objects is returned, see iter_pages."""
     if not url: return False
-    # Time limit of scryfall API
-    sleep(0.1)
-    r = requests.get(url)
+    status_code, content = fetch("GET", url)
     data = {}
-    if r.status_code == requests.codes.ok:
-        data = json.loads(r.content.decode('utf-8'))
+    if status_code == requests.codes.ok:
+        data = json.loads(content.decode('utf-8'))
         if data.get("object", False) == "error": 
             logging.info("API respond an error to url : {0}".format(url))
             return False
-        if data.get("has_more", None) and data.get("next_page", None):
-            content = get_content(data["next_page"])
-            data["data"] += content.get("data", [])
     return data
 
 
+def iter_pages(url):
+    """Yield each page of a list object, following next_page links"""
+    while url:
+        content = get_content(url)
+        if not content: return
+        yield content
+        url = content.get("next_page", None) if content.get("has_more", None) else None
+
+
+def iter_data(url):
+    """Yield objects of a list object page by page"""
+    for page in iter_pages(url):
+        yield from page.get("data", [])
+
+
+def post_content(url, payload):
+    """Post json payload to API and extract data from json response."""
+    if not url: return False
+    status_code, content = fetch("POST", url, payload)
+    data = {}
+    if status_code == requests.codes.ok:
+        data = json.loads(content.decode('utf-8'))
+        if data.get("object", False) == "error":
+            logging.info("API respond an error to url : {0}".format(url))
+            return False
+    return data
+
+
+def iter_sets():
+    """Yield all MTG set objects"""
+    return iter_data(API_URL + "/sets")
+
+
 def get_set_list():
     """Get list of all MTG set objects"""
-    url = "https://api.scryfall.com/sets"
-    content = get_content(url)
-    return content.get("data", None)
+    return list(iter_sets())
 
 
 def get_cards_list(edition):
     """Get list of cards from a set object"""
     url = edition.get("search_uri", False)
-    content = get_content(url)
-    return content.get("data", None)
+    return list(iter_data(url))
 
 
 def get_futur_sets():
     """Get list of all futur set objects until the last set with a past realease date"""
     present = datetime.now()
-    set_list = get_set_list()
     futur_sets = []
-    i = 0
-    while datetime.strptime(set_list[i].get("released_at", "3000-01-01"),'%Y-%m-%d') > present and i < len(set_list):
+    # Sets are sorted by release date, stop at first released set
+    for edition in iter_sets():
+        if datetime.strptime(edition.get("released_at", "3000-01-01"),'%Y-%m-%d') <= present:
+            break
         # Doesn't include Magic Online sets
-        if not set_list[i].get("digital", False):
-            futur_sets.append(set_list[i])
-        i += 1
+        if not edition.get("digital", False):
+            futur_sets.append(edition)
     return futur_sets
 
 
@@ -72,19 +168,19 @@ def get_card_set(card):
     set_code = card.get("code", None)
     if not set_code: return None
     
-    url = "https://api.scryfall.com/sets/{}".format(set_code)
+    url = API_URL + "/sets/{}".format(set_code)
     return get_content(url)
 
 
 def get_set(set_code):
     """Return set object from a set_code"""
     if not set_code: return None
-    url = "https://api.scryfall.com/sets/{}".format(set_code)
+    url = API_URL + "/sets/{}".format(set_code)
     return get_content(url)
 
 def get_card_by_id(scryfall_id):
     """Get card object by scryfall id"""
-    url = "https://api.scryfall.com/cards/{}".format(scryfall_id)
+    url = API_URL + "/cards/{}".format(scryfall_id)
     content = get_content(url)
     return content
 
@@ -96,25 +192,85 @@ def get_card_by_name(name, set="", exact=True):
         exact = "exact"
     else:
         exact = "fuzzy"
-    url = f"https://api.scryfall.com/cards/named?{exact}={quote(name)}{set}"
+    url = f"{API_URL}/cards/named?{exact}={quote(name)}{set}"
     content = get_content(url)
     if not content.get("object", "error") == "error": 
         return content
     else:
         return None
 
+def get_collection(identifiers, max_workers=1):
+    """Resolve a list of card identifiers ({"id": ...} or {"name": ..., "set": ...})
+    with as few requests as possible, up to max_workers requests at a time.
+    Return a tuple (cards, not_found)"""
+    cards, not_found = [], []
+    url = API_URL + "/cards/collection"
+    batches = [identifiers[i:i+COLLECTION_SIZE] for i in range(0, len(identifiers), COLLECTION_SIZE)]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        contents = executor.map(lambda batch: post_content(url, {"identifiers": batch}), batches)
+        for batch, content in zip(batches, contents):
+            if not content:
+                not_found += batch
+                continue
+            cards += content.get("data", [])
+            not_found += content.get("not_found", [])
+    return cards, not_found
+
+def get_cards_by_name(names):
+    """Return a list of card objects matching a list of (name, set_code) tuples.
+    A card which can't be found is returned as None"""
+    identifiers = []
+    for name, set_code in names:
+        identifier = {"name": name}
+        if set_code:
+            identifier["set"] = set_code
+        identifiers.append(identifier)
+    cards, not_found = get_collection(identifiers)
+    # Try again without set for cards not found in the given set
+    retry = [{"name": i["name"]} for i in not_found if "set" in i]
+    if retry:
+        cards += get_collection(retry)[0]
+
+    # Names may refer to a single face of a multi-faced card
+    index = {}
+    for card in cards:
+        for name in get_card_face_names(card):
+            index.setdefault(name.lower(), []).append(card)
+    results = []
+    for name, set_code in names:
+        candidates = index.get(name.lower(), [])
+        card = next((c for c in candidates if c.get("set", "") == (set_code or "").lower()), None)
+        if not card and candidates:
+            card = candidates[0]
+        results.append(card)
+    return results
+
+def get_cards_by_id(scryfall_ids, max_workers=1):
+    """Return a dict of card objects by scryfall id"""
+    cards, not_found = get_collection([{"id": i} for i in scryfall_ids], max_workers=max_workers)
+    if not_found:
+        logging.info(f"{len(not_found)} scryfall id(s) not found: {not_found}")
+    return {card["id"]: card for card in cards}
+
+def get_card_face_names(card):
+    """Return full name and face names of a card object"""
+    names = [card.get("name", "")]
+    for face in card.get("card_faces", []):
+        if face.get("name", None):
+            names.append(face["name"])
+    return names
+
+def iter_cards(query):
+    """Yield cards matching a scryfall search query page by page"""
+    url = API_URL + "/cards/search?q=" + quote_plus(query)
+    return iter_data(url)
+
 def search(**kwargs):
-    """General search using scryfall search engine"""
-    url = "https://api.scryfall.com/cards/search?q="
-    url += "+".join(quote_plus(f"{key}:{value}") for key, value in kwargs.items())
-    content = get_content(url)
-    if not content.get("object", "error") == "error": 
-        return content
-    else:
-        return None
+    """General search using scryfall search engine, return a generator of card objects"""
+    return iter_cards(" ".join(f"{key}:{value}" for key, value in kwargs.items()))
 
 def get_random_card(query=None):
-    url = "https://api.scryfall.com/cards/random"
+    url = API_URL + "/cards/random"
     if query:
         url += "?" + quote(query)
     content = get_content(url)
@@ -145,6 +301,14 @@ def get_card_names(card):
         card_names = [card.get("name", None)]
         return card_names
 
+def get_bulk_data(bulk_type="default_cards"):
+    """Get bulk data object (with its download_uri) of given type"""
+    url = API_URL + "/bulk-data/" + bulk_type
+    content = get_content(url)
+    if content and content.get("object", None) == "bulk_data":
+        return content
+    return None
+
 def get_related_tokens_id(card):
     ids = []
     for part in card.get("all_parts", []):
@@ -153,9 +317,7 @@ def get_related_tokens_id(card):
     return ids
             
 if __name__ == "__main__":
-    s = search(name="Valiant Rescuer", set="IKO")
-    data = s.get("data", [None])[0]
-    if data.get("object", None) == "card":
-        card = data
-    token = get_related_token_id(card)
-    print(token)
\ No newline at end of file
+    card = next(search(name="Valiant Rescuer", set="IKO"), None)
+    if card and card.get("object", None) == "card":
+        token = get_related_tokens_id(card)
+        print(token)
\ No newline at end of file
@@ -0,0 +1,158 @@
+import json
+import sqlite3
+import hashlib
+import logging
+import threading
+from time import time
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+
+class CacheEntry:
+
+    def __init__(self, content, etag, last_modified, expires):
+        self.content = content
+        self.etag = etag
+        self.last_modified = last_modified
+        self.expires = expires
+
+    @property
+    def is_fresh(self):
+        return self.expires > time()
+
+    def __repr__(self):
+        return f"<CacheEntry(size={len(self.content)}, etag={self.etag}, "\
+               f"last_modified={self.last_modified}, is_fresh={self.is_fresh})>"
+
+
+class ResponseCache:
+    """Persistent cache of API responses stored in a SQLite file.
+    Entries expire after a ttl and least recently used entries are evicted
+    once the cache is bigger than max_size bytes."""
+
+    # Last access times of hits are written together, at most this many hits late
+    touch_batch = 100
+
+    def __init__(self, path, max_size=200*1024*1024):
+        self.path = path
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS response ("
+                        "key TEXT PRIMARY KEY, content BLOB, etag TEXT, last_modified TEXT, "
+                        "expires REAL, last_access REAL, size INTEGER)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS ix_response_last_access ON response (last_access)")
+        self.db.commit()
+        self.size = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM response").fetchone()[0]
+        # key: last access not written yet
+        self.touched = {}
+        # Statistics
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.evicted = 0
+
+    @staticmethod
+    def key(method, url, payload=None):
+        """Normalize url (and payload for POST requests) into a cache key"""
+        parts = urlsplit(url)
+        query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+        key = method.upper() + " " + urlunsplit((parts.scheme.lower(), parts.netloc.lower(),
+                                                 parts.path, query, ""))
+        if payload is not None:
+            body = json.dumps(payload, sort_keys=True).encode('utf-8')
+            key += " " + hashlib.sha1(body).hexdigest()
+        return key
+
+    def get(self, key):
+        """Return the CacheEntry stored for key, even if expired, or None"""
+        with self.lock:
+            row = self.db.execute("SELECT content, etag, last_modified, expires FROM response WHERE key = ?",
+                                  (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.touched[key] = time()
+            if len(self.touched) >= self.touch_batch:
+                self._write_touched()
+                self.db.commit()
+            entry = CacheEntry(*row)
+            if entry.is_fresh:
+                self.hits += 1
+        return entry
+
+    def set(self, key, content, ttl, etag=None, last_modified=None):
+        now = time()
+        with self.lock:
+            old = self.db.execute("SELECT size FROM response WHERE key = ?", (key,)).fetchone()
+            if old:
+                # Stale entry downloaded again
+                self.size -= old[0]
+                self.misses += 1
+            self.db.execute("INSERT OR REPLACE INTO response VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            (key, content, etag, last_modified, now + ttl, now, len(content)))
+            self.size += len(content)
+            self.touched.pop(key, None)
+            self._write_touched()
+            self._evict()
+            self.db.commit()
+
+    def refresh(self, key, ttl):
+        """Extend lifetime of an entry revalidated by the server"""
+        with self.lock:
+            self.touched.pop(key, None)
+            self._write_touched()
+            self.db.execute("UPDATE response SET expires = ?, last_access = ? WHERE key = ?",
+                            (time() + ttl, time(), key))
+            self.db.commit()
+            self.hits += 1
+            self.revalidated += 1
+
+    def _write_touched(self):
+        """Write pending last access times in the current transaction, lock must be held"""
+        if self.touched:
+            self.db.executemany("UPDATE response SET last_access = ? WHERE key = ?",
+                                [(t, key) for key, t in self.touched.items()])
+            self.touched = {}
+
+    def flush(self):
+        """Write pending last access times, e.g. at the end of an import"""
+        with self.lock:
+            self._write_touched()
+            self.db.commit()
+
+    def _evict(self):
+        """Remove least recently used entries until the cache fits in max_size"""
+        if self.size <= self.max_size:
+            return
+        target = self.max_size * 0.9
+        rows = self.db.execute("SELECT key, size FROM response ORDER BY last_access")
+        keys = []
+        for key, size in rows:
+            if self.size <= target:
+                break
+            keys.append((key,))
+            self.size -= size
+        self.db.executemany("DELETE FROM response WHERE key = ?", keys)
+        self.evicted += len(keys)
+        logging.info(f"{len(keys)} response(s) evicted from cache")
+
+    def clear(self):
+        with self.lock:
+            self.db.execute("DELETE FROM response")
+            self.db.commit()
+            self.size = 0
+            self.touched = {}
+
+    def stats(self):
+        with self.lock:
+            entries = self.db.execute("SELECT COUNT(*) FROM response").fetchone()[0]
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "revalidated": self.revalidated,
+                "evicted": self.evicted,
+                "entries": entries,
+                "size": self.size}
+
+    def __repr__(self):
+        return f"<ResponseCache(path={self.path}, hits={self.hits}, misses={self.misses}, "\
+               f"revalidated={self.revalidated}, size={self.size})>"
@@ -0,0 +1,181 @@
+import os
+import json
+import shutil
+import logging
+import tempfile
+import threading
+import subprocess
+import requests
+import config
+import uid_resolver
+import scan_actions
+import media_cache
+from concurrent.futures import ThreadPoolExecutor
+from model import session_scope, CubeList
+
+"""Signature sounds sent by players are processed once in background by ffmpeg:
+leading and trailing silences are trimmed, loudness is normalized and duration is capped.
+Result is a mono PCM wav file, which vlc starts to play without probing or decoding,
+and an OGG/Opus preview sent as a voice message in Telegram dialogs."""
+
+SOUNDS_DIR = os.path.join(config.src_dir, "resources", "sounds")
+URL_FORMATS = [".mp3", ".m4a", ".ogg"]
+AUDIO_FORMATS = [".mp3", ".m4a"]
+VOICE_FORMATS = [".ogg", ".oga"]
+EXTENSION = ".wav"
+# Copy of a processed signature that Telegram plays as a voice message
+PREVIEW_EXTENSION = ".ogg"
+MAX_DURATION = 10.0     # seconds
+MAX_INPUT_DURATION = 60.0
+LOUDNESS = -16          # LUFS
+SILENCE = "-50dB"
+TIMEOUT = 120
+WORKERS = 2
+
+
+class UnknownFormat(Exception):
+    pass
+
+
+class DownloadError(Exception):
+
+    def __init__(self, status_code):
+        super().__init__(f"Download failed with status code {status_code}")
+        self.status_code = status_code
+
+
+def download(message, bot):
+    """Download the audio, voice or audio url of a message to a temporary file and return its path.
+    Return None if message has no audio, raises UnknownFormat or DownloadError for urls"""
+    if message.audio or message.voice:
+        file = bot.getFile((message.audio or message.voice).file_id)
+        filename, file_extension = os.path.splitext(file.file_path)
+        path = temporary_path(file_extension)
+        file.download(path)
+    elif message.entities:
+        url = message.parse_entity(message.entities[0])
+        filename, file_extension = os.path.splitext(url)
+        logging.info(f"Audio to download from url: {url}")
+        if file_extension not in URL_FORMATS:
+            raise UnknownFormat(file_extension)
+        r = requests.get(url)
+        if not r.ok:
+            raise DownloadError(r.status_code)
+        path = temporary_path(file_extension)
+        with open(path, 'wb') as f:
+            f.write(r.content)
+    else:
+        return None
+    logging.info(f"audio downloaded ({path})")
+    return path
+
+
+def send(bot, chat_id, filename, title):
+    """Send a signature file to a chat, uploaded once then sent by file_id"""
+    path = os.path.join(SOUNDS_DIR, filename)
+    file_extension = os.path.splitext(filename)[1]
+    if file_extension in AUDIO_FORMATS:
+        return media_cache.send(bot, "audio", chat_id, path, title=title, performer="cubebot")
+    elif file_extension in VOICE_FORMATS:
+        return media_cache.send(bot, "voice", chat_id, path, caption=title)
+    elif file_extension == EXTENSION:
+        preview = preview_path(path)
+        if os.path.exists(preview):
+            return media_cache.send(bot, "voice", chat_id, preview, caption=title)
+        return media_cache.send(bot, "document", chat_id, path, caption=title)
+
+
+def preview_path(path):
+    return os.path.splitext(path)[0] + PREVIEW_EXTENSION
+
+
+def temporary_path(extension):
+    fd, path = tempfile.mkstemp(suffix=extension, prefix="signature_")
+    os.close(fd)
+    return path
+
+
+def probe(path):
+    """Return duration in seconds and audio codec of a file"""
+    result = subprocess.run(["ffprobe", "-v", "error", "-select_streams", "a:0",
+                             "-show_entries", "format=duration:stream=codec_name", "-of", "json", path],
+                            check=True, capture_output=True, timeout=TIMEOUT)
+    info = json.loads(result.stdout)
+    streams = info.get("streams") or [{}]
+    return float(info["format"]["duration"]), streams[0].get("codec_name", None)
+
+
+def transcode(source, destination):
+    """Return (duration, source codec) of the transcoded file"""
+    codec = probe(source)[1]
+    trim = f"silenceremove=start_periods=1:start_threshold={SILENCE}"
+    # Trailing silence is trimmed as leading silence of the reversed sound
+    filters = ",".join([trim, "areverse", trim, "areverse", f"loudnorm=I={LOUDNESS}:TP=-1.5:LRA=11"])
+    partial = destination + ".part"
+    subprocess.run(["ffmpeg", "-y", "-v", "error", "-t", str(MAX_INPUT_DURATION), "-i", source,
+                    "-af", filters, "-t", str(MAX_DURATION), "-ac", "1", "-ar", "48000",
+                    "-c:a", "pcm_s16le", "-f", "wav", partial],
+                   check=True, capture_output=True, timeout=TIMEOUT)
+    # OGG/Opus preview of the processed sound for the Telegram dialogs
+    preview = preview_path(destination)
+    subprocess.run(["ffmpeg", "-y", "-v", "error", "-f", "wav", "-i", partial,
+                    "-c:a", "libopus", "-b:a", "64k", "-f", "ogg", preview + ".part"],
+                   check=True, capture_output=True, timeout=TIMEOUT)
+    os.replace(preview + ".part", preview)
+    # vlc never sees a file being written
+    os.replace(partial, destination)
+    return probe(destination)[0], codec
+
+
+_executor = None
+_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            # Work is done by ffmpeg processes, threads only wait for them
+            _executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="signature")
+        return _executor
+
+
+def process(source, cube_id, card_id, game_id=None):
+    """Runs on a worker thread: transcode a downloaded signature then save it as the signature
+    of a cube card. Return the signature filename"""
+    filename = f"{cube_id}_{card_id}{EXTENSION}"
+    try:
+        try:
+            duration, codec = transcode(source, os.path.join(SOUNDS_DIR, filename))
+            saved = filename
+        except (subprocess.SubprocessError, OSError, ValueError, KeyError) as e:
+            # Keep the file as sent, like before processing existed
+            if isinstance(e, FileNotFoundError):
+                logging.warning(f"ffmpeg or ffprobe not found (see doc/install.txt), "
+                                f"signature {source} saved unprocessed")
+            else:
+                logging.warning(f"Signature processing failed for {source}, keeping original file: {e!r}")
+            saved = f"{cube_id}_{card_id}{os.path.splitext(source)[1]}"
+            shutil.copyfile(source, os.path.join(SOUNDS_DIR, saved))
+            duration, codec = None, None
+        finally:
+            os.remove(source)
+        with session_scope() as s:
+            c = s.query(CubeList).filter(CubeList.card_id == card_id, CubeList.cube_id == cube_id).first()
+            c.signature = saved
+            c.signature_duration = duration
+            c.signature_source = codec
+            logging.info(f"{c} signed with {c.signature} ({duration}s, from {codec})")
+        uid_resolver.invalidate(cube_id)
+        scan_actions.invalidate(game_id)
+        return saved
+    except Exception as e:
+        # Nobody waits for the result
+        logging.exception(e)
+        raise
+
+
+def ingest(source, cube_id, card_id, game_id=None):
+    """Process a downloaded signature in background then save it as the signature of a cube card.
+    Return a future of the signature filename"""
+    return get_executor().submit(process, source, cube_id, card_id, game_id)
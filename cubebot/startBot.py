@@ -4,6 +4,8 @@ import sys
 import traceback
 from telegram import ParseMode
 from telegram.ext import Updater, CommandHandler
+from telegram.utils.request import Request
+from outbox import QueuedBot
 from telegram.utils.helpers import mention_html
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy import create_engine
@@ -16,10 +18,16 @@ logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s
 
 
 def main():
-    # Create the EventHandler and pass it your bot's token.
-    updater = Updater(config.telegram_token,
-                      use_context=True,
-                      request_kwargs={'read_timeout': 10, 'connect_timeout': 7})
+    # Messages are sent by the outbox, within Telegram rate limits. Several outbox workers
+    # send to several chats at once (e.g. a booster to every drafter), a chat is served in order
+    workers, outbox_workers = 4, 8
+    # One connection for each dispatcher and outbox worker, polling, job queue and main thread
+    request = Request(con_pool_size=workers + outbox_workers + 4, read_timeout=10, connect_timeout=7)
+    bot = QueuedBot(config.telegram_token, request=request, outbox_workers=outbox_workers)
+    # Create the EventHandler and pass it your bot.
+    updater = Updater(bot=bot,
+                      workers=workers,
+                      use_context=True)
     
     # Get the dispatcher to register handlers
     dp = updater.dispatcher
@@ -94,7 +102,8 @@ def send_help(update, context):
                 "/win - stop game\n"\
                 "/sealed - send sealed pool\n"\
                 "/draft - start draft\n"\
-                "/rematch - reload last decks\n"
+                "/rematch - reload last decks\n"\
+                "/update - sync cube with cubecobra\n"
 
     text += "/scan - scanner ses cartes\n"\
             "/load_deck - charger son dernier deck\n"\
@@ -0,0 +1,72 @@
+import logging
+import threading
+from collections import namedtuple
+from time import time
+from model import session_scope, Card, CubeList
+
+"""Resolve NFC tag uids to cube cards from memory"""
+
+TagRecord = namedtuple("TagRecord", ["card_id", "name", "signature", "cube_id"])
+
+
+def normalize(uid):
+    """pn532 returns uids as bytearray, DB stores bytes"""
+    return bytes(uid)
+
+
+class UidResolver:
+    """Dict of tag uid: TagRecord for the tagged cards of a cube"""
+
+    def __init__(self, cube_id, rows):
+        """rows: iterable of (uid, card_id, name, signature)"""
+        self.cube_id = cube_id
+        self.records = {normalize(uid): TagRecord(card_id, name, signature, cube_id)
+                        for uid, card_id, name, signature in rows}
+
+    def resolve(self, uid):
+        return self.records.get(normalize(uid), None)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __repr__(self):
+        return f"<UidResolver(cube_id={self.cube_id}, uids={len(self.records)})>"
+
+
+_resolvers = {}
+_lock = threading.Lock()
+
+
+def get_resolver(cube_id):
+    """Return uid resolver of a cube, build it if needed. Safe to call from the scanner thread"""
+    with _lock:
+        resolver = _resolvers.get(cube_id, None)
+        if resolver is None:
+            start = time()
+            with session_scope() as s:
+                rows = s.query(CubeList.uid, Card.id, Card.name, CubeList.signature).join(Card)\
+                        .filter(CubeList.cube_id == cube_id, CubeList.uid != None).all()
+            resolver = UidResolver(cube_id, rows)
+            _resolvers[cube_id] = resolver
+            logging.info(f"Uid resolver built for cube {cube_id}: {resolver} in {time()-start:.3f}s")
+        return resolver
+
+
+def tagged_uids():
+    """Uids of every tagged card, e.g. presented by the NFC emulator"""
+    with session_scope() as s:
+        return [uid for uid, in s.query(CubeList.uid).filter(CubeList.uid != None)]
+
+
+def resolve(cube_id, uid):
+    """Return TagRecord of a tag uid in a cube or None"""
+    return get_resolver(cube_id).resolve(uid)
+
+
+def invalidate(cube_id=None):
+    """Drop uid resolver of a cube (or all resolvers) after uids or signatures changed"""
+    with _lock:
+        if cube_id is None:
+            _resolvers.clear()
+        else:
+            _resolvers.pop(cube_id, None)
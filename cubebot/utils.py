@@ -2,13 +2,14 @@ import config
 import logging
 import os
 import scryfall
+import card_index
+import uid_resolver
+from catalog import catalog
 import ndef
-from random import shuffle
 from tqdm import tqdm
 from model import *
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, object_session
 from sqlalchemy import create_engine
-from sqlalchemy import not_
 from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
 import csv
 import requests
@@ -16,8 +17,9 @@ import feedparser
 from time import mktime, sleep
 from datetime import datetime
 from bs4 import BeautifulSoup
-from pn532 import PN532_SPI
+from nfc_scanner import get_pn532
 from deckstat_interface import get_sealed_url
+from boosters import set_boosters
 
 
 def create_cube(name, cubecobra_id):
@@ -28,58 +30,136 @@ def create_cube(name, cubecobra_id):
     session.add(c)
     import_cubecobra(c)
     session.commit()
+    card_index.invalidate(c.id)
     logging.info("commit")
     return c
 
 
 def import_cubecobra(cube, include_maybeboard=False, from_file=False):
     cards = get_cube_list(cube, from_file=from_file) #True if test on update
-    cards = tqdm(cards, total=len(cards))
-    cards.set_description(f"Cube creation")
+    new_cards = []
     for card in cards:
         if card["Maybeboard"] == "true" and not include_maybeboard:
             continue
-        c = Card(name=card["Name"],
-                 set_code=card["Set"],
-                 cmc=card["CMC"],
-                 color=card["Color"],
-                 type_line=card["Type"],
-                 status=card["Status"],
-                 tags=card["Tags"])
-        add_scryfall_infos(c)
-        cube.cards.append(c)
+        new_cards.append(set_card_fields(Card(), card))
+    add_scryfall_infos_batch(new_cards)
+    cube.cards.extend(new_cards)
 
     logging.info("CubeCobra succesfully imported")
+    logging.info(f"Scryfall requests: {scryfall.limiter.stats()}")
     return cube
 
 
-def add_scryfall_infos(card):
+def set_card_fields(card_db, card):
+    """Copy fields of a cubecobra csv row to a Card"""
+    card_db.name = card["Name"]
+    card_db.set_code = card["Set"]
+    card_db.cmc = card["CMC"]
+    card_db.color = card["Color"]
+    card_db.type_line = card["Type"]
+    card_db.status = card["Status"]
+    card_db.tags = card["Tags"]
+    return card_db
+
+
+def add_scryfall_infos(card, tokens=None):
     """Add scryfall id, image_url
        Then create related token and link them to card"""
-    s = scryfall.get_card_by_name(card.name, set=card.set_code, exact=True)
-    if s.get("object", None) == "card":
+    add_scryfall_infos_batch([card], tokens=tokens)
+
+
+def add_scryfall_infos_batch(cards, tokens=None):
+    """Same as add_scryfall_infos for a list of cards.
+       Cards then related tokens are fetched by batch from scryfall"""
+    if tokens is None:
+        tokens = TokenRegistry()
+    results = get_cards_by_name([(card.name, card.set_code) for card in cards])
+    cards_tokens_id = []
+    for card, s in zip(cards, results):
+        if not s:
+            logging.info(f"[{card.name}] not found on scryfall")
+            continue
         card.scryfall_id = s["id"]
         card.name = s["name"]
         card.image_url = scryfall.get_image_urls(s)[0]
-        tokens_id = scryfall.get_related_tokens_id(s)
-        for token_id in tokens_id:
-            t = scryfall.get_card_by_id(token_id)
-            color = scryfall.get_card_color(t)
-            # Check for existing tokens
-            token = session.query(Token).filter(Token.name==t["name"],
-                                                Token.power==t.get("power", None),
-                                                Token.toughness==t.get("toughness", None),
-                                                Token.color==color).first()
-            # If token doesnt exist we create it
-            if not token:
-                token = Token(name = t["name"],
-                              power = t.get("power", None),
-                              toughness = t.get("toughness", None),
-                              color = scryfall.get_card_color(t),
-                              image_url = scryfall.get_image_urls(t)[0],
-                              scryfall_id = t["id"])
-            # Add related token to card
-            card.tokens.append(token)
+        cards_tokens_id.append((card, scryfall.get_related_tokens_id(s)))
+
+    related_tokens = tokens.get_tokens({token_id for card, ids in cards_tokens_id for token_id in ids})
+    for card, ids in cards_tokens_id:
+        for token_id in ids:
+            if token_id in related_tokens:
+                # Add related token to card
+                card.tokens.append(related_tokens[token_id])
+
+
+class TokenRegistry:
+    """Tokens indexed by scryfall id and by (name, power, toughness, color).
+    Load it once per import so each distinct token costs at most one request and one insert."""
+
+    def __init__(self, max_workers=4):
+        self.max_workers = max_workers
+        self.by_id = {}
+        self.by_key = {}
+        self.missing = set()
+        for token in session.query(Token).all():
+            if token.scryfall_id:
+                self.by_id.setdefault(token.scryfall_id, token)
+            self.by_key.setdefault(self.key(token.name, token.power, token.toughness, token.color), token)
+
+    @staticmethod
+    def key(name, power, toughness, color):
+        # power and toughness are strings on scryfall but may be loaded as int from DB
+        return (name,
+                None if power is None else str(power),
+                None if toughness is None else str(toughness),
+                color)
+
+    def get_tokens(self, scryfall_ids):
+        """Return a dict of Token by scryfall id, unknown tokens are fetched concurrently then created"""
+        unknown = {i for i in scryfall_ids if i not in self.by_id and i not in self.missing}
+        if unknown:
+            logging.info(f"Fetch {len(unknown)} unknown token(s)")
+            cards = get_cards_by_id(unknown, max_workers=self.max_workers)
+            self.missing.update(unknown - cards.keys())
+            for scryfall_id, t in cards.items():
+                color = scryfall.get_card_color(t)
+                key = self.key(t["name"], t.get("power", None), t.get("toughness", None), color)
+                token = self.by_key.get(key, None)
+                # If token doesnt exist we create it
+                if not token:
+                    token = Token(name = t["name"],
+                                  power = t.get("power", None),
+                                  toughness = t.get("toughness", None),
+                                  color = color,
+                                  image_url = scryfall.get_image_urls(t)[0],
+                                  scryfall_id = t["id"])
+                    self.by_key[key] = token
+                self.by_id[scryfall_id] = token
+        return {i: self.by_id[i] for i in scryfall_ids if i in self.by_id}
+
+
+def get_cards_by_name(names):
+    """Resolve (name, set_code) tuples from local catalog, then from scryfall API on a miss"""
+    if not catalog.is_available:
+        return scryfall.get_cards_by_name(names)
+    results = catalog.get_cards_by_name(names)
+    misses = [i for i, card in enumerate(results) if card is None]
+    if misses:
+        logging.info(f"{len(misses)} card(s) not found in catalog")
+        for i, card in zip(misses, scryfall.get_cards_by_name([names[i] for i in misses])):
+            results[i] = card
+    return results
+
+
+def get_cards_by_id(scryfall_ids, max_workers=1):
+    """Get a dict of card objects by scryfall id from local catalog, then from scryfall API on a miss"""
+    if not catalog.is_available:
+        return scryfall.get_cards_by_id(scryfall_ids, max_workers=max_workers)
+    cards = catalog.get_cards_by_id(scryfall_ids)
+    misses = [i for i in scryfall_ids if i not in cards]
+    if misses:
+        cards.update(scryfall.get_cards_by_id(misses, max_workers=max_workers))
+    return cards
 
 
 def import_basic_lands(cube):
@@ -117,7 +197,7 @@ def get_cube_list(cube, from_file=False):
 
 def quick_scan(cube):
     """Show card on screen then scan it to pear tag id to card in DB"""
-    pn532 = PN532_SPI(debug=False, reset=20, cs=4)
+    pn532 = get_pn532(emulated_uids=uid_resolver.tagged_uids)
     pn532.SAM_configuration()
     cards = session.query(CubeList, Card).join(Card).filter(CubeList.cube_id == cube.id).all()
     uids = []
@@ -132,13 +212,14 @@ def quick_scan(cube):
             cube_card.uid = uid
             # write_string_to_tag(f"https://scryfall.com/card/{card.scryfall_id}", pn532)
             session.commit()
+            uid_resolver.invalidate(cube.id)
             loop = False
 
 
 def scan_card_for_DB(cube):
     # TODO write gatherer link of the card to nfc chip for phone scan - ntag2xx_write_block
     # https://blog.foulquier.info/tutoriels/iot/installation-de-la-carte-nfc-pn532-sur-un-arduino-et-ecriture-d-un-message-ndef-sur-un-tag-mifare-classic
-    pn532 = PN532_SPI(debug=False, reset=20, cs=4)
+    pn532 = get_pn532(emulated_uids=uid_resolver.tagged_uids)
     pn532.SAM_configuration()
     loop = True
     logging.info("Place card on the scanner one by one... Type 'Done' to stop process.")
@@ -157,6 +238,7 @@ def scan_card_for_DB(cube):
             card = card_list[0]
             card.uid = uid
             session.commit()
+            uid_resolver.invalidate(card.cube_id)
             # ntag2xx_write_block(1, url)
             logging.info(f"Saved: {card}\nPlace next card on the scanner...")
         elif card_name == "Done":
@@ -170,7 +252,7 @@ def scan_card_for_DB(cube):
 
 def scan_card_to_write_url(cube):
     """Scan card to write card url on tag"""
-    pn532 = PN532_SPI(debug=False, reset=20, cs=4)
+    pn532 = get_pn532(emulated_uids=uid_resolver.tagged_uids)
     pn532.SAM_configuration()
     loop = True
     logging.info("Place card on the scanner then wait before removing it")
@@ -197,8 +279,7 @@ def scan_card_to_write_url(cube):
 
 
 def test_scan(cube):
-    cubelist = session.query(CubeList).join(Card).filter(CubeList.uid != None).all()
-    pn532 = PN532_SPI(debug=False, reset=20, cs=4)
+    pn532 = get_pn532(emulated_uids=uid_resolver.tagged_uids)
     pn532.SAM_configuration()
     logging.info("Start scanning to see if it works...")
     loop = True
@@ -210,13 +291,13 @@ def test_scan(cube):
             continue
         logging.info(uid)
         # Check if uid is known
-        c = next((c for c in cubelist if c.uid == uid), None)
-        if c:
-           logging.info(c.card)
+        record = uid_resolver.resolve(cube.id, uid)
+        if record:
+           logging.info(record)
 
 
 def update_cube(cube, commit=True):
-    """WARNING: Only works on singleton cubes for now"""
+    """WARNING: Only works on singleton cubes for now, see sync_cube"""
     rss = "https://cubecobra.com/cube/rss/" + cube.cubecobra_id
     updates = feedparser.parse(rss).entries
     t1 = mktime(cube.last_update.timetuple())
@@ -302,27 +383,96 @@ def update_cube(cube, commit=True):
                                                                     CubeList.cube_id == cube.id).all()
             cubelist_db = tqdm(cubelist_db, total=len(cubelist_db))
             cubelist_db.set_description("Update cards info")
+            cubelist = {card["Name"]: card for card in cubelist}
+            cards_to_fill = []
             for card_db in cubelist_db:
-                for card in cubelist:
-                    if card_db.name == card["Name"]:
-                        # logging.info(f"Update data for {card_db.name}.")
-                        card_db.set_code = card["Set"]
-                        card_db.cmc=card["CMC"]
-                        card_db.color=card["Color"]
-                        card_db.type_line=card["Type"]
-                        card_db.status=card["Status"]
-                        card_db.tags=card["Tags"]
-                        add_scryfall_infos(card_db)
-                        break
+                card = cubelist.get(card_db.name, None)
+                if card:
+                    # logging.info(f"Update data for {card_db.name}.")
+                    set_card_fields(card_db, card)
+                    cards_to_fill.append(card_db)
+            add_scryfall_infos_batch(cards_to_fill)
             # Add yes no option / telegram handler
             if commit: 
                 session.commit()
+                card_index.invalidate(cube.id)
+                uid_resolver.invalidate(cube.id)
                 logging.info(f"{cube.name} updated successfully.")
             else:
                 logging.info("Update Complete. /!\ No commit was made.")
     return len(updates_to_proceed)
 
 
+def card_key(name):
+    """Key used to match a cubecobra card name with a DB card name.
+    Some cards with "//" in their name on scryfall are without "//" on cubecobra"""
+    return name.split(" // ")[0].strip().lower()
+
+
+def sync_cube(cube, include_maybeboard=False, commit=True):
+    """Synchronize cube with its cubecobra csv in a single pass, works on non singleton cubes.
+    Each copy of a card is a CubeList row: rows removed on cubecobra are reused for added cards
+    (swap keeps the uid of the tag), then remaining rows are deleted and remaining cards inserted.
+    Works in the session of the cube. Return a dict with the number of added, removed and swapped cards"""
+    start = datetime.now()
+    s = object_session(cube) or session
+    remote = {}
+    for card in get_cube_list(cube):
+        if card["Maybeboard"] == "true" and not include_maybeboard:
+            continue
+        remote.setdefault(card_key(card["Name"]), []).append(card)
+
+    local = {}
+    rows = s.query(CubeList, Card).join(Card).filter(CubeList.cube_id == cube.id).all()
+    for cube_card, card_db in rows:
+        key = card_key(card_db.name)
+        if key not in remote and card_db.type_line == "Basic Land":
+            # Basic lands are added by import_basic_lands, not by cubecobra
+            continue
+        local.setdefault(key, []).append((cube_card, card_db))
+
+    to_fill, to_add, to_remove = [], [], []
+    for key in local.keys() | remote.keys():
+        copies, remote_copies = local.get(key, []), remote.get(key, [])
+        # Keep copies with a tag or a signature first
+        copies.sort(key=lambda c: (c[0].uid is None, c[0].signature is None))
+        for (cube_card, card_db), card in zip(copies, remote_copies):
+            if card_db.set_code is None:
+                to_fill.append(set_card_fields(card_db, card))
+        to_remove += [cube_card for cube_card, card_db in copies[len(remote_copies):]]
+        to_add += remote_copies[len(copies):]
+
+    new_cards = [set_card_fields(Card(), card) for card in to_add]
+    add_scryfall_infos_batch(to_fill + new_cards)
+    s.add_all(new_cards)
+    s.flush()
+
+    # Swap: removed rows point to new cards
+    swapped = min(len(to_remove), len(new_cards))
+    for cube_card, card_db in zip(to_remove, new_cards):
+        logging.info(f"~[{cube_card.card.name} → {card_db.name}]")
+        cube_card.card_id = card_db.id
+        cube_card.signature = None
+    removed = [cube_card.card_id for cube_card in to_remove[swapped:]]
+    if removed:
+        s.query(CubeList).filter(CubeList.cube_id == cube.id,
+                                 CubeList.card_id.in_(removed)).delete(synchronize_session=False)
+    added = [{"cube_id": cube.id, "card_id": card_db.id} for card_db in new_cards[swapped:]]
+    if added:
+        s.bulk_insert_mappings(CubeList, added)
+    cube.last_update = datetime.now()
+
+    result = {"added": len(added), "removed": len(removed), "swapped": swapped}
+    if commit:
+        s.commit()
+        card_index.invalidate(cube.id)
+        uid_resolver.invalidate(cube.id)
+        logging.info(f"{cube.name} synchronized in {datetime.now()-start}: {result}")
+    else:
+        logging.info(f"Sync Complete: {result}. /!\ No commit was made.")
+    return result
+
+
 def write_url_to_tag(url, scanner, block_size=4, write_size=16):
     records = [ndef.UriRecord(url)]
     data = b"\x03<" + b"".join(ndef.message_encoder(records)) + b"\xfe"
@@ -354,79 +504,6 @@ def remove_games_from_cube(cube, state):
     session.commit()
 
 
-def set_boosters(draft):
-    boosters = []
-    if draft.cube.id in [1,5]:
-        draft.booster_size = 9
-        draft.round_num = 5
-        cube_cards = session.query(Card).join(CubeList).filter(CubeList.cube_id == draft.cube.id,
-                                                               Card.type_line != "Basic Land",
-                                                               Card.tags != "Draft").all()
-        shuffle(cube_cards)
-        logging.info(f"{len(cube_cards)} cards selected.")
-        n = 0
-        for drafter in draft.drafters:
-            for i in range(draft.round_num):
-                booster_cards = []
-                # 9 cards per boost
-                while len(booster_cards) < draft.booster_size:
-                    booster_cards.append(cube_cards.pop())
-                boosters.append(Booster(id=n, cards=booster_cards))
-                n += 1
-
-    elif draft.cube.id == 4:
-        # Custom function for Greg Cube Draft
-        commanders = session.query(Card).join(CubeList).filter(CubeList.cube_id == 3,
-                                                               Card.type_line != "Basic Land",
-                                                               not_(Card.tags.contains('partnerWith'))).all()
-        # Manually add partners
-        for partner in draft.partners:
-            commanders.append(session.query(Card).join(CubeList).filter(CubeList.cube_id == 3,
-                                                                        Card.name == partner["name"]).first())
-
-        cube_cards = session.query(Card).join(CubeList).filter(CubeList.cube_id == 4,
-                                                               Card.type_line != "Basic Land").all()
-
-        shuffle(cube_cards)
-        shuffle(commanders)
-
-        n = 0
-        for drafter in draft.drafters:
-            # 5 main boosters
-            for i in range(5):
-                booster_cards = []
-                # 12 cards per boost
-                while len(booster_cards) < 12:
-                    booster_cards.append(cube_cards.pop())
-                boosters.append(Booster(id=n, cards=booster_cards))
-                n += 1
-
-        command_tower = session.query(Card).filter(Card.name == "Command Tower").first()
-        # Add commander last to be poped first during draft
-        for drafter in draft.drafters:
-            # Every player get the card 'command tower' to build his deck
-            drafter.pool.append(command_tower)
-            booster_cards = []
-            # 6 cards per boost
-            while len(booster_cards) < 6:
-                booster_cards.append(commanders.pop())
-            boosters.append(Booster(id=n, cards=booster_cards))
-            n += 1
-
-    else:
-        logging.info("No specific configuration for this cube")
-        return None, None
-
-    draft.boosters = boosters
-
-    content = ""
-    for card in cube_cards:
-        content += card.name + "\n"
-        filename = "Cartes restantes.txt"
-
-    return content, filename
-
-
 if __name__ == "__main__":
     """To test update :
     - create cube with last_update = 2020-04-01 13:58:21